@@ -2,17 +2,34 @@ import gradio as gr
 import json
 import os
 import sys
-import copy
 import random
 import requests
+from requests.adapters import HTTPAdapter
+import httpx
 import time
+import concurrent.futures
+import collections
+import hashlib
+import asyncio
+import struct
+import sqlite3
+import zlib
+import weakref
 import base64
 import uuid
 import websocket
 import threading
+import atexit
 import logging
 import traceback
 from io import BytesIO
+# 可选依赖：安装了watchdog时通过系统文件通知(inotify等)监视输出文件夹，否则定期轮询
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
 from PIL import Image
 import shutil
 import datetime
@@ -35,6 +52,76 @@ logging.basicConfig(
     ]
 )
 
+# ComfyUI相关子系统的日志，默认级别由COMFYUI_LOG_LEVEL设置（默认INFO），
+# 可通过COMFYUI_LOG_LEVELS按子系统单独调整，例如 "websocket=DEBUG,http=WARNING"，
+# 子系统包括 http、websocket、job、history、pool、workflow、retention；
+# 设置COMFYUI_LOG_JSON为文件路径时，同时以每行一条JSON的格式写入该文件
+COMFYUI_LOG_LEVEL = os.environ.get("COMFYUI_LOG_LEVEL", "INFO")
+COMFYUI_LOG_LEVELS = os.environ.get("COMFYUI_LOG_LEVELS", "")
+COMFYUI_LOG_JSON = os.environ.get("COMFYUI_LOG_JSON", "")
+
+# JSON行格式的日志，便于用工具检索和统计
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup_comfyui_logging():
+    comfyui_logger = logging.getLogger("comfyui")
+    try:
+        comfyui_logger.setLevel(COMFYUI_LOG_LEVEL.strip().upper())
+    except ValueError:
+        print(f"无效的日志级别: {COMFYUI_LOG_LEVEL}，使用INFO")
+        comfyui_logger.setLevel(logging.INFO)
+    for item in COMFYUI_LOG_LEVELS.split(","):
+        if "=" not in item:
+            continue
+        name, level = item.split("=", 1)
+        try:
+            logging.getLogger(f"comfyui.{name.strip()}").setLevel(level.strip().upper())
+        except ValueError:
+            print(f"无效的日志级别: {item}")
+    if COMFYUI_LOG_JSON:
+        json_handler = logging.FileHandler(COMFYUI_LOG_JSON, encoding="utf-8")
+        json_handler.setFormatter(JsonLogFormatter())
+        comfyui_logger.addHandler(json_handler)
+
+setup_comfyui_logging()
+
+http_log = logging.getLogger("comfyui.http")
+ws_log = logging.getLogger("comfyui.websocket")
+job_log = logging.getLogger("comfyui.job")
+history_log = logging.getLogger("comfyui.history")
+pool_log = logging.getLogger("comfyui.pool")
+workflow_log = logging.getLogger("comfyui.workflow")
+retention_log = logging.getLogger("comfyui.retention")
+
+# 按次数采样的调试日志，用于每一帧都会触发的消息：同一类消息每every次只输出一次，
+# 调试级别未开启时直接返回，不做任何格式化
+class LogSampler:
+    def __init__(self, logger, every=100):
+        self.logger = logger
+        self.every = every
+        self.counts = collections.Counter()
+    
+    def debug(self, key, msg, *args):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        self.counts[key] += 1
+        count = self.counts[key]
+        if count % self.every == 1 or self.every == 1:
+            self.logger.debug(msg + "（采样，累计 %s 次）", *args, count)
+
+ws_sampler = LogSampler(ws_log)
+
 # 捕获未处理的异常
 def handle_exception(exc_type, exc_value, exc_traceback):
     logging.error("未捕获的异常", exc_info=(exc_type, exc_value, exc_traceback))
@@ -57,210 +144,566 @@ except Exception as e:
 # ComfyUI服务器地址
 COMFYUI_SERVER = "127.0.0.1:8188"  # 可以根据实际情况修改
 
+# ComfyUI服务器列表，可通过环境变量COMFYUI_SERVERS配置多个服务器（逗号分隔），
+# 任务会分配给队列最短的服务器；未配置时只使用COMFYUI_SERVER
+COMFYUI_SERVERS = [server.strip() for server in os.environ.get("COMFYUI_SERVERS", COMFYUI_SERVER).split(",") if server.strip()]
+
+# 排队上限：每个用户、以及所有用户合计同时排队或生成中的任务数
+COMFYUI_MAX_PENDING_PER_USER = int(os.environ.get("COMFYUI_MAX_PENDING_PER_USER", "2"))
+COMFYUI_MAX_PENDING_TOTAL = int(os.environ.get("COMFYUI_MAX_PENDING_TOTAL", "20"))
+
+# 文件保留策略：ComfyUI input文件夹中本程序按内容哈希命名上传的图片、本地output文件夹和预览图缓存的
+# 最长保留天数与容量上限(MB)，0表示不限制；output默认不清理，需要时通过环境变量开启
+COMFYUI_INPUT_MAX_AGE_DAYS = float(os.environ.get("COMFYUI_INPUT_MAX_AGE_DAYS", "7"))
+COMFYUI_INPUT_QUOTA_MB = float(os.environ.get("COMFYUI_INPUT_QUOTA_MB", "2048"))
+COMFYUI_OUTPUT_MAX_AGE_DAYS = float(os.environ.get("COMFYUI_OUTPUT_MAX_AGE_DAYS", "0"))
+COMFYUI_OUTPUT_QUOTA_MB = float(os.environ.get("COMFYUI_OUTPUT_QUOTA_MB", "0"))
+COMFYUI_PREVIEW_QUOTA_MB = float(os.environ.get("COMFYUI_PREVIEW_QUOTA_MB", "1024"))
+
 # WSL路径常量
 WSL_COMFYUI_PATH = "\\\\wsl$\\ComfyUI-Ubuntu\\home\\ComfyUI"
 
-# 读取workflows.json文件
-def load_workflow():
-    # 首先尝试当前目录的json文件夹
-    try:
-        with open("json/workflows.json", "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        import sys
-        import os
+# 工作流模板注册表：按名称缓存解析好的工作流。访问时最多每check_interval秒检查一次文件的
+# 修改时间和大小，文件变化后重新读取并整体替换缓存的模板，读取失败时继续使用旧模板；
+# 参数补丁计划按模板对象缓存，模板替换后会重新编译。修改工作流文件后无需重启程序
+class WorkflowTemplateRegistry:
+    def __init__(self, check_interval=2.0):
+        self.check_interval = check_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+    
+    # 注册模板文件：优先使用当前目录下的文件，不存在时使用相对于exe的目录
+    def register(self, name, relative_path):
         exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "json", "workflows.json")
+        self._entries[name] = {
+            "paths": [relative_path, os.path.join(exe_dir, relative_path)],
+            "path": None,
+            "data": {},
+            "signature": None,
+            "checked": None,
+        }
+        return self.get(name)
+    
+    @staticmethod
+    def _stat(entry):
+        for path in entry["paths"]:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            return path, (path, stat.st_mtime_ns, stat.st_size)
+        return None, None
+    
+    def _refresh(self, name, entry):
+        path, signature = self._stat(entry)
+        if signature == entry["signature"] and entry["checked"] is not None:
+            return
+        entry["signature"] = signature
+        if path is None:
+            workflow_log.error("无法找到工作流文件 %s，已尝试路径: %s", name, " 和 ".join(entry["paths"]))
+            return
         try:
-            with open(workflow_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print(f"错误：无法找到workflows.json文件，已尝试路径: json/workflows.json 和 {workflow_path}")
-            raise
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("文件内容不是JSON对象")
+        except Exception as e:
+            # 文件可能正在被写入，等下次变化后再读取
+            workflow_log.error("读取工作流文件失败，继续使用已加载的模板: %s, %s", path, e)
+            return
+        reloaded = entry["path"] is not None
+        entry["data"] = data
+        entry["path"] = path
+        if reloaded:
+            workflow_log.info("工作流文件已更新，重新加载模板 %s: %s", name, path)
+        else:
+            workflow_log.debug("已加载工作流模板 %s: %s", name, path)
+    
+    # 返回当前的模板，模板只读，需要修改时按补丁计划生成副本
+    def get(self, name):
+        entry = self._entries.get(name)
+        if entry is None:
+            return {}
+        checked = entry["checked"]
+        if checked is None or time.monotonic() - checked >= self.check_interval:
+            with self._lock:
+                checked = entry["checked"]
+                if checked is None or time.monotonic() - checked >= self.check_interval:
+                    try:
+                        self._refresh(name, entry)
+                    finally:
+                        entry["checked"] = time.monotonic()
+        return entry["data"]
 
-# 读取图生图工作流文件
-def load_img2img_workflow():
-    # 首先尝试当前目录的workflows文件夹
-    try:
-        with open("workflows/img_to_img.json", "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        import sys
-        import os
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "workflows", "img_to_img.json")
+# JSON文件的后台持久化：调用方只登记最新的数据，不在请求路径上写文件。
+# 同一文件在debounce秒内的多次保存合并为一次写入，写入先到临时文件再替换，
+# 并发点击或进程中断时不会留下写了一半的JSON
+class JsonFilePersister:
+    def __init__(self, debounce=1.0):
+        self.debounce = debounce
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._thread = None
+    
+    # 登记要保存的数据，同一路径只保留最后一次的数据
+    # 登记的数据按写时复制生成，登记后不会再被修改，后台线程可以直接序列化
+    def schedule(self, path, data):
+        with self._cond:
+            self._pending[path] = (data, time.monotonic() + self.debounce)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="json-persister", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    due = [path for path, (data, deadline) in self._pending.items() if deadline <= now]
+                    if due:
+                        break
+                    if self._pending:
+                        self._cond.wait(min(deadline for data, deadline in self._pending.values()) - now)
+                    else:
+                        self._cond.wait()
+                items = [(path, self._pending.pop(path)[0]) for path in due]
+            for path, data in items:
+                self.write(path, data)
+    
+    # 立即写入所有未保存的数据，程序退出前调用
+    def flush(self):
+        with self._cond:
+            items = [(path, data) for path, (data, deadline) in self._pending.items()]
+            self._pending.clear()
+        for path, data in items:
+            self.write(path, data)
+    
+    @staticmethod
+    def write(path, data):
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
         try:
-            with open(workflow_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print(f"错误：无法找到img_to_img.json文件，已尝试路径: workflows/img_to_img.json 和 {workflow_path}")
-            raise
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, path)
+            workflow_log.debug("已保存文件: %s", path)
+        except Exception as e:
+            workflow_log.warning("保存文件失败: %s, %s", path, e)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
 
-# 读取三视图工作流文件
-def load_random_three_views_workflow():
-    # 首先尝试当前目录的workflows文件夹
-    try:
-        with open("workflows/Random_three_views.json", "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        import sys
-        import os
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "workflows", "Random_three_views.json")
-        try:
-            with open(workflow_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print(f"错误：无法找到Random_three_views.json文件，已尝试路径: workflows/Random_three_views.json 和 {workflow_path}")
-            raise
+json_persister = JsonFilePersister()
+atexit.register(json_persister.flush)
 
-# 读取放大及面部修复工作流文件
-def load_magnified_facial_restoration_workflow():
-    # 首先尝试当前目录的workflows文件夹
-    try:
-        with open("workflows/Magnified_facial_restoration.json", "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        import sys
-        import os
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "workflows", "Magnified_facial_restoration.json")
-        try:
-            with open(workflow_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print(f"错误：无法找到Magnified_facial_restoration.json文件，已尝试路径: workflows/Magnified_facial_restoration.json 和 {workflow_path}")
-            raise
+# 全局共享的工作流模板
+workflow_templates = WorkflowTemplateRegistry()
+workflow_templates.register("txt2img", os.path.join("json", "workflows.json"))
+workflow_templates.register("img2img", os.path.join("workflows", "img_to_img.json"))
+workflow_templates.register("three_views", os.path.join("workflows", "Random_three_views.json"))
+workflow_templates.register("magnify", os.path.join("workflows", "Magnified_facial_restoration.json"))
+workflow_templates.register("facial_restoration", os.path.join("workflows", "Facial_restoration.json"))
 
-# 保存workflows.json文件
-def save_workflow_json(workflow_data):
-    # 首先尝试当前目录的json文件夹
-    try:
-        with open("json/workflows.json", "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        import sys
-        import os
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "json", "workflows.json")
-        os.makedirs(os.path.dirname(workflow_path), exist_ok=True)
-        with open(workflow_path, "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
-
-# 保存图生图工作流文件
-def save_img2img_workflow_json(workflow_data):
-    # 首先尝试当前目录的workflows文件夹
-    try:
-        os.makedirs("workflows", exist_ok=True)
-        with open("workflows/img_to_img.json", "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "workflows", "img_to_img.json")
-        os.makedirs(os.path.dirname(workflow_path), exist_ok=True)
-        with open(workflow_path, "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
-
-# 保存三视图工作流文件
-def save_random_three_views_workflow_json(workflow_data):
-    # 首先尝试当前目录的workflows文件夹
-    try:
-        os.makedirs("workflows", exist_ok=True)
-        with open("workflows/Random_three_views.json", "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "workflows", "Random_three_views.json")
-        os.makedirs(os.path.dirname(workflow_path), exist_ok=True)
-        with open(workflow_path, "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
-
-# 保存放大及面部修复工作流文件
-def save_magnified_facial_restoration_workflow_json(workflow_data):
-    # 首先尝试当前目录的workflows文件夹
-    try:
-        os.makedirs("workflows", exist_ok=True)
-        with open("workflows/Magnified_facial_restoration.json", "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "workflows", "Magnified_facial_restoration.json")
-        os.makedirs(os.path.dirname(workflow_path), exist_ok=True)
-        with open(workflow_path, "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
+# 工作流参数映射中的一条目标：按class_type匹配节点，写入inputs中的input_key
+# title用于区分同类节点（匹配_meta.title），node只在标题也无法区分时指定节点ID；
+# optional的参数值为空时不写入，convert在写入前转换参数值
+def node_input(class_type, input_key, title=None, node=None, optional=False, convert=None):
+    return {
+        "class_type": class_type,
+        "input": input_key,
+        "title": title,
+        "node": node,
+        "optional": optional,
+        "convert": convert,
+    }
 
-# 加载工作流
-workflow = load_workflow()
+# 只保留文件名，ComfyUI会在input目录下查找
+def workflow_file_name(value):
+    if isinstance(value, str):
+        return os.path.basename(value)
+    return value
 
-# 加载图生图工作流
-try:
-    img2img_workflow = load_img2img_workflow()
-except Exception as e:
-    logging.error(f"加载图生图工作流失败: {e}")
-    img2img_workflow = {}  # 使用空字典作为默认值
+LORA_STACK_CLASS = "Lora Loader Stack (rgthree)"
 
-# 加载三视图工作流
-try:
-    random_three_views_workflow = load_random_three_views_workflow()
-except Exception as e:
-    logging.error(f"加载三视图工作流失败: {e}")
-    random_three_views_workflow = {}  # 使用空字典作为默认值
+# Flux模型加载节点的参数映射，各工作流共用
+def flux_model_param_map():
+    return {
+        "unet_name": [node_input("UNETLoader", "unet_name")],
+        "clip_name1": [node_input("DualCLIPLoader", "clip_name1")],
+        "clip_name2": [node_input("DualCLIPLoader", "clip_name2")],
+        "vae_name": [node_input("VAELoader", "vae_name")],
+    }
 
-# 加载放大及面部修复工作流
-try:
-    magnified_facial_restoration_workflow = load_magnified_facial_restoration_workflow()
-except Exception as e:
-    logging.error(f"加载放大及面部修复工作流失败: {e}")
-    magnified_facial_restoration_workflow = {}  # 使用空字典作为默认值
+# LoRA堆节点的参数映射
+def lora_stack_param_map():
+    param_map = {}
+    for index in range(1, 5):
+        param_map[f"lora_0{index}"] = [node_input(LORA_STACK_CLASS, f"lora_0{index}")]
+        param_map[f"strength_0{index}"] = [node_input(LORA_STACK_CLASS, f"strength_0{index}")]
+    return param_map
 
-# 读取面部修复工作流文件
-def load_facial_restoration_workflow():
-    # 首先尝试当前目录的workflows文件夹
-    try:
-        with open("workflows/Facial_restoration.json", "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        import sys
-        import os
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "workflows", "Facial_restoration.json")
+# 面部细化(FaceDetailerPipe)节点中可由界面调节的参数
+FACE_DETAILER_PARAMS = [
+    "guide_size", "guide_size_for", "max_size", "seed", "steps", "cfg",
+    "sampler_name", "scheduler", "denoise", "feather", "noise_mask",
+    "force_inpaint", "bbox_threshold", "bbox_dilation", "bbox_crop_factor",
+    "sam_detection_hint", "sam_dilation", "sam_threshold", "sam_bbox_expansion",
+    "sam_mask_hint_threshold", "sam_mask_hint_use_negative", "drop_size",
+    "refiner_ratio", "cycle", "inpaint_model", "noise_mask_feather",
+    "tiled_encode", "tiled_decode",
+]
+
+# SD放大(UltimateSDUpscale)节点中可由界面调节的参数
+SD_UPSCALE_PARAMS = [
+    "upscale_by", "seed", "steps", "cfg", "sampler_name", "scheduler", "denoise",
+    "tile_width", "tile_height", "mask_blur", "tile_padding", "seam_fix_mode",
+    "seam_fix_denoise", "seam_fix_width", "seam_fix_mask_blur", "seam_fix_padding",
+    "force_uniform_tiles", "tiled_decode",
+]
+
+# 各工作流的界面参数到节点输入的声明式映射：参数名 -> [目标节点输入, ...]
+# 新增工作流只需在这里添加映射，节点ID在加载工作流时按class_type和标题解析
+WORKFLOW_PARAM_MAPS = {
+    "txt2img": {
+        "width": [node_input("EmptyLatentImage", "width"), node_input("EmptySD3LatentImage", "width")],
+        "height": [node_input("EmptyLatentImage", "height"), node_input("EmptySD3LatentImage", "height")],
+        "image_name": [node_input("Simple String", "string")],
+        "sampler_name": [node_input("KSamplerSelect", "sampler_name")],
+        "scheduler": [node_input("BasicScheduler", "scheduler")],
+        "steps": [node_input("BasicScheduler", "steps")],
+        "denoise": [node_input("BasicScheduler", "denoise")],
+        "noise_seed": [node_input("RandomNoise", "noise_seed")],
+        "guidance": [node_input("CLIPTextEncodeFlux", "guidance"), node_input("FluxGuidance", "guidance")],
+        **flux_model_param_map(),
+        **lora_stack_param_map(),
+        "face_prompt": [node_input("ChinesePrompt_Mix", "text", title="面部及摄影设备", node="33")],
+        "clothes_prompt": [node_input("ChinesePrompt_Mix", "text", title="衣着及动作", node="36")],
+        "environment_prompt": [node_input("ChinesePrompt_Mix", "text", title="环境", node="37")],
+        "input_image": [node_input("LoadImage", "image", optional=True)],
+    },
+    "img2img": {
+        "width": [node_input("EmptyLatentImage", "width")],
+        "height": [node_input("EmptyLatentImage", "height")],
+        # 图生图工作流里名称和重绘幅度都用简易字符串节点，只能按节点ID区分
+        "image_name": [node_input("Simple String", "string", node="303")],
+        "redraw_strength": [node_input("Simple String", "string", node="94", convert=str)],
+        "sampler_name": [node_input("KSamplerSelect", "sampler_name")],
+        "scheduler": [node_input("BasicScheduler", "scheduler")],
+        "steps": [node_input("BasicScheduler", "steps")],
+        "noise_seed": [node_input("RandomNoise", "noise_seed")],
+        "guidance": [node_input("FluxGuidance", "guidance")],
+        **flux_model_param_map(),
+        **lora_stack_param_map(),
+        # 图生图工作流中151/152节点的标题与界面字段相反，沿用界面读取时的节点对应关系
+        "face_prompt": [node_input("ChinesePrompt_Mix", "text", title="面部及摄影设备", node="150")],
+        "clothes_prompt": [node_input("ChinesePrompt_Mix", "text", node="151")],
+        "environment_prompt": [node_input("ChinesePrompt_Mix", "text", node="152")],
+        "input_image": [node_input("LoadImage", "image", optional=True)],
+    },
+    "three_views": {
+        "image_name": [node_input("Simple String", "string")],
+        "pose_image": [node_input("LoadImage", "image", optional=True)],
+        "prompt": [node_input("CLIPTextEncode", "text", node="18")],
+        "controlnet_name": [node_input("ControlNetLoader", "control_net_name")],
+        "width": [
+            node_input("ImageScale", "width"),
+            node_input("EmptySD3LatentImage", "width"),
+            node_input("ModelSamplingFlux", "width"),
+        ],
+        "height": [
+            node_input("ImageScale", "height"),
+            node_input("EmptySD3LatentImage", "height"),
+            node_input("ModelSamplingFlux", "height"),
+        ],
+        "sampler_name": [node_input("KSamplerSelect", "sampler_name")],
+        "scheduler": [node_input("BasicScheduler", "scheduler")],
+        "steps": [node_input("BasicScheduler", "steps")],
+        "denoise": [node_input("BasicScheduler", "denoise")],
+        "noise_seed": [node_input("RandomNoise", "noise_seed")],
+        "guidance": [node_input("FluxGuidance", "guidance")],
+        **flux_model_param_map(),
+        **lora_stack_param_map(),
+    },
+    "magnify": {
+        "image_name": [node_input("Simple String", "string")],
+        "input_image": [node_input("LoadImage", "image", optional=True, convert=workflow_file_name)],
+        "positive_prompt": [node_input("CLIPTextEncode", "text", node="157")],
+        "negative_prompt": [node_input("CLIPTextEncode", "text", node="364")],
+        **{key: [node_input("UltimateSDUpscale", key)] for key in SD_UPSCALE_PARAMS},
+        "upscale_model": [node_input("UpscaleModelLoader", "model_name")],
+        **flux_model_param_map(),
+    },
+    "facial_restoration": {
+        "image_name": [node_input("Simple String", "string")],
+        "input_image": [node_input("LoadImage", "image", optional=True, convert=workflow_file_name)],
+        "positive_prompt": [node_input("CLIPTextEncode", "text", node="157")],
+        "negative_prompt": [node_input("CLIPTextEncode", "text", node="364")],
+        "bbox_model": [node_input("UltralyticsDetectorProvider", "model_name")],
+        **{key: [node_input("FaceDetailerPipe", key)] for key in FACE_DETAILER_PARAMS},
+        **flux_model_param_map(),
+    },
+}
+
+# 没有对应映射的工作流只替换输入图像
+LOAD_IMAGE_PARAM_MAP = {
+    "input_image": [node_input("LoadImage", "image", optional=True)],
+}
+
+# 按选择器在工作流中查找节点ID：先按class_type过滤，再按标题或节点ID区分同类节点
+def match_workflow_nodes(workflow_data, target):
+    candidates = [
+        node_id for node_id, node_data in workflow_data.items()
+        if isinstance(node_data, dict) and node_data.get("class_type") == target["class_type"]
+    ]
+    if target["title"]:
+        titled = [
+            node_id for node_id in candidates
+            if workflow_data[node_id].get("_meta", {}).get("title") == target["title"]
+        ]
+        if titled:
+            return titled
+    if target["node"]:
+        return [target["node"]] if target["node"] in candidates else []
+    if target["title"]:
+        return []
+    return candidates
+
+# 工作流参数补丁计划：加载工作流时把参数映射解析成(节点ID, 输入字段)，
+# 每次请求只按计划写入参数，并且只复制被修改的节点（写时复制），其余节点与模板共享
+class WorkflowPatchPlan:
+    def __init__(self, workflow_data, param_map):
+        self.targets = {}
+        self.missing = []
+        for param, node_inputs in param_map.items():
+            targets = []
+            for target in node_inputs:
+                for node_id in match_workflow_nodes(workflow_data, target):
+                    targets.append((node_id, target))
+            if targets:
+                self.targets[param] = targets
+            else:
+                self.missing.append(param)
+    
+    # 参数对应的节点ID列表
+    def nodes_for(self, param):
+        return [node_id for node_id, target in self.targets.get(param, [])]
+    
+    # 按计划读取defaults中各参数在工作流里的当前值：取第一个有该输入的目标节点，
+    # 输入连接到其他节点(列表)时跳过；读不到的参数保留默认值，返回新字典
+    def read(self, workflow_data, defaults):
+        params = dict(defaults)
+        for param in defaults:
+            for node_id, target in self.targets.get(param, []):
+                inputs = (workflow_data.get(node_id) or {}).get("inputs") or {}
+                value = inputs.get(target["input"])
+                if target["input"] in inputs and not isinstance(value, list):
+                    params[param] = value
+                    break
+        return params
+    
+    # 返回写入参数后的新工作流，不修改传入的工作流
+    def apply(self, workflow_data, params):
+        patched = dict(workflow_data)
+        copied = set()
+        for param, targets in self.targets.items():
+            if param not in params:
+                continue
+            value = params[param]
+            for node_id, target in targets:
+                if target["optional"] and not value:
+                    continue
+                if node_id not in patched:
+                    continue
+                if node_id not in copied:
+                    node_data = dict(patched[node_id])
+                    node_data["inputs"] = dict(node_data.get("inputs") or {})
+                    patched[node_id] = node_data
+                    copied.add(node_id)
+                patched[node_id]["inputs"][target["input"]] = target["convert"](value) if target["convert"] else value
+        return patched
+
+# 按名称取得当前的工作流模板，文件有变化时会重新加载
+def get_workflow_template(name):
+    return workflow_templates.get(name)
+
+# 编译好的补丁计划，模板对象被替换（重新加载）后重新编译
+workflow_patch_plans = {}
+workflow_patch_plans_lock = threading.Lock()
+
+def get_workflow_patch_plan(name):
+    template = get_workflow_template(name)
+    with workflow_patch_plans_lock:
+        cached = workflow_patch_plans.get(name)
+        if cached is not None and cached[0] is template:
+            return cached[1]
+    
+    plan = WorkflowPatchPlan(template, WORKFLOW_PARAM_MAPS[name])
+    if template and plan.missing:
+        workflow_log.debug("工作流 %s 中没有找到参数对应的节点: %s", name, ", ".join(plan.missing))
+    with workflow_patch_plans_lock:
+        workflow_patch_plans[name] = (template, plan)
+    return plan
+
+# 按补丁计划读取工作流模板中的界面参数，与保存参数使用同一份映射；模板为空时返回默认参数
+def read_workflow_params(name, defaults):
+    template = get_workflow_template(name)
+    if not template:
+        return dict(defaults)
+    return get_workflow_patch_plan(name).read(template, defaults)
+
+# 把输入图像文件名写入工作流的图像加载节点，返回(新工作流, 写入的节点ID列表)
+def apply_workflow_input_image(workflow_data, filename, name=None):
+    if name in WORKFLOW_PARAM_MAPS and "input_image" in WORKFLOW_PARAM_MAPS[name]:
+        plan = get_workflow_patch_plan(name)
+        # 传入的工作流与模板节点不一致时（例如旧版本保存的工作流），按当前工作流解析
+        if any(node_id not in workflow_data for node_id in plan.nodes_for("input_image")):
+            plan = WorkflowPatchPlan(workflow_data, LOAD_IMAGE_PARAM_MAP)
+    else:
+        plan = WorkflowPatchPlan(workflow_data, LOAD_IMAGE_PARAM_MAP)
+    return plan.apply(workflow_data, {"input_image": filename}), plan.nodes_for("input_image")
+
+# 按用户保存的界面参数：每个用户（get_param_owner：登录名，未启用登录时所有浏览器共用一份）在每个界面
+# 最近一次使用的参数和命名预设。加载的工作流模板只读，生成时按补丁计划把参数写入模板的副本，
+# 多个用户同时生成互不覆盖，也不再争用同一个工作流文件
+class UserParamStore:
+    def __init__(self, path="json/user_params.json", max_users=500):
+        self.path = path
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._users = {}
         try:
-            with open(workflow_path, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(path, "r", encoding="utf-8") as f:
+                self._users = json.load(f).get("users", {})
         except FileNotFoundError:
-            print(f"错误：无法找到Facial_restoration.json文件，已尝试路径: workflows/Facial_restoration.json 和 {workflow_path}")
-            raise
+            pass
+        except Exception as e:
+            workflow_log.warning("读取用户参数失败: %s, %s", path, e)
+    
+    # 只保存可以写入JSON的简单参数值
+    @staticmethod
+    def _clean(params):
+        return {key: value for key, value in params.items() if value is None or isinstance(value, (str, int, float, bool))}
+    
+    # 写时复制更新一个用户的记录，登记给后台持久化的数据不会再被修改
+    def _update(self, user, update):
+        with self._lock:
+            users = dict(self._users)
+            record = users.pop(user, {})
+            users[user] = update(record)
+            # 只保留最近活跃的用户：没有保存预设的旧用户记录优先删除，仍然超出时再删除最久未使用的记录
+            if len(users) > self.max_users:
+                others = [name for name in users if name != user]
+                for stale in [name for name in others if not users[name].get("presets")][:len(users) - self.max_users]:
+                    del users[stale]
+                for stale in [name for name in others if name in users][:len(users) - self.max_users]:
+                    del users[stale]
+            self._users = users
+            json_persister.schedule(self.path, {"users": users})
+    
+    def get_last(self, user, tab):
+        return self._users.get(user, {}).get("last", {}).get(tab)
+    
+    def remember(self, user, tab, params):
+        params = self._clean(params)
+        self._update(user, lambda record: {**record, "last": {**record.get("last", {}), tab: params}})
+    
+    def list_presets(self, user, tab):
+        return sorted(self._users.get(user, {}).get("presets", {}).get(tab, {}))
+    
+    def get_preset(self, user, tab, name):
+        return self._users.get(user, {}).get("presets", {}).get(tab, {}).get(name)
+    
+    def save_preset(self, user, tab, name, params):
+        params = self._clean(params)
+        def update(record):
+            presets = record.get("presets", {})
+            return {**record, "presets": {**presets, tab: {**presets.get(tab, {}), name: params}}}
+        self._update(user, update)
+    
+    def delete_preset(self, user, tab, name):
+        def update(record):
+            presets = record.get("presets", {})
+            tab_presets = {key: value for key, value in presets.get(tab, {}).items() if key != name}
+            return {**record, "presets": {**presets, tab: tab_presets}}
+        self._update(user, update)
 
-# 保存面部修复工作流文件
-def save_facial_restoration_workflow_json(workflow_data):
-    # 首先尝试当前目录的workflows文件夹
-    try:
-        os.makedirs("workflows", exist_ok=True)
-        with open("workflows/Facial_restoration.json", "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "workflows", "Facial_restoration.json")
-        os.makedirs(os.path.dirname(workflow_path), exist_ok=True)
-        with open(workflow_path, "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
+# 全局共享的用户参数记录
+user_params = UserParamStore()
 
-# 加载面部修复工作流
-try:
-    facial_restoration_workflow = load_facial_restoration_workflow()
-except Exception as e:
-    logging.error(f"加载面部修复工作流失败: {e}")
-    facial_restoration_workflow = {}  # 使用空字典作为默认值
+# 为界面添加参数预设控件，并在页面加载时恢复该用户在该界面最近一次使用的参数
+# fields为[(参数名, 组件)]，需要在gr.Blocks中调用
+def add_param_preset_controls(demo, tab, fields):
+    keys = [key for key, component in fields]
+    components = [component for key, component in fields]
+    
+    with gr.Accordion("参数预设", open=False):
+        with gr.Row():
+            preset_list = gr.Dropdown(choices=[], label="已保存的预设")
+            preset_name = gr.Textbox(label="预设名称", placeholder="输入名称后保存当前参数")
+        with gr.Row():
+            load_preset_btn = gr.Button("载入预设")
+            save_preset_btn = gr.Button("保存为预设")
+            delete_preset_btn = gr.Button("删除预设")
+        preset_status = gr.Textbox(label="预设状态", interactive=False)
+    
+    def values_for(params):
+        return [params[key] if key in params else gr.update() for key in keys]
+    
+    def restore_last_params(request: gr.Request):
+        user = get_param_owner(request)
+        params = user_params.get_last(user, tab) or {}
+        return values_for(params) + [gr.update(choices=user_params.list_presets(user, tab), value=None)]
+    
+    def load_preset(request: gr.Request, name):
+        params = user_params.get_preset(get_param_owner(request), tab, name) if name else None
+        if params is None:
+            return values_for({}) + ["请先选择要载入的预设"]
+        return values_for(params) + [f"已载入预设: {name}"]
+    
+    def save_preset(request: gr.Request, name, *values):
+        name = (name or "").strip()
+        if not name:
+            return gr.update(), "请输入预设名称"
+        user = get_param_owner(request)
+        user_params.save_preset(user, tab, name, dict(zip(keys, values)))
+        return gr.update(choices=user_params.list_presets(user, tab), value=name), f"已保存预设: {name}"
+    
+    def delete_preset(request: gr.Request, name):
+        if not name:
+            return gr.update(), "请先选择要删除的预设"
+        user = get_param_owner(request)
+        user_params.delete_preset(user, tab, name)
+        return gr.update(choices=user_params.list_presets(user, tab), value=None), f"已删除预设: {name}"
+    
+    load_preset_btn.click(fn=load_preset, inputs=[preset_list], outputs=components + [preset_status])
+    save_preset_btn.click(fn=save_preset, inputs=[preset_name] + components, outputs=[preset_list, preset_status])
+    delete_preset_btn.click(fn=delete_preset, inputs=[preset_list], outputs=[preset_list, preset_status])
+    demo.load(fn=restore_last_params, inputs=None, outputs=components + [preset_list])
+
+# 在界面末尾添加生成记录搜索：按提示词在生成记录索引中全文搜索，显示仍然存在的输出图像
+def add_generation_search():
+    with gr.Accordion("生成记录搜索", open=False):
+        with gr.Row():
+            search_query = gr.Textbox(label="提示词", placeholder="输入提示词中的词语，多个词之间用空格分隔", scale=4)
+            search_btn = gr.Button("搜索", scale=1)
+        search_gallery = gr.Gallery(label="搜索结果", columns=6, height="auto")
+        search_status = gr.Textbox(label="搜索状态", interactive=False)
+    
+    async def search_generations(query):
+        query = (query or "").strip()
+        if not query:
+            return [], "请输入要搜索的提示词"
+        jobs = await asyncio.to_thread(generation_index.search, query)
+        images = []
+        for job in jobs:
+            caption = f"{job['tab']} | 种子 {job['seed']}"
+            images.extend((path, caption) for path in job["outputs"] if os.path.exists(path))
+        return images, f"找到 {len(jobs)} 条生成记录，{len(images)} 张图像"
+    
+    search_btn.click(fn=search_generations, inputs=[search_query], outputs=[search_gallery, search_status])
+    search_query.submit(fn=search_generations, inputs=[search_query], outputs=[search_gallery, search_status])
 
 # 获取模型文件列表的通用函数
 def get_models_from_folder(folder_path, extensions=None, normalize=True):
@@ -367,102 +810,58 @@ def get_models_list():
     
     return models
 
-# 提取可调节参数
+# 提取可调节参数：按文生图的补丁计划读取模板中的当前值
 def extract_adjustable_params():
-    params = {}
-    
-    # 提取图像尺寸参数
-    if "1" in workflow and "inputs" in workflow["1"]:
-        params["width"] = workflow["1"]["inputs"].get("width", 512)
-        params["height"] = workflow["1"]["inputs"].get("height", 512)
-    
-    # 提取采样器参数
-    if "8" in workflow and "inputs" in workflow["8"]:
-        params["sampler_name"] = workflow["8"]["inputs"].get("sampler_name", "euler")
-    
-    # 提取调度器参数
-    if "9" in workflow and "inputs" in workflow["9"]:
-        params["scheduler"] = workflow["9"]["inputs"].get("scheduler", "simple")
-        params["steps"] = workflow["9"]["inputs"].get("steps", 20)
-        params["denoise"] = workflow["9"]["inputs"].get("denoise", 1)
-    
-    # 提取随机噪声种子
-    if "11" in workflow and "inputs" in workflow["11"]:
-        params["noise_seed"] = workflow["11"]["inputs"].get("noise_seed", 0)
-    
-    # 提取引导参数
-    if "14" in workflow and "inputs" in workflow["14"]:
-        params["guidance"] = workflow["14"]["inputs"].get("guidance", 3.5)
-    
-    # 提取303节点参数（图片命名）
-    if "303" in workflow and "inputs" in workflow["303"]:
-        params["image_name"] = workflow["303"]["inputs"].get("text", "")
-    else:
-        params["image_name"] = ""
-    
-    # 提取模型参数 - 设置默认值为截图中的模型
-    if "6" in workflow and "inputs" in workflow["6"]:
-        params["unet_name"] = workflow["6"]["inputs"].get("unet_name", "FLUX/flux-dev.safetensors")
-    else:
-        params["unet_name"] = "FLUX/flux-dev.safetensors"
-    
-    if "5" in workflow and "inputs" in workflow["5"]:
-        params["clip_name1"] = workflow["5"]["inputs"].get("clip_name1", "flux/t5xxl_fp16.safetensors")
-        params["clip_name2"] = workflow["5"]["inputs"].get("clip_name2", "flux/clip_l.safetensors")
-    else:
-        params["clip_name1"] = "flux/t5xxl_fp16.safetensors"
-        params["clip_name2"] = "flux/clip_l.safetensors"
-    
-    if "4" in workflow and "inputs" in workflow["4"]:
-        params["vae_name"] = workflow["4"]["inputs"].get("vae_name", "flux/ae.safetensors")
-    else:
-        params["vae_name"] = "flux/ae.safetensors"
-    
-    # 提取LoRA参数
-    if "12" in workflow and "inputs" in workflow["12"]:
-        params["lora_01"] = workflow["12"]["inputs"].get("lora_01", "None")
-        params["strength_01"] = workflow["12"]["inputs"].get("strength_01", 0.8)
-        params["lora_02"] = workflow["12"]["inputs"].get("lora_02", "None")
-        params["strength_02"] = workflow["12"]["inputs"].get("strength_02", 0.8)
-        params["lora_03"] = workflow["12"]["inputs"].get("lora_03", "None")
-        params["strength_03"] = workflow["12"]["inputs"].get("strength_03", 1)
-        params["lora_04"] = workflow["12"]["inputs"].get("lora_04", "None")
-        params["strength_04"] = workflow["12"]["inputs"].get("strength_04", 1)
-    
-    # 提取文本提示词
-    if "33" in workflow and "inputs" in workflow["33"]:
-        params["face_prompt"] = workflow["33"]["inputs"].get("text", "")
-    
-    if "36" in workflow and "inputs" in workflow["36"]:
-        params["clothes_prompt"] = workflow["36"]["inputs"].get("text", "")
-    
-    if "37" in workflow and "inputs" in workflow["37"]:
-        params["environment_prompt"] = workflow["37"]["inputs"].get("text", "")
-    
-    return params
+    return read_workflow_params("txt2img", {
+        "width": 512,
+        "height": 512,
+        "sampler_name": "euler",
+        "scheduler": "simple",
+        "steps": 20,
+        "denoise": 1,
+        "noise_seed": 0,
+        "guidance": 3.5,
+        "image_name": "",
+        "unet_name": "FLUX/flux-dev.safetensors",
+        "clip_name1": "flux/t5xxl_fp16.safetensors",
+        "clip_name2": "flux/clip_l.safetensors",
+        "vae_name": "flux/ae.safetensors",
+        "lora_01": "None",
+        "strength_01": 0.8,
+        "lora_02": "None",
+        "strength_02": 0.8,
+        "lora_03": "None",
+        "strength_03": 1,
+        "lora_04": "None",
+        "strength_04": 1,
+        "face_prompt": "",
+        "clothes_prompt": "",
+        "environment_prompt": "",
+    })
 
 # 获取ComfyUI的input文件夹中所有图片
 def get_input_folder_images():
     comfyui_input_path = os.path.join(WSL_COMFYUI_PATH, "input")
-    os.makedirs(comfyui_input_path, exist_ok=True)
     
     image_files = []
     valid_extensions = ['.png', '.jpg', '.jpeg', '.webp', '.bmp']
     
     try:
-        for file in os.listdir(comfyui_input_path):
-            file_path = os.path.join(comfyui_input_path, file)
-            if os.path.isfile(file_path) and any(file.lower().endswith(ext) for ext in valid_extensions):
-                # 只添加文件名，不添加完整路径
-                image_files.append(file)
+        # ComfyUI不在本机时input文件夹可能无法访问，此时列表为空
+        os.makedirs(comfyui_input_path, exist_ok=True)
+        # scandir在列目录时一并取得文件信息，不需要对每个文件单独stat
+        with os.scandir(comfyui_input_path) as entries:
+            for entry in entries:
+                if entry.is_file() and any(entry.name.lower().endswith(ext) for ext in valid_extensions):
+                    image_files.append((entry.stat().st_mtime, entry.name))
     except Exception as e:
         print(f"读取图片文件夹时出错: {e}")
     
     # 使用修改时间排序，最新的在前面
-    image_files.sort(key=lambda x: os.path.getmtime(os.path.join(comfyui_input_path, x)), reverse=True)
+    image_files.sort(reverse=True)
     
-    # 只返回文件名列表
-    return image_files
+    # 只返回文件名列表，不包含完整路径
+    return [name for mtime, name in image_files]
 
 # 当选择下拉菜单中的图片时调用
 def select_existing_image(file_path):
@@ -479,533 +878,413 @@ def select_existing_image(file_path):
     
     return file_path, f"已选择图片: {file_path}", dimension_text
 
-# 提取图生图可调节参数
+# 提取图生图可调节参数：按图生图的补丁计划读取模板中的当前值
 def extract_img2img_params():
-    params = {}
-    
-    # 如果工作流为空，返回默认参数
-    if not img2img_workflow:
-        return {
-            "width": 512,
-            "height": 512,
-            "sampler_name": "euler",
-            "scheduler": "simple",
-            "steps": 20,
-            # 移除去噪强度参数，已由重绘幅度取代
-            "guidance": 3.5,
-            "noise_seed": 0,
-            "lora_01": "None",
-            "strength_01": 0.8,
-            "lora_02": "None",
-            "strength_02": 0.8,
-            "lora_03": "None",
-            "strength_03": 1,
-            "lora_04": "None",
-            "strength_04": 1,
-            "face_prompt": "",
-            "clothes_prompt": "",
-            "environment_prompt": "",
-            "unet_name": "FLUX/flux-dev.safetensors",
-            "clip_name1": "flux/t5xxl_fp16.safetensors",
-            "clip_name2": "flux/clip_l.safetensors",
-            "vae_name": "flux/ae.safetensors",
-            "redraw_strength": 0.75,  # 图生图重绘幅度参数，代替去噪强度
-            "image_name": ""  # 添加图片命名参数
-        }
-    
-    # 提取303节点参数（图片命名）
-    if "303" in img2img_workflow and "inputs" in img2img_workflow["303"]:
-        params["image_name"] = img2img_workflow["303"]["inputs"].get("text", "")
-    else:
-        params["image_name"] = ""
-    
-    # 提取图像尺寸参数
-    if "1" in img2img_workflow and "inputs" in img2img_workflow["1"]:
-        params["width"] = img2img_workflow["1"]["inputs"].get("width", 512)
-        params["height"] = img2img_workflow["1"]["inputs"].get("height", 512)
-    
-    # 提取采样器参数 - 修改为节点77
-    if "77" in img2img_workflow and "inputs" in img2img_workflow["77"]:
-        params["sampler_name"] = img2img_workflow["77"]["inputs"].get("sampler_name", "euler")
-    else:
-        params["sampler_name"] = "euler"  # 设置默认值
-    
-    # 提取调度器参数 - 修改为节点78，移除去噪强度
-    if "78" in img2img_workflow and "inputs" in img2img_workflow["78"]:
-        params["scheduler"] = img2img_workflow["78"]["inputs"].get("scheduler", "simple")
-        params["steps"] = img2img_workflow["78"]["inputs"].get("steps", 20)
-        # 移除去噪强度提取
-    else:
-        params["scheduler"] = "simple"  # 设置默认值
-        params["steps"] = 20  # 设置默认值
-    
-    # 提取图生图重绘幅度参数
-    if "94" in img2img_workflow and "inputs" in img2img_workflow["94"]:
-        # 从string字段提取数值
-        redraw_strength_str = img2img_workflow["94"]["inputs"].get("string", "0.75")
-        try:
-            params["redraw_strength"] = float(redraw_strength_str)
-        except ValueError:
-            params["redraw_strength"] = 0.75  # 如果无法解析，使用默认值
-    else:
-        params["redraw_strength"] = 0.75  # 默认值
-    
-    # 提取随机噪声种子 - 固定从节点79提取
-    if "79" in img2img_workflow and "inputs" in img2img_workflow["79"]:
-        params["noise_seed"] = img2img_workflow["79"]["inputs"].get("noise_seed", 0)
-        print(f"从图生图工作流79号节点读取随机种子: {params['noise_seed']}")
-    else:
-        params["noise_seed"] = 0  # 设置默认值
-    
-    # 提取引导参数 - 修改为节点80
-    if "80" in img2img_workflow and "inputs" in img2img_workflow["80"]:
-        params["guidance"] = img2img_workflow["80"]["inputs"].get("guidance", 3.5)
-    else:
-        params["guidance"] = 3.5  # 设置默认值
-    
-    # 提取模型参数
-    if "87" in img2img_workflow and "inputs" in img2img_workflow["87"]:  # 使用正确的节点ID
-        params["unet_name"] = img2img_workflow["87"]["inputs"].get("unet_name", "FLUX/flux-dev.safetensors")
-    else:
-        params["unet_name"] = "FLUX/flux-dev.safetensors"  # 设置默认值
-    
-    if "75" in img2img_workflow and "inputs" in img2img_workflow["75"]:  # 使用正确的节点ID
-        params["clip_name1"] = img2img_workflow["75"]["inputs"].get("clip_name1", "flux/t5xxl_fp16.safetensors")
-        params["clip_name2"] = img2img_workflow["75"]["inputs"].get("clip_name2", "flux/clip_l.safetensors")
-    else:
-        params["clip_name1"] = "flux/t5xxl_fp16.safetensors"  # 设置默认值
-        params["clip_name2"] = "flux/clip_l.safetensors"  # 设置默认值
-    
-    if "84" in img2img_workflow and "inputs" in img2img_workflow["84"]:  # 使用正确的节点ID
-        params["vae_name"] = img2img_workflow["84"]["inputs"].get("vae_name", "flux/ae.safetensors")
-    else:
-        params["vae_name"] = "flux/ae.safetensors"  # 设置默认值
-    
-    # 提取LoRA参数 - 固定从节点88提取
-    if "88" in img2img_workflow and "inputs" in img2img_workflow["88"]:
-        params["lora_01"] = img2img_workflow["88"]["inputs"].get("lora_01", "None")
-        params["strength_01"] = img2img_workflow["88"]["inputs"].get("strength_01", 0.8)
-        params["lora_02"] = img2img_workflow["88"]["inputs"].get("lora_02", "None")
-        params["strength_02"] = img2img_workflow["88"]["inputs"].get("strength_02", 0.8)
-        params["lora_03"] = img2img_workflow["88"]["inputs"].get("lora_03", "None")
-        params["strength_03"] = img2img_workflow["88"]["inputs"].get("strength_03", 1)
-        params["lora_04"] = img2img_workflow["88"]["inputs"].get("lora_04", "None")
-        params["strength_04"] = img2img_workflow["88"]["inputs"].get("strength_04", 1)
-        print(f"从图生图工作流88号节点读取LoRA参数")
-    else:
-        params["lora_01"] = "None"  # 设置默认值
-        params["strength_01"] = 0.8
-        params["lora_02"] = "None"
-        params["strength_02"] = 0.8
-        params["lora_03"] = "None"
-        params["strength_03"] = 1
-        params["lora_04"] = "None"
-        params["strength_04"] = 1
-    
-    # 直接从图生图工作流中的特定节点提取提示词
-    # 节点150：人物，景别，镜头，服饰
-    if "150" in img2img_workflow and "inputs" in img2img_workflow["150"]:
-        params["face_prompt"] = img2img_workflow["150"]["inputs"].get("text", "")
-    else:
-        params["face_prompt"] = ""
-    
-    # 节点151：场景
-    if "151" in img2img_workflow and "inputs" in img2img_workflow["151"]:
-        params["clothes_prompt"] = img2img_workflow["151"]["inputs"].get("text", "")
-    else:
-        params["clothes_prompt"] = ""
-    
-    # 节点152：动作
-    if "152" in img2img_workflow and "inputs" in img2img_workflow["152"]:
-        params["environment_prompt"] = img2img_workflow["152"]["inputs"].get("text", "")
-    else:
-        params["environment_prompt"] = ""
+    params = read_workflow_params("img2img", {
+        "width": 512,
+        "height": 512,
+        "sampler_name": "euler",
+        "scheduler": "simple",
+        "steps": 20,
+        # 移除去噪强度参数，已由重绘幅度取代
+        "guidance": 3.5,
+        "noise_seed": 0,
+        "lora_01": "None",
+        "strength_01": 0.8,
+        "lora_02": "None",
+        "strength_02": 0.8,
+        "lora_03": "None",
+        "strength_03": 1,
+        "lora_04": "None",
+        "strength_04": 1,
+        "face_prompt": "",
+        "clothes_prompt": "",
+        "environment_prompt": "",
+        "unet_name": "FLUX/flux-dev.safetensors",
+        "clip_name1": "flux/t5xxl_fp16.safetensors",
+        "clip_name2": "flux/clip_l.safetensors",
+        "vae_name": "flux/ae.safetensors",
+        "redraw_strength": 0.75,  # 图生图重绘幅度参数，代替去噪强度
+        "image_name": "",
+    })
     
+    # 重绘幅度保存在简易字符串节点中，转换为数值
+    try:
+        params["redraw_strength"] = float(params["redraw_strength"])
+    except (TypeError, ValueError):
+        params["redraw_strength"] = 0.75  # 如果无法解析，使用默认值
     return params
 
 # 保存调整后的参数
-def save_workflow(params):
-    workflow_copy = copy.deepcopy(workflow)
-    
-    # 更新图像尺寸
-    if "1" in workflow_copy:
-        workflow_copy["1"]["inputs"]["width"] = params["width"]
-        workflow_copy["1"]["inputs"]["height"] = params["height"]
-    
-    # 更新303节点参数（图片命名）
-    if "303" in workflow_copy:
-        if "inputs" not in workflow_copy["303"]:
-            workflow_copy["303"]["inputs"] = {}
-        workflow_copy["303"]["inputs"]["text"] = params["image_name"]
-    
-    # 更新采样器
-    if "8" in workflow_copy:
-        workflow_copy["8"]["inputs"]["sampler_name"] = params["sampler_name"]
-    
-    # 更新调度器
-    if "9" in workflow_copy:
-        workflow_copy["9"]["inputs"]["scheduler"] = params["scheduler"]
-        workflow_copy["9"]["inputs"]["steps"] = params["steps"]
-        workflow_copy["9"]["inputs"]["denoise"] = params["denoise"]
-    
-    # 更新随机噪声种子
-    if "11" in workflow_copy:
-        workflow_copy["11"]["inputs"]["noise_seed"] = params["noise_seed"]
-    # 更新图生图工作流的79号节点随机种子
-    if "79" in workflow_copy and "inputs" in workflow_copy["79"]:
-        workflow_copy["79"]["inputs"]["noise_seed"] = params["noise_seed"]
-        print(f"已将随机种子 {params['noise_seed']} 保存到图生图工作流79号节点")
-    
-    # 更新引导参数
-    if "14" in workflow_copy:
-        workflow_copy["14"]["inputs"]["guidance"] = params["guidance"]
-    
-    # 更新模型参数
-    if "6" in workflow_copy and "unet_name" in params:
-        workflow_copy["6"]["inputs"]["unet_name"] = params["unet_name"]
-    
-    if "5" in workflow_copy:
-        if "clip_name1" in params:
-            workflow_copy["5"]["inputs"]["clip_name1"] = params["clip_name1"]
-        if "clip_name2" in params:
-            workflow_copy["5"]["inputs"]["clip_name2"] = params["clip_name2"]
-    
-    if "4" in workflow_copy and "vae_name" in params:
-        workflow_copy["4"]["inputs"]["vae_name"] = params["vae_name"]
-    
-    # 更新LoRA参数
-    if "12" in workflow_copy:
-        workflow_copy["12"]["inputs"]["lora_01"] = params["lora_01"]
-        workflow_copy["12"]["inputs"]["strength_01"] = params["strength_01"]
-        workflow_copy["12"]["inputs"]["lora_02"] = params["lora_02"]
-        workflow_copy["12"]["inputs"]["strength_02"] = params["strength_02"]
-        workflow_copy["12"]["inputs"]["lora_03"] = params["lora_03"]
-        workflow_copy["12"]["inputs"]["strength_03"] = params["strength_03"]
-        workflow_copy["12"]["inputs"]["lora_04"] = params["lora_04"]
-        workflow_copy["12"]["inputs"]["strength_04"] = params["strength_04"]
-    
-    # 更新图生图工作流中的88号节点LoRA参数
-    if "88" in workflow_copy and "inputs" in workflow_copy["88"]:
-        workflow_copy["88"]["inputs"]["lora_01"] = params["lora_01"]
-        workflow_copy["88"]["inputs"]["strength_01"] = params["strength_01"]
-        workflow_copy["88"]["inputs"]["lora_02"] = params["lora_02"]
-        workflow_copy["88"]["inputs"]["strength_02"] = params["strength_02"]
-        workflow_copy["88"]["inputs"]["lora_03"] = params["lora_03"]
-        workflow_copy["88"]["inputs"]["strength_03"] = params["strength_03"]
-        workflow_copy["88"]["inputs"]["lora_04"] = params["lora_04"]
-        workflow_copy["88"]["inputs"]["strength_04"] = params["strength_04"]
-        print(f"已将LoRA参数保存到图生图工作流88号节点")
-    
-    # 更新文本提示词
-    if "33" in workflow_copy:
-        workflow_copy["33"]["inputs"]["text"] = params["face_prompt"]
-    
-    if "36" in workflow_copy:
-        workflow_copy["36"]["inputs"]["text"] = params["clothes_prompt"]
-    
-    if "37" in workflow_copy:
-        workflow_copy["37"]["inputs"]["text"] = params["environment_prompt"]
-    
-    # 保存工作流
-    save_workflow_json(workflow_copy)
+def save_workflow(params, user=None):
+    # 按编译好的补丁计划写入参数，只复制被修改的节点
+    workflow_copy = get_workflow_patch_plan("txt2img").apply(get_workflow_template("txt2img"), params)
+    
+    # 记住该用户最近一次使用的参数，工作流模板保持不变
+    if user is not None:
+        user_params.remember(user, "txt2img", params)
     return workflow_copy
 
 # 保存图生图调整后的参数
-def save_img2img_workflow(params):
-    workflow_copy = copy.deepcopy(img2img_workflow)
-    
+def save_img2img_workflow(params, user=None):
     # 如果工作流为空，使用默认结构（需实际使用时根据img_to_img.json结构调整）
-    if not workflow_copy:
+    template = get_workflow_template("img2img")
+    if not template:
         logging.warning("图生图工作流为空，无法保存参数")
-        return workflow_copy
-    
-    # 更新303节点参数（图片命名）
-    if "303" in workflow_copy:
-        if "inputs" not in workflow_copy["303"]:
-            workflow_copy["303"]["inputs"] = {}
-        workflow_copy["303"]["inputs"]["text"] = params["image_name"]
-    
-    # 更新图像尺寸
-    if "1" in workflow_copy:
-        workflow_copy["1"]["inputs"]["width"] = params["width"]
-        workflow_copy["1"]["inputs"]["height"] = params["height"]
-    
-    # 更新采样器 - 修改为节点77
-    if "77" in workflow_copy:
-        workflow_copy["77"]["inputs"]["sampler_name"] = params["sampler_name"]
-    
-    # 更新调度器 - 修改为节点78，移除去噪强度
-    if "78" in workflow_copy:
-        workflow_copy["78"]["inputs"]["scheduler"] = params["scheduler"]
-        workflow_copy["78"]["inputs"]["steps"] = params["steps"]
-        # 移除去噪强度设置
-    
-    # 更新图生图重绘幅度
-    if "94" in workflow_copy:
-        workflow_copy["94"]["inputs"]["string"] = str(params["redraw_strength"])
-    
-    # 更新随机噪声种子 - 固定使用节点79
-    if "79" in workflow_copy:
-        workflow_copy["79"]["inputs"]["noise_seed"] = params["noise_seed"]
-        print(f"已将随机种子 {params['noise_seed']} 保存到图生图工作流79号节点")
-    
-    # 更新引导参数 - 修改为节点80
-    if "80" in workflow_copy:
-        workflow_copy["80"]["inputs"]["guidance"] = params["guidance"]
-    
-    # 更新模型参数
-    if "87" in workflow_copy and "unet_name" in params:
-        workflow_copy["87"]["inputs"]["unet_name"] = params["unet_name"]
-    
-    if "75" in workflow_copy:
-        if "clip_name1" in params:
-            workflow_copy["75"]["inputs"]["clip_name1"] = params["clip_name1"]
-        if "clip_name2" in params:
-            workflow_copy["75"]["inputs"]["clip_name2"] = params["clip_name2"]
-    
-    if "84" in workflow_copy and "vae_name" in params:
-        workflow_copy["84"]["inputs"]["vae_name"] = params["vae_name"]
-    
-    # 更新LoRA参数 - 固定到节点88
-    if "88" in workflow_copy:
-        workflow_copy["88"]["inputs"]["lora_01"] = params["lora_01"]
-        workflow_copy["88"]["inputs"]["strength_01"] = params["strength_01"]
-        workflow_copy["88"]["inputs"]["lora_02"] = params["lora_02"]
-        workflow_copy["88"]["inputs"]["strength_02"] = params["strength_02"]
-        workflow_copy["88"]["inputs"]["lora_03"] = params["lora_03"]
-        workflow_copy["88"]["inputs"]["strength_03"] = params["strength_03"]
-        workflow_copy["88"]["inputs"]["lora_04"] = params["lora_04"]
-        workflow_copy["88"]["inputs"]["strength_04"] = params["strength_04"]
-        print(f"已将LoRA参数保存到图生图工作流88号节点")
-    
-    # 更新文本提示词到对应的节点
-    # 节点150：人物，景别，镜头，服饰
-    if "150" in workflow_copy and "inputs" in workflow_copy["150"]:
-        workflow_copy["150"]["inputs"]["text"] = params["face_prompt"]
-    
-    # 节点151：场景
-    if "151" in workflow_copy and "inputs" in workflow_copy["151"]:
-        workflow_copy["151"]["inputs"]["text"] = params["clothes_prompt"]
-    
-    # 节点152：动作
-    if "152" in workflow_copy and "inputs" in workflow_copy["152"]:
-        workflow_copy["152"]["inputs"]["text"] = params["environment_prompt"]
-    
-    # 保存工作流
-    save_img2img_workflow_json(workflow_copy)
+        return {}
+    
+    # 按编译好的补丁计划写入参数，只复制被修改的节点
+    workflow_copy = get_workflow_patch_plan("img2img").apply(template, params)
+    
+    # 记住该用户最近一次使用的参数，工作流模板保持不变
+    if user is not None:
+        user_params.remember(user, "img2img", params)
     return workflow_copy
 
 # 生成随机种子
 def generate_random_seed():
     return random.randint(0, 1000000000000000)
 
-# 使用WebSocket监听ComfyUI状态
-class ComfyUIWebSocket:
-    def __init__(self, client_id, prompt_id=None, on_image_generated=None, on_progress=None):
-        self.client_id = client_id
+# ComfyUI HTTP接口客户端：所有接口调用共用一个带连接池的Session（keep-alive），
+# 并为每类接口设置独立的(连接, 读取)超时，避免服务器卡死时线程被永久占用
+class ComfyUIClient:
+    timeouts = {
+        "prompt": (3, 30),
+        "queue": (3, 10),
+        "history": (3, 30),
+        "view": (3, 120),
+        "upload": (3, 120),
+        "control": (3, 10),
+        "system_stats": (2, 5),
+    }
+    
+    def __init__(self, server=COMFYUI_SERVER, pool_size=16, input_dir=None):
+        self.server = server
+        self.base_url = f"http://{server}"
+        self.input_dir = input_dir  # 本机可以直接访问的ComfyUI input文件夹，远程服务器为None
+        self._uploaded = {}  # 已上传图片内容的sha256 -> 服务器上的文件名
+        self._upload_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+    
+    def _request(self, method, path, endpoint, **kwargs):
+        kwargs.setdefault("timeout", self.timeouts[endpoint])
+        return self.session.request(method, self.base_url + path, **kwargs)
+    
+    # 提交工作流，返回原始响应，由调用方检查状态码
+    def submit_prompt(self, workflow, client_id, prompt_id=None):
+        prompt_data = {"prompt": workflow, "client_id": client_id}
+        if prompt_id:
+            prompt_data["prompt_id"] = prompt_id
+        return self._request("POST", "/api/prompt", "prompt", json=prompt_data)
+    
+    def get_queue(self):
+        response = self._request("GET", "/api/queue", "queue")
+        response.raise_for_status()
+        return response.json()
+    
+    # 查询历史记录，指定prompt_id时只返回该任务的记录
+    def get_history(self, prompt_id=None):
+        path = f"/api/history/{prompt_id}" if prompt_id else "/api/history"
+        response = self._request("GET", path, "history")
+        response.raise_for_status()
+        return response.json()
+    
+    # 获取输出图像，参数交给requests编码，文件名含特殊字符时也能正确下载
+    def view(self, filename, subfolder="", img_type="output", stream=False):
+        params = {"filename": filename, "subfolder": subfolder, "type": img_type}
+        return self._request("GET", "/view", "view", params=params, stream=stream)
+    
+    # 上传图片到ComfyUI的input目录，返回服务器实际保存的文件名
+    def upload_image(self, image_bytes, filename, overwrite=False):
+        files = {"image": (filename, image_bytes)}
+        data = {"type": "input", "overwrite": "true" if overwrite else "false"}
+        response = self._request("POST", "/upload/image", "upload", files=files, data=data)
+        response.raise_for_status()
+        result = response.json()
+        name = result["name"]
+        if result.get("subfolder"):
+            name = f"{result['subfolder']}/{name}"
+        return name
+    
+    # 把本地图片(文件路径或PIL图像)交给ComfyUI使用，返回工作流中引用的文件名
+    # 已在ComfyUI input目录中的文件直接使用文件名；其余文件按内容哈希命名后上传，
+    # 内容相同的图片只上传一次
+    def upload_input_image(self, source, prefix="upload"):
+        if source is None:
+            return None
+        if isinstance(source, str):
+            if self.input_dir and os.path.dirname(os.path.abspath(source)) == os.path.abspath(self.input_dir):
+                return os.path.basename(source)
+            with open(source, "rb") as f:
+                image_bytes = f.read()
+            ext = os.path.splitext(source)[1].lower() or ".png"
+        else:
+            buffer = BytesIO()
+            source.save(buffer, format="PNG")
+            image_bytes = buffer.getvalue()
+            ext = ".png"
+        
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        with self._upload_lock:
+            name = self._uploaded.get(digest)
+        # 本机input文件夹中的文件可能已被清理，此时重新上传
+        if name and self.input_dir and not os.path.exists(os.path.join(self.input_dir, name)):
+            name = None
+        if name:
+            http_log.info("图片内容已上传过，直接使用: %s", name)
+            return name
+        
+        name = self.upload_image(image_bytes, f"{prefix}_{digest[:16]}{ext}")
+        with self._upload_lock:
+            self._uploaded[digest] = name
+        http_log.info("已上传图片到ComfyUI: %s (%s KB)", name, len(image_bytes) // 1024)
+        return name
+    
+    # 启动时检查ComfyUI是否可以连接
+    def probe(self):
+        try:
+            response = self._request("GET", "/api/system_stats", "system_stats")
+            if response.status_code == 200:
+                http_log.info("ComfyUI服务器连接正常: %s", self.base_url)
+                return True
+            http_log.warning("ComfyUI服务器响应异常: %s，状态码: %s", self.base_url, response.status_code)
+        except requests.exceptions.RequestException as e:
+            http_log.warning("无法连接ComfyUI服务器: %s，错误: %s", self.base_url, e)
+        return False
+
+# ComfyUI异步HTTP客户端(httpx)，供异步的生成流程使用，等待结果时不占用线程
+# 每个gradio界面运行在各自线程的事件循环中，连接池按事件循环分别创建
+class AsyncComfyUIClient:
+    timeouts = ComfyUIClient.timeouts
+    max_concurrent_downloads = 4  # 每个事件循环同时下载输出文件的上限
+    
+    def __init__(self, server=COMFYUI_SERVER, pool_size=16):
+        self.server = server
+        self.base_url = f"http://{server}"
+        self.pool_size = pool_size
+        self._clients = weakref.WeakKeyDictionary()
+        self._download_semaphores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+    
+    def _get_client(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None:
+                limits = httpx.Limits(max_connections=self.pool_size,
+                                      max_keepalive_connections=self.pool_size)
+                client = httpx.AsyncClient(base_url=self.base_url, limits=limits)
+                self._clients[loop] = client
+            return client
+    
+    def _get_download_semaphore(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = self._download_semaphores.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self.max_concurrent_downloads)
+                self._download_semaphores[loop] = semaphore
+            return semaphore
+    
+    async def _request(self, method, path, endpoint, **kwargs):
+        connect_timeout, read_timeout = self.timeouts[endpoint]
+        kwargs.setdefault("timeout", httpx.Timeout(read_timeout, connect=connect_timeout))
+        return await self._get_client().request(method, path, **kwargs)
+    
+    # 提交工作流，返回原始响应，由调用方检查状态码
+    async def submit_prompt(self, workflow, client_id, prompt_id=None):
+        prompt_data = {"prompt": workflow, "client_id": client_id}
+        if prompt_id:
+            prompt_data["prompt_id"] = prompt_id
+        return await self._request("POST", "/api/prompt", "prompt", json=prompt_data)
+    
+    async def get_queue(self):
+        response = await self._request("GET", "/api/queue", "queue")
+        response.raise_for_status()
+        return response.json()
+    
+    async def get_history(self, prompt_id=None):
+        path = f"/api/history/{prompt_id}" if prompt_id else "/api/history"
+        response = await self._request("GET", path, "history")
+        response.raise_for_status()
+        return response.json()
+    
+    # 从等待队列中删除任务
+    async def delete_from_queue(self, prompt_ids):
+        response = await self._request("POST", "/api/queue", "control", json={"delete": list(prompt_ids)})
+        response.raise_for_status()
+    
+    # 中断正在执行的任务，新版本ComfyUI只会中断指定prompt_id的任务
+    async def interrupt(self, prompt_id=None):
+        payload = {"prompt_id": prompt_id} if prompt_id else {}
+        response = await self._request("POST", "/api/interrupt", "control", json=payload)
+        response.raise_for_status()
+    
+    async def view(self, filename, subfolder="", img_type="output"):
+        params = {"filename": filename, "subfolder": subfolder, "type": img_type}
+        return await self._request("GET", "/view", "view", params=params)
+    
+    # 把/view返回的文件按块直接写入dest_path，不在内存中解码和重新编码；
+    # 先写入临时文件，完成后再改名，失败或取消时不会留下不完整的文件。
+    # 同时进行的下载数受max_concurrent_downloads限制，传入hasher时边下载边计算内容哈希
+    async def download(self, filename, dest_path, subfolder="", img_type="output", chunk_size=256 * 1024, hasher=None):
+        params = {"filename": filename, "subfolder": subfolder, "type": img_type}
+        connect_timeout, read_timeout = self.timeouts["view"]
+        timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        temp_path = dest_path + ".part"
+        try:
+            async with self._get_download_semaphore():
+                async with self._get_client().stream("GET", "/view", params=params, timeout=timeout) as response:
+                    response.raise_for_status()
+                    with open(temp_path, "wb") as f:
+                        async for chunk in response.aiter_bytes(chunk_size):
+                            f.write(chunk)
+                            if hasher is not None:
+                                hasher.update(chunk)
+            os.replace(temp_path, dest_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return dest_path
+
+# ComfyUI工作流执行失败（执行报错或被中断）
+class ComfyUIExecutionError(Exception):
+    pass
+
+# 单个工作流(prompt)的执行状态机
+# pending(已入队) -> running(执行中) -> success(完成) / error(执行出错) / interrupted(被中断)
+# 收到服务器真正的结束事件(execution_success 或 node为空的executing)后立即完成future
+class ComfyUIJob:
+    def __init__(self, prompt_id=None, on_progress=None, on_preview=None):
         self.prompt_id = prompt_id
-        self.ws = None
-        self.on_image_generated = on_image_generated
-        self.on_progress = on_progress  # 添加进度回调
-        self.ws_url = f"ws://{COMFYUI_SERVER}/ws?clientId={client_id}"
-        self.running = False
-        self.generated_images = []
-        self.execution_started = False
-        self.execution_completed = False
+        self.on_progress = on_progress  # 进度回调
+        self.on_preview = on_preview  # 采样预览图回调，参数为图像字节
+        self.state = "pending"
+        self.images = []  # 执行过程中executed事件输出的图像
         self.current_node = ""  # 当前执行节点
-        self.connection_successful = False  # 添加连接状态标志
-        self.last_progress_time = 0  # 添加最后一次进度更新时间
-        self.max_retry_count = 3  # 添加最大重试次数
-        self.retry_count = 0  # 当前重试次数
-        
-    def on_message(self, ws, message):
-        try:
-            print(f"收到WebSocket消息: {message[:100]}..." if len(message) > 100 else message)
-            data = json.loads(message)
-            
-            # 记录最后一次收到消息的时间
-            self.last_progress_time = time.time()
-            self.connection_successful = True
-            
-            if data["type"] == "status":
-                print(f"ComfyUI状态: {data.get('status', 'unknown')}")
-                if self.on_progress and not self.execution_started:
-                    self.on_progress(0.15, "已连接ComfyUI，等待工作流开始...")
-                return
-                
-            # 只处理与当前prompt_id相关的消息
-            if "data" in data and "prompt_id" in data["data"] and data["data"]["prompt_id"] != self.prompt_id:
-                print(f"收到其他工作流的消息，已忽略. 当前: {self.prompt_id}, 收到: {data['data']['prompt_id']}")
-                return
-                
-            # 对于没有data字段但有prompt_id字段的消息
-            if "prompt_id" in data and data["prompt_id"] != self.prompt_id:
-                print(f"收到其他工作流的消息，已忽略. 当前: {self.prompt_id}, 收到: {data['prompt_id']}")
+        self.error = None
+        self.started_at = None  # 开始执行的时间，用于估计后续任务的等待时间
+        self.submitted = False  # 是否已成功提交到服务器，重连同步时只检查已提交的任务
+        self.future = concurrent.futures.Future()
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.future.done()
+
+    # 处理一条属于本任务的WebSocket消息
+    def handle_message(self, msg_type, data):
+        if self.done:
+            return
+
+        if msg_type == "execution_start":
+            job_log.info("工作流开始执行: %s", self.prompt_id)
+            self.state = "running"
+            self.started_at = time.time()
+            self._report(None, "工作流开始执行...")
+
+        elif msg_type == "execution_cached":
+            cached_nodes = data.get("nodes", [])
+            if cached_nodes:
+                job_log.debug("使用缓存的节点: %s", cached_nodes)
+
+        elif msg_type == "executing":
+            node_id = data.get("node")
+            if node_id is None:
+                # node为空表示整个工作流已执行完毕
+                self.resolve()
                 return
-            
-            if data["type"] == "execution_start":
-                print(f"工作流开始执行: {self.prompt_id}")
-                self.execution_started = True
-                if self.on_progress:
-                    self.on_progress(0.2, "工作流开始执行...")
-                
-            elif data["type"] == "executing":
-                # 执行中，更新进度
-                node_id = None
-                # 检查是否有data字段包装
-                if "data" in data and "node" in data["data"]:
-                    node_id = data["data"].get("node", "unknown")
-                elif "node" in data:
-                    node_id = data.get("node", "unknown")
-                
-                if node_id:
-                    self.current_node = node_id
-                    print(f"正在执行节点: {node_id}")
-                    # 更新UI进度
-                    if self.on_progress:
-                        # 根据节点ID判断执行阶段
-                        progress_message = self._get_node_description(node_id)
-                        self.on_progress(0.25, f"正在执行: {progress_message}")
-                
-            elif data["type"] == "progress":
-                # 进度更新 - 处理不同格式的进度消息
-                value = None
-                max_value = None
-                
-                # 检查是否有data字段包装
-                if "data" in data:
-                    if "value" in data["data"] and "max" in data["data"]:
-                        value = data["data"]["value"]
-                        max_value = data["data"]["max"]
-                else:
-                    if "value" in data and "max" in data:
-                        value = data["value"]
-                        max_value = data["max"]
-                
-                if value is not None and max_value is not None:
-                    progress_value = value / max_value
-                    print(f"进度: {int(progress_value * 100)}% ({value}/{max_value})")
-                    # 将实际进度传递给UI
-                    if self.on_progress:
-                        # 将进度映射到0.25-0.9区间
-                        ui_progress = 0.25 + progress_value * 0.65
-                        progress_message = self._get_node_description(self.current_node)
-                        self.on_progress(ui_progress, f"进度: {int(progress_value * 100)}% - {progress_message}")
-                    
-            elif data["type"] == "executed":
-                # 节点执行完毕 - 处理不同格式的消息
-                node_id = None
-                output = None
-                
-                # 检查是否有data字段包装
-                if "data" in data:
-                    if "node" in data["data"]:
-                        node_id = data["data"]["node"]
-                    if "output" in data["data"]:
-                        output = data["data"]["output"]
-                else:
-                    if "node" in data:
-                        node_id = data["node"]
-                    if "output" in data:
-                        output = data["output"]
-                
-                if node_id:
-                    print(f"节点执行完毕: {node_id}")
-                    
-                if output and "images" in output:
-                    for img_data in output["images"]:
-                        if "filename" in img_data:
-                            img_info = {
-                                "filename": img_data["filename"],
-                                "subfolder": img_data.get("subfolder", ""),
-                                "type": img_data.get("type", "output")
-                            }
-                            self.generated_images.append(img_info)
-                            print(f"检测到图像输出: {img_info['filename']}")
-                            if self.on_progress:
-                                self.on_progress(0.9, "图像生成完成，准备下载...")
-                        
-            elif data["type"] == "execution_cached" or data["type"] == "execution_complete":
-                # 执行完成
-                print(f"工作流执行完成: {self.prompt_id}")
-                self.execution_completed = True
-                if self.on_progress:
-                    self.on_progress(0.95, "工作流执行完成，准备显示结果...")
-        except Exception as e:
-            print(f"处理WebSocket消息时出错: {e}")
-            import traceback
-            traceback.print_exc()
-            
-    def on_error(self, ws, error):
-        print(f"WebSocket错误: {error}")
-        # 记录错误时的时间，便于后续分析
-        self.last_error_time = time.time()
-        
-    def on_close(self, ws, close_status_code, close_msg):
-        print(f"WebSocket连接关闭: 代码={close_status_code}, 消息={close_msg}")
-        self.running = False
-        
-        # 尝试重新连接（仅当还未达到最大重试次数且工作流未完成）
-        if self.retry_count < self.max_retry_count and self.execution_started and not self.execution_completed:
-            self.retry_count += 1
-            print(f"尝试重新连接WebSocket (尝试 {self.retry_count}/{self.max_retry_count})")
-            if self.on_progress:
-                self.on_progress(0.85, f"WebSocket连接中断，正在尝试重新连接 ({self.retry_count}/{self.max_retry_count})...")
-            self.start()
+            self.state = "running"
+            self.current_node = node_id
+            job_log.debug("正在执行节点: %s", node_id)
+            self._report(None, f"正在执行: {self._get_node_description(node_id)}")
+
+        elif msg_type == "progress":
+            value = data.get("value")
+            max_value = data.get("max")
+            if value is not None and max_value:
+                # 直接使用采样器的实际步数作为进度
+                progress_message = self._get_node_description(self.current_node)
+                self._report(value / max_value, f"步数: {value}/{max_value} - {progress_message}")
+
+        elif msg_type == "executed":
+            node_id = data.get("node")
+            output = data.get("output") or {}
+            if node_id:
+                job_log.debug("节点执行完毕: %s", node_id)
+            for img_data in output.get("images", []):
+                if "filename" in img_data:
+                    img_info = {
+                        "filename": img_data["filename"],
+                        "subfolder": img_data.get("subfolder", ""),
+                        "type": img_data.get("type", "output")
+                    }
+                    with self._lock:
+                        self.images.append(img_info)
+                    job_log.debug("检测到图像输出: %s", img_info['filename'])
+                    self._report(None, "图像生成完成，准备下载...")
+
+        elif msg_type == "execution_success":
+            self.resolve()
+
+        elif msg_type == "execution_error":
+            error_message = data.get("exception_message") or "未知错误"
+            node_type = data.get("node_type", "")
+            self.fail("error", f"节点 {data.get('node_id', '')} {node_type} 执行出错: {error_message}")
+
+        elif msg_type == "execution_interrupted":
+            self.fail("interrupted", "工作流已被中断")
+
+    # 处理一帧属于本任务的采样预览图
+    def handle_preview(self, image_bytes):
+        if self.done or not self.on_preview:
             return
-        
-        # 如果WebSocket关闭但我们有图像且执行已经开始，调用回调
-        if self.execution_started and self.generated_images and self.on_image_generated:
-            print("WebSocket关闭时有未处理的图像，现在处理它们")
-            self.on_image_generated(self.generated_images)
-        
-    def on_open(self, ws):
-        print(f"WebSocket连接已打开: {self.ws_url}")
-        self.running = True
-        self.connection_successful = True
-        self.last_progress_time = time.time()
-        
-        if self.on_progress:
-            self.on_progress(0.15, "WebSocket连接已建立，等待ComfyUI响应...")
-        
-        # 发送一个ping消息测试WebSocket是否正常工作
         try:
-            ws.send(json.dumps({"type": "ping"}))
-            print("已发送ping消息")
+            self.on_preview(image_bytes)
         except Exception as e:
-            print(f"发送ping消息失败: {e}")
-        
-    def start(self):
-        # 创建WebSocket连接
-        websocket.enableTrace(True)  # 启用调试输出
+            job_log.warning("更新预览图失败: %s", e)
+
+    # 任务成功完成，images为空时使用executed事件收集到的图像
+    def resolve(self, images=None):
+        with self._lock:
+            if self.future.done():
+                return
+            if images is not None:
+                self.images = list(images)
+            self.state = "success"
+            result = list(self.images)
+            self.future.set_result(result)
+        job_log.info("工作流执行完成: %s，共 %s 张图像", self.prompt_id, len(result))
+        self._report(1.0, "工作流执行完成，准备显示结果...")
+
+    # 任务失败
+    def fail(self, state, message):
+        with self._lock:
+            if self.future.done():
+                return
+            self.state = state
+            self.error = message
+            self.future.set_exception(ComfyUIExecutionError(message))
+        job_log.warning("工作流执行失败: %s - %s", self.prompt_id, message)
+
+    # 阻塞等待任务结束，超时返回None；任务失败时抛出ComfyUIExecutionError
+    def wait(self, timeout=None):
         try:
-            self.ws = websocket.WebSocketApp(self.ws_url,
-                                          on_message=self.on_message,
-                                          on_error=self.on_error,
-                                          on_close=self.on_close,
-                                          on_open=self.on_open)
-            
-            # 启动WebSocket客户端线程
-            self.thread = threading.Thread(target=self.ws.run_forever)
-            self.thread.daemon = True
-            self.thread.start()
-        except Exception as e:
-            print(f"创建WebSocket连接失败: {e}")
-            import traceback
-            traceback.print_exc()
-        
-    def close(self):
-        # 如果WebSocket还在运行且有图像，调用回调
-        if self.running and self.generated_images and self.on_image_generated:
-            print("关闭WebSocket前处理生成的图像")
-            self.on_image_generated(self.generated_images)
-            
-        # 关闭WebSocket
-        if self.ws:
-            print("关闭WebSocket连接")
-            self.ws.close()
-        self.running = False
-        
+            return self.future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+
+    def _report(self, value, message):
+        if self.on_progress:
+            try:
+                self.on_progress(value, message)
+            except Exception as e:
+                job_log.warning("更新进度失败: %s", e)
+
     # 根据节点ID返回更友好的描述
     def _get_node_description(self, node_id):
         node_descriptions = {
@@ -1022,310 +1301,1822 @@ class ComfyUIWebSocket:
         }
         return node_descriptions.get(node_id, f"处理节点 {node_id}")
 
-# 发送工作流到ComfyUI并获取结果
-def send_workflow_to_comfyui(workflow_data, progress=None, return_all_images=False, input_image_path=None):
+# ComfyUI二进制WebSocket消息类型
+PREVIEW_IMAGE = 1  # 采样预览图：4字节事件类型 + 4字节图像格式 + 图像数据
+PREVIEW_IMAGE_WITH_METADATA = 4  # 带元数据的预览图：4字节事件类型 + 4字节元数据长度 + JSON元数据 + 图像数据
+
+# 解析二进制预览帧，返回(图像字节, 元数据)，不是预览帧时返回None
+def decode_preview_frame(message):
+    if len(message) < 8:
+        return None
+    event_type = struct.unpack(">I", message[:4])[0]
+    if event_type == PREVIEW_IMAGE:
+        return message[8:], {}
+    if event_type == PREVIEW_IMAGE_WITH_METADATA:
+        metadata_length = struct.unpack(">I", message[4:8])[0]
+        metadata = json.loads(message[8:8 + metadata_length].decode("utf-8"))
+        return message[8 + metadata_length:], metadata
+    return None
+
+# 单个任务的进度总线：WebSocket线程和发送流程只记录最新的进度、状态和采样预览帧，
+# 界面按固定频率取最新状态刷新，来不及显示的中间更新直接合并丢弃
+class ComfyUIProgressBus:
+    max_updates_per_second = 4  # 每秒最多刷新界面的次数
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+        self.message = ""
+        self._seq = 0
+        self._image_bytes = None
+        self._preview_seq = 0
+        self.task = None
+        self._loop = None
+        self.job = None  # 发送流程登记的ComfyUIJob，出错兜底时按任务查找输出
+        self._results = []  # 已下载完成、界面还未取走的结果图像[(序号, 路径)]
+
+    # 在当前事件循环中启动生成任务，返回asyncio任务
+    def start(self, coro):
+        self._loop = asyncio.get_running_loop()
+        self.task = asyncio.ensure_future(coro)
+        return self.task
+
+    # 取消生成任务，可以在任意线程中调用
+    def cancel(self):
+        if self.task is None or self.task.done():
+            return
+        try:
+            self._loop.call_soon_threadsafe(self.task.cancel)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+
+    # 记录进度，value为None时只更新状态文字
+    def update(self, value, message):
+        with self._lock:
+            if value is not None:
+                self.value = value
+            self.message = message
+            self._seq += 1
+
+    # 记录一张已下载完成的结果图像，index为该图像在任务输出中的序号
+    def add_result(self, index, path):
+        with self._lock:
+            self._results.append((index, path))
+            self._seq += 1
+    
+    # 取出上次调用之后新下载完成的结果图像[(序号, 路径)]
+    def take_results(self):
+        with self._lock:
+            results, self._results = self._results, []
+        return results
+    
+    # 记录最新的采样预览帧
+    def push(self, image_bytes):
+        with self._lock:
+            self._image_bytes = image_bytes
+            self._preview_seq += 1
+
+    # 在任务完成前按限定频率产出(进度, 状态文字, 预览图)，预览图没有更新时为None
+    async def stream(self, task):
+        interval = 1.0 / self.max_updates_per_second
+        last_seq = 0
+        last_preview_seq = 0
+        while not task.done():
+            await asyncio.wait({task}, timeout=interval)
+            if task.done():
+                break
+            with self._lock:
+                seq, value, message = self._seq, self.value, self.message
+                preview_seq, image_bytes = self._preview_seq, self._image_bytes
+            if seq == last_seq and preview_seq == last_preview_seq:
+                continue
+            last_seq = seq
+            image = None
+            if preview_seq != last_preview_seq and image_bytes is not None:
+                last_preview_seq = preview_seq
+                try:
+                    image = Image.open(BytesIO(image_bytes))
+                    image.load()
+                except Exception as e:
+                    job_log.warning("解码预览图失败: %s", e)
+                    image = None
+            yield value, message, image
+
+# ComfyUI服务器熔断器：连续失败达到阈值后断开，断开期间新任务直接失败，
+# 超过reset_timeout后允许再次尝试，成功一次即恢复
+class ComfyUICircuitBreaker:
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None  # 断开的时间，None表示闭合
+        self._lock = threading.Lock()
+    
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+    
+    # 是否允许发起新请求：闭合时允许，断开超过reset_timeout后允许试探
+    def allow(self):
+        with self._lock:
+            return self.opened_at is None or time.time() - self.opened_at >= self.reset_timeout
+    
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+    
+    # 记录一次失败，返回熔断器是否因此刚刚断开
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures < self.failure_threshold:
+                return False
+            just_opened = self.opened_at is None
+            self.opened_at = time.time()
+            return just_opened
+
+# 进程内共享的ComfyUI WebSocket连接
+# 所有任务使用同一个client_id提交，消息按prompt_id分发给等待中的任务。
+# 断线后按指数退避（带随机抖动）重连，重连成功后通过HTTP接口同步断线期间各任务的状态
+class ComfyUIWebSocket:
+    reconnect_base_delay = 1  # 第一次重连的等待时间（秒）
+    reconnect_max_delay = 30  # 重连等待时间上限（秒）
+    max_early_events = 200  # 最多缓存的未登记任务事件数
+
+    def __init__(self, server=COMFYUI_SERVER, client=None, breaker=None):
+        self.server = server
+        self.client = client or ComfyUIClient(server)  # 重连后同步任务状态使用
+        self.breaker = breaker or ComfyUICircuitBreaker()
+        self.client_id = str(uuid.uuid4())  # 整个进程共享的客户端ID
+        self.ws = None
+        self.ws_url = f"ws://{server}/ws?clientId={self.client_id}"
+        self.jobs = {}  # prompt_id -> ComfyUIJob
+        # 任务登记前收到的事件（旧版本ComfyUI不接受客户端指定prompt_id时出现）
+        self._early_events = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+        self.running = False
+        self.connected_event = threading.Event()  # 连接建立后置位
+        self.connection_successful = False  # 当前是否处于连接状态
+        self.last_progress_time = 0  # 最后一次收到消息的时间
+        self.running_prompt_id = None  # 服务器当前正在执行的prompt
+        self._ever_connected = False  # 是否连接成功过，用于区分首次连接和重连
+        self._opened = False  # 本次连接是否建立成功
+
+    # 登记等待中的任务，并补发登记前已收到的事件
+    def register(self, job):
+        with self._lock:
+            self.jobs[job.prompt_id] = job
+            early = self._early_events.pop(job.prompt_id, [])
+        for msg_type, msg_data in early:
+            job.handle_message(msg_type, msg_data)
+
+    # 服务器返回的prompt_id与预先生成的不一致时重新登记
+    def rekey(self, job, prompt_id):
+        with self._lock:
+            self.jobs.pop(job.prompt_id, None)
+        job.prompt_id = prompt_id
+        self.register(job)
+
+    def unregister(self, job):
+        with self._lock:
+            if self.jobs.get(job.prompt_id) is job:
+                del self.jobs[job.prompt_id]
+
+    def _dispatch(self, prompt_id, msg_type, msg_data):
+        with self._lock:
+            job = self.jobs.get(prompt_id)
+            if job is None:
+                events = self._early_events.setdefault(prompt_id, [])
+                events.append((msg_type, msg_data))
+                while len(self._early_events) > self.max_early_events:
+                    self._early_events.popitem(last=False)
+                return
+        job.handle_message(msg_type, msg_data)
+
+    def _active_jobs(self):
+        with self._lock:
+            return list(self.jobs.values())
+        
+    # 二进制消息为采样预览图，交给对应的任务
+    def _handle_binary(self, message):
+        ws_sampler.debug("preview", "收到预览帧: %s 字节", len(message))
+        frame = decode_preview_frame(message)
+        if frame is None:
+            return
+        image_bytes, metadata = frame
+        prompt_id = metadata.get("prompt_id") or self.running_prompt_id
+        with self._lock:
+            job = self.jobs.get(prompt_id)
+        if job is not None:
+            job.handle_preview(image_bytes)
+        
+    def on_message(self, ws, message):
+        try:
+            if isinstance(message, bytes):
+                self.last_progress_time = time.time()
+                self._handle_binary(message)
+                return
+            data = json.loads(message)
+            
+            # 记录最后一次收到消息的时间
+            self.last_progress_time = time.time()
+            self.connection_successful = True
+            
+            msg_type = data.get("type")
+            ws_sampler.debug(msg_type, "收到WebSocket消息: %s", msg_type)
+            # 兼容有data字段包装和没有包装的两种消息格式
+            msg_data = data.get("data", data)
+            if not isinstance(msg_data, dict):
+                msg_data = {}
+            
+            if msg_type == "status":
+                ws_log.debug("ComfyUI状态: %s", msg_data.get('status', 'unknown'))
+                for job in self._active_jobs():
+                    if job.on_progress and job.state == "pending":
+                        job.on_progress(None, "已连接ComfyUI，等待工作流开始...")
+                return
+            
+            # 记录服务器当前执行的prompt，用于分发不带prompt_id的旧格式消息
+            prompt_id = msg_data.get("prompt_id")
+            if msg_type in ("execution_start", "executing") and prompt_id:
+                self.running_prompt_id = prompt_id if msg_data.get("node", "") is not None else None
+            if prompt_id is None:
+                prompt_id = self.running_prompt_id
+            if prompt_id is None:
+                return
+            
+            self._dispatch(prompt_id, msg_type, msg_data)
+        except Exception as e:
+            ws_log.error("处理WebSocket消息时出错: %s", e, exc_info=True)
+            
+    def on_error(self, ws, error):
+        ws_log.warning("WebSocket错误: %s", error)
+        # 记录错误时的时间，便于后续分析
+        self.last_error_time = time.time()
+        
+    def on_close(self, ws, close_status_code, close_msg):
+        ws_log.info("WebSocket连接关闭: 代码=%s, 消息=%s", close_status_code, close_msg)
+        self.running = False
+        self.connection_successful = False
+        self.connected_event.clear()
+        if self._stopped:
+            return
+        for job in self._active_jobs():
+            if job.on_progress:
+                job.on_progress(None, "WebSocket连接中断，正在尝试重新连接...")
+        
+    def on_open(self, ws):
+        ws_log.info("WebSocket连接已打开: %s", self.ws_url)
+        self.running = True
+        self.connection_successful = True
+        self.last_progress_time = time.time()
+        self.breaker.record_success()
+        self._opened = True
+        reconnected = self._ever_connected
+        self._ever_connected = True
+        self.connected_event.set()
+        if reconnected:
+            # 在单独的线程中同步，不阻塞WebSocket消息的接收
+            threading.Thread(target=self.resync, name="comfyui-resync", daemon=True).start()
+
+    # 重连后同步断线期间错过的任务状态：仍在队列中的继续等待，
+    # 已有历史记录的直接完成或失败，两处都找不到的（服务器重启）视为丢失
+    def resync(self):
+        jobs = [job for job in self._active_jobs() if job.submitted and not job.done]
+        if not jobs:
+            return
+        ws_log.info("WebSocket已重连，同步 %s 个任务的状态", len(jobs))
+        try:
+            queue_data = self.client.get_queue()
+        except Exception as e:
+            ws_log.warning("同步任务状态时查询队列失败: %s", e)
+            return
+        running = {item[1] for item in queue_data.get("queue_running", [])}
+        pending = {item[1] for item in queue_data.get("queue_pending", [])}
+        self.running_prompt_id = next(iter(running), None)
+        
+        for job in jobs:
+            if job.prompt_id in running:
+                job.state = "running"
+                job._report(None, "已重新连接ComfyUI，工作流执行中...")
+                continue
+            if job.prompt_id in pending:
+                job._report(None, "已重新连接ComfyUI，等待工作流开始...")
+                continue
+            try:
+                history_data = self.client.get_history(job.prompt_id)
+            except Exception as e:
+                ws_log.warning("同步任务状态时查询历史记录失败: %s", e)
+                continue
+            prompt_info = history_data.get(job.prompt_id)
+            if prompt_info is None:
+                job.fail("lost", "ComfyUI服务器已重启，任务已丢失，请重新生成")
+            elif prompt_info.get("status", {}).get("status_str") == "error":
+                job.fail("error", "工作流执行出错（断线期间）")
+            else:
+                images = parse_history_images(history_data, job.prompt_id)
+                if images is not None:
+                    job.resolve(images)
+
+    # 第attempt次重连前的等待时间：指数增长并加入随机抖动，避免多个进程同时重连
+    def _reconnect_delay(self, attempt):
+        delay = min(self.reconnect_max_delay, self.reconnect_base_delay * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    # 连接循环：断线后在同一个线程内重连，不再为每次重连创建新线程
+    def _run(self):
+        attempt = 0
+        while not self._stopped:
+            opened = False
+            try:
+                self.ws = websocket.WebSocketApp(self.ws_url,
+                                              on_message=self.on_message,
+                                              on_error=self.on_error,
+                                              on_close=self.on_close,
+                                              on_open=self.on_open)
+                self._opened = False
+                self.ws.run_forever(ping_interval=30, ping_timeout=10)
+                opened = self._opened
+            except Exception as e:
+                ws_log.warning("WebSocket连接异常: %s", e)
+            self.running = False
+            self.connection_successful = False
+            self.connected_event.clear()
+            if self._stopped:
+                break
+            
+            if opened:
+                # 连接建立过，说明服务器可用，从头开始退避
+                attempt = 0
+            elif self.breaker.record_failure():
+                # 连续连接失败，熔断并让等待中的任务立即失败，不再无限等待
+                ws_log.warning("ComfyUI服务器不可用，熔断 %s 秒: %s", self.breaker.reset_timeout, self.server)
+                for job in self._active_jobs():
+                    job.fail("unavailable", "ComfyUI服务器不可用，请稍后重试")
+            
+            delay = self._reconnect_delay(attempt)
+            attempt += 1
+            ws_log.info("%.1f 秒后重新连接WebSocket（第 %s 次）", delay, attempt)
+            time.sleep(delay)
+        
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped = False
+        # 启动WebSocket客户端线程（整个进程只有一个）
+        self._thread = threading.Thread(target=self._run, name="comfyui-websocket")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # 等待连接建立，避免提交后才连接导致漏掉执行事件
+    def wait_connected(self, timeout=5):
+        return self.connected_event.wait(timeout)
+        
+    def close(self):
+        # 关闭WebSocket，不再重连
+        self._stopped = True
+        if self.ws:
+            ws_log.info("关闭WebSocket连接")
+            self.ws.close()
+        self.running = False
+
+# 从历史记录的单个prompt条目中提取输出图像
+def extract_history_images(prompt_info):
+    images = []
+    for node_id, node_output in prompt_info.get("outputs", {}).items():
+        for img_data in node_output.get("images", []):
+            if "filename" in img_data:
+                images.append({
+                    "filename": img_data["filename"],
+                    "subfolder": img_data.get("subfolder", ""),
+                    "type": img_data.get("type", "output")
+                })
+    return images
+
+# 从历史记录中取出指定工作流的输出图像，未完成时返回None
+def parse_history_images(history_data, prompt_id):
+    if prompt_id not in history_data:
+        return None
+    history_log.debug("在历史记录中找到工作流: %s", prompt_id)
+    prompt_info = history_data[prompt_id]
+    status = prompt_info.get("status", {})
+    if not prompt_info.get("outputs") and not status.get("completed"):
+        return None
+    images = extract_history_images(prompt_info)
+    history_log.debug("从历史记录中找到 %s 张图像", len(images))
+    return images
+
+# 通过HTTP历史记录查询工作流结果，未完成时返回None
+def fetch_history_images(client, prompt_id):
+    return parse_history_images(client.get_history(prompt_id), prompt_id)
+
+# fetch_history_images的异步版本
+async def fetch_history_images_async(async_client, prompt_id):
+    return parse_history_images(await async_client.get_history(prompt_id), prompt_id)
+
+# 历史记录兜底跟踪器：只为WebSocket失联时仍在等待的任务查询/api/history/{prompt_id}，
+# 一个后台线程在每个轮询周期内批量检查所有等待中的任务，没有结果时逐步拉长轮询间隔
+class ComfyUIHistoryTracker:
+    def __init__(self, client, min_interval=2, max_interval=30):
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+    
+    # 开始跟踪任务，新任务加入时重置轮询间隔并立即检查一次
+    def watch(self, job):
+        with self._lock:
+            if job.prompt_id in self.jobs:
+                return
+            self.jobs[job.prompt_id] = job
+            self.interval = self.min_interval
+            self._wakeup.set()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="comfyui-history", daemon=True)
+                self._thread.start()
+    
+    def unwatch(self, job):
+        with self._lock:
+            if self.jobs.get(job.prompt_id) is job:
+                del self.jobs[job.prompt_id]
+    
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                jobs = [job for job in self.jobs.values() if not job.done]
+                for prompt_id in [pid for pid, job in self.jobs.items() if job.done]:
+                    del self.jobs[prompt_id]
+                interval = self.interval
+            
+            if not jobs:
+                # 没有等待中的任务时休眠到下一次watch
+                self._wakeup.wait()
+                continue
+            
+            resolved = 0
+            for job in jobs:
+                try:
+                    images = fetch_history_images(self.client, job.prompt_id)
+                    if images is not None:
+                        job.resolve(images)
+                        resolved += 1
+                except Exception as e:
+                    history_log.warning("HTTP API检查失败: %s", e)
+            
+            with self._lock:
+                if resolved:
+                    self.interval = self.min_interval
+                else:
+                    self.interval = min(self.interval * 2, self.max_interval)
+                interval = self.interval
+            
+            self._wakeup.wait(interval)
+
+# 一个ComfyUI服务器及其HTTP客户端、共享WebSocket和历史记录跟踪器，
+# 同一个任务的提交、进度、历史记录和下载都经过同一个后端
+class ComfyUIBackend:
+    def __init__(self, server, comfyui_dir=None):
+        self.server = server
+        # 本机可以直接访问的ComfyUI安装目录，远程服务器为None
+        self.comfyui_dir = comfyui_dir
+        input_dir = os.path.join(comfyui_dir, "input") if comfyui_dir else None
+        self.client = ComfyUIClient(server, input_dir=input_dir)
+        self.async_client = AsyncComfyUIClient(server)
+        self.tracker = ComfyUIHistoryTracker(self.client)
+        self.healthy = True
+        self.queue_depth = 0  # 最近一次队列快照中的任务数
+        # 最近一次/api/queue的快照：(时间, 执行中的prompt_id列表, 按顺序排列的等待中prompt_id列表)
+        self.queue_snapshot = (0, [], [])
+        self._queue_lock = threading.Lock()
+        self.active_jobs = 0  # 本进程分配到该服务器且尚未结束的任务数
+        self.submitted_prompts = {}  # 其中已提交到服务器的任务：prompt_id -> 提交时间
+        self.durations = collections.deque(maxlen=20)  # 最近完成任务的执行耗时（秒）
+        self.breaker = ComfyUICircuitBreaker()  # WebSocket连接和健康检查共用
+        self._websocket = None
+        self._lock = threading.Lock()
+    
+    # 获取该服务器的共享WebSocket连接，首次调用时建立连接
+    def get_websocket(self):
+        with self._lock:
+            if self._websocket is None:
+                self._websocket = ComfyUIWebSocket(self.server, self.client, self.breaker)
+                pool_log.info("创建共享WebSocket连接: %s，客户端ID: %s", self.server, self._websocket.client_id)
+            websocket_hub = self._websocket
+        websocket_hub.start()
+        # 熔断期间不再等待连接建立
+        if self.breaker.is_open:
+            return websocket_hub
+        if not websocket_hub.wait_connected(timeout=5):
+            pool_log.warning("WebSocket连接未能及时建立: %s，将通过HTTP历史记录检查结果", self.server)
+        return websocket_hub
+    
+    # 把输出图像的filename/subfolder/type解析为本机可以直接访问的ComfyUI文件路径，
+    # 远程服务器、文件不存在或路径越出对应文件夹时返回None
+    def resolve_local_file(self, image_info):
+        if not self.comfyui_dir:
+            return None
+        img_type = image_info.get("type", "output")
+        if img_type not in ("output", "temp", "input"):
+            return None
+        base_dir = os.path.abspath(os.path.join(self.comfyui_dir, img_type))
+        path = os.path.abspath(os.path.join(base_dir, image_info.get("subfolder", ""), image_info["filename"]))
+        try:
+            if os.path.commonpath([base_dir, path]) != base_dir:
+                return None
+        except ValueError:
+            return None
+        return path if os.path.isfile(path) else None
+    
+    # 刷新队列快照；max_age秒内已经刷新过时直接使用，所有等待中的任务和健康检查共用同一份快照，
+    # 每个服务器每个周期只请求一次/api/queue
+    def refresh_queue(self, max_age=0):
+        with self._queue_lock:
+            if max_age and time.time() - self.queue_snapshot[0] < max_age:
+                return self.queue_snapshot
+            queue_data = self.client.get_queue()
+            running = [item[1] for item in queue_data.get("queue_running", [])]
+            pending = [item[1] for item in sorted(queue_data.get("queue_pending", []), key=lambda item: item[0])]
+            self.queue_snapshot = (time.time(), running, pending)
+            self.queue_depth = len(running) + len(pending)
+            return self.queue_snapshot
+    
+    def check_health(self):
+        try:
+            self.refresh_queue()
+            if not self.healthy:
+                pool_log.info("ComfyUI服务器已恢复: %s", self.server)
+            self.healthy = True
+            self.breaker.record_success()
+        except Exception as e:
+            if self.healthy:
+                pool_log.warning("ComfyUI服务器不可用: %s，错误: %s", self.server, e)
+            self.healthy = False
+            self.breaker.record_failure()
+    
+    # 负载：队列快照中的任务数 + 本进程还没有出现在快照中的任务
+    # （尚未提交的，以及在快照之后才提交的），已在快照中的本地任务不重复计算
+    def load(self):
+        checked_at = self.queue_snapshot[0]
+        submitted = list(self.submitted_prompts.values())
+        unsubmitted = max(0, self.active_jobs - len(submitted))
+        return self.queue_depth + unsubmitted + sum(1 for t in submitted if t > checked_at)
+    
+    def record_duration(self, seconds):
+        self.durations.append(seconds)
+    
+    # 按最近任务的平均耗时估计前面jobs_ahead个任务需要的时间，没有历史数据时返回None
+    def estimate_wait(self, jobs_ahead):
+        if not self.durations:
+            return None
+        return jobs_ahead * sum(self.durations) / len(self.durations)
+    
+    # 取消任务：还在排队时从队列中删除，正在执行时中断，已结束时不做处理
+    async def cancel_prompt(self, prompt_id):
+        queue_data = await self.async_client.get_queue()
+        if any(item[1] == prompt_id for item in queue_data.get("queue_pending", [])):
+            await self.async_client.delete_from_queue([prompt_id])
+            pool_log.info("已从ComfyUI队列中删除任务: %s", prompt_id)
+        elif any(item[1] == prompt_id for item in queue_data.get("queue_running", [])):
+            await self.async_client.interrupt(prompt_id)
+            pool_log.info("已中断ComfyUI正在执行的任务: %s", prompt_id)
+    
+    # 按队列快照计算任务前面还有多少个任务（包括正在执行的），不在队列中时返回None
+    async def get_jobs_ahead(self, prompt_id, max_age=5):
+        checked_at, running, pending = await asyncio.to_thread(self.refresh_queue, max_age)
+        if prompt_id in pending:
+            return len(running) + pending.index(prompt_id)
+        return None
+
+# ComfyUI服务器池：后台线程定期通过/api/queue检查各服务器的健康状态和队列长度，
+# 新任务分配给可用服务器中负载最小的一个
+class ComfyUIBackendPool:
+    health_check_interval = 5  # 健康检查间隔（秒）
+    
+    def __init__(self, servers):
+        # 默认服务器在本机（WSL）上，可以直接访问它的input文件夹
+        self.backends = [
+            ComfyUIBackend(server, WSL_COMFYUI_PATH if server == COMFYUI_SERVER else None)
+            for server in servers
+        ]
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    # 默认服务器，用于界面上传图片等不属于具体任务的操作
+    @property
+    def default(self):
+        return self.backends[0]
+    
+    def _run(self):
+        while True:
+            for backend in self.backends:
+                backend.check_health()
+            time.sleep(self.health_check_interval)
+    
+    def _start_health_checks(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="comfyui-health", daemon=True)
+                self._thread.start()
+    
+    # 选择负载最小的可用服务器；所有服务器都不可用时在全部服务器中选择
+    def select(self):
+        if len(self.backends) == 1:
+            return self.backends[0]
+        self._start_health_checks()
+        candidates = [backend for backend in self.backends
+                      if backend.healthy and backend.breaker.allow()] or self.backends
+        backend = min(candidates, key=lambda b: b.load())
+        pool_log.info("任务分配到ComfyUI服务器: %s (负载: %s, 队列: %s, 本地任务: %s)",
+                      backend.server, backend.load(), backend.queue_depth, backend.active_jobs)
+        return backend
+    
+    # 标记任务开始/提交/结束，用于健康检查间隔内的负载估计
+    def acquire(self, backend):
+        with self._lock:
+            backend.active_jobs += 1
+    
+    def mark_submitted(self, backend, prompt_id):
+        with self._lock:
+            backend.submitted_prompts[prompt_id] = time.time()
+    
+    def release(self, backend, prompt_id=None):
+        with self._lock:
+            backend.active_jobs = max(0, backend.active_jobs - 1)
+            backend.submitted_prompts.pop(prompt_id, None)
+    
+    # 启动时检查所有服务器是否可以连接，多个服务器时开始定期健康检查
+    def probe(self):
+        for backend in self.backends:
+            backend.healthy = backend.client.probe()
+        if len(self.backends) > 1:
+            self._start_health_checks()
+        return any(backend.healthy for backend in self.backends)
+
+# 全局共享的ComfyUI服务器池
+comfyui_pool = ComfyUIBackendPool(COMFYUI_SERVERS)
+
+# 任务准入控制：限制每个用户以及全局同时排队或生成中的任务数，
+# 避免用户反复点击生成按钮把重复任务堆进ComfyUI队列。
+# 名额按get_request_user计算：登录名，未启用登录时为gradio会话
+class ComfyUIAdmission:
+    def __init__(self, max_per_user, max_total):
+        self.max_per_user = max_per_user
+        self.max_total = max_total
+        self.pending = collections.Counter()  # 登录名或会话 -> 排队或生成中的任务数
+        self.total = 0
+        self._lock = threading.Lock()
+    
+    # 尝试占用一个任务名额，返回(是否允许, 拒绝原因)
+    def try_admit(self, user):
+        with self._lock:
+            if self.total >= self.max_total:
+                return False, f"当前排队任务已满（{self.total}/{self.max_total}），请稍后再试"
+            if self.pending[user] >= self.max_per_user:
+                return False, f"您已有 {self.pending[user]} 个任务在排队或生成中，请等待完成后再提交"
+            self.pending[user] += 1
+            self.total += 1
+            return True, None
+    
+    def release(self, user):
+        with self._lock:
+            if self.pending[user] > 0:
+                self.pending[user] -= 1
+                self.total -= 1
+            if self.pending[user] <= 0:
+                del self.pending[user]
+
+# 全局共享的任务准入控制
+comfyui_admission = ComfyUIAdmission(COMFYUI_MAX_PENDING_PER_USER, COMFYUI_MAX_PENDING_TOTAL)
+
+# 从gradio请求中识别用户：启用登录时使用登录名，否则使用gradio会话，
+# 不使用客户端地址或可伪造的代理转发头，同一NAT后的不同用户不会共用名额
+def get_request_user(request):
+    if request is None:
+        return "anonymous"
+    if getattr(request, "username", None):
+        return request.username
+    return request.session_hash or "anonymous"
+
+# 未启用登录时参数记录的所有者
+SHARED_PARAM_OWNER = "shared"
+
+# 参数记录和预设的所有者：启用登录时为登录名；未启用登录时gradio会话在每次刷新页面后都会变化，
+# 所有浏览器共用一份按界面保存的参数和预设，刷新后仍能恢复上次使用的参数
+def get_param_owner(request):
+    if request is not None and getattr(request, "username", None):
+        return request.username
+    return SHARED_PARAM_OWNER
+
+# 按gradio会话记录未完成任务的进度总线，页面关闭时据此取消任务
+class ComfyUISessionJobs:
+    def __init__(self):
+        self.sessions = {}  # session_hash -> set(ComfyUIProgressBus)
+        self._lock = threading.Lock()
+    
+    def add(self, session, bus):
+        with self._lock:
+            self.sessions.setdefault(session, set()).add(bus)
+    
+    def discard(self, session, bus):
+        with self._lock:
+            buses = self.sessions.get(session)
+            if buses is not None:
+                buses.discard(bus)
+                if not buses:
+                    del self.sessions[session]
+    
+    # 取消会话中所有未完成的任务，返回取消的任务数
+    def cancel(self, session):
+        with self._lock:
+            buses = self.sessions.pop(session, set())
+        for bus in buses:
+            bus.cancel()
+        return len(buses)
+
+# 全局共享的会话任务记录
+comfyui_session_jobs = ComfyUISessionJobs()
+
+# 页面关闭或会话断开时取消该会话所有未完成的任务
+def cancel_session_jobs(request: gr.Request):
+    if request is None:
+        return
+    count = comfyui_session_jobs.cancel(request.session_hash)
+    if count:
+        pool_log.info("会话 %s 已断开，取消 %s 个未完成的任务", request.session_hash, count)
+
+# 为生成按钮的处理函数加上准入控制：超过排队上限时只在最后一个输出（状态文字）显示原因，
+# 其余输出保持不变。处理函数通过传入的进度总线启动生成任务，
+# 处理函数结束、被取消按钮取消或页面关闭时取消仍在进行的任务，并释放名额
+def comfyui_admission_control(outputs_count):
+    def decorator(handler):
+        async def wrapper(request: gr.Request, *args, progress=gr.Progress()):
+            # 按登录名或会话计算名额，不按客户端地址，同一NAT后的用户互不占用名额
+            user = get_request_user(request)
+            admitted, message = comfyui_admission.try_admit(user)
+            if not admitted:
+                pool_log.warning("拒绝用户 %s 的新任务: %s", user, message)
+                yield tuple(gr.update() for _ in range(outputs_count - 1)) + (message,)
+                return
+            session = request.session_hash if request is not None else None
+            bus = ComfyUIProgressBus()
+            comfyui_session_jobs.add(session, bus)
+            results = handler(*args, bus=bus, user=get_param_owner(request), progress=progress)
+            try:
+                async for result in results:
+                    yield result
+            finally:
+                bus.cancel()
+                await results.aclose()
+                comfyui_session_jobs.discard(session, bus)
+                comfyui_admission.release(user)
+        wrapper.__name__ = handler.__name__
+        return wrapper
+    return decorator
+
+# 等待任务结束：在事件循环中等待任务的future，每隔5秒醒来一次，
+# 若WebSocket长时间没有消息则交给历史记录跟踪器兜底检查
+async def wait_for_comfyui_job(job, backend, ws_hub, progress=None, timeout=None):
+    start_time = time.time()
+    future = asyncio.wrap_future(job.future)
     try:
-        # 生成客户端ID
-        client_id = str(uuid.uuid4())
-        generated_images = []  # 存储所有生成的图像路径
-        generation_event = threading.Event()
-        
-        # 记录当前进度的变量
-        current_progress = {"value": 0.1, "message": "正在初始化..."}
-        
-        # 创建回调函数处理生成的图像
-        def on_image_generated(images):
-            if images:
-                print(f"处理生成的图像: 发现 {len(images)} 张图片")
-                
-                # 存储所有图像
-                all_saved_images = []
-                
-                for i, image_info in enumerate(images):
-                    filename = image_info["filename"]
-                    subfolder = image_info.get("subfolder", "")
-                    img_type = image_info.get("type", "output")
-                    
-                    # 构建图像URL
-                    image_url = f"http://{COMFYUI_SERVER}/view?filename={filename}&subfolder={subfolder}&type={img_type}"
-                    print(f"生成的图像 {i+1} URL: {image_url}")
-                    
-                    try:
-                        # 下载图像
-                        print(f"开始下载图像 {i+1}: {image_url}")
-                        response = requests.get(image_url)
-                        if response.status_code == 200:
-                            print(f"图像 {i+1} 下载成功，准备保存")
-                            # 确保output文件夹存在
-                            os.makedirs("output", exist_ok=True)
-                            
-                            # 使用时间戳创建文件名
-                            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                            output_filename = f"output/image_{timestamp}_{i+1}.png"
-                            
-                            # 保存图像
-                            image = Image.open(BytesIO(response.content))
-                            image.save(output_filename)
-                            all_saved_images.append(image)
-                            print(f"图像 {i+1} 已保存到: {output_filename}")
-                        else:
-                            print(f"图像 {i+1} 下载失败，状态码: {response.status_code}")
-                            print(response.text[:200] if len(response.text) > 200 else response.text)
-                    except Exception as e:
-                        print(f"下载图像 {i+1} 失败: {e}")
-                
-                # 更新生成的图像列表
-                generated_images.extend(all_saved_images)
-                
-                # 通知主线程图像已生成
-                generation_event.set()
+        while True:
+            # 任务还在排队时显示排队位置和预计等待时间，排队位置取自服务器共用的队列快照
+            if job.state == "pending" and progress is not None:
+                try:
+                    jobs_ahead = await backend.get_jobs_ahead(job.prompt_id)
+                    if jobs_ahead is not None:
+                        estimate = backend.estimate_wait(jobs_ahead)
+                        message = f"排队中: 前面还有 {jobs_ahead} 个任务"
+                        if estimate is not None:
+                            message += f"，预计等待约 {int(estimate)} 秒"
+                        progress(None, message)
+                except Exception as e:
+                    workflow_log.warning("查询队列位置失败: %s", e)
+            
+            wait_time = 5
+            if timeout is not None:
+                remaining = timeout - (time.time() - start_time)
+                if remaining <= 0:
+                    return None
+                wait_time = min(wait_time, remaining)
+            
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), wait_time)
+            except asyncio.TimeoutError:
+                pass
+            
+            # 如果WebSocket连接未建立或超过15秒没有收到消息，使用HTTP API检查状态
+            current_time = time.time()
+            if (not ws_hub.connection_successful or
+                    current_time - ws_hub.last_progress_time > 15):
+                workflow_log.debug("WebSocket连接可能不活跃，使用HTTP API检查状态")
+                backend.tracker.watch(job)
+                if progress is not None:
+                    elapsed = int(current_time - start_time)
+                    progress(None, f"正在生成图像... (HTTP检查，已等待{elapsed}秒)")
+    finally:
+        backend.tracker.unwatch(job)
+
+# 生成结果的输出存储：按日期分目录保存(output/YYYY/MM/DD)，文件以内容哈希和任务ID命名，
+# 相同内容只保存一份。文件先完整写入同目录下的临时文件，再通过硬链接发布，
+# 目标已存在时不会被覆盖，并发写入同一个目录也是安全的
+class ComfyUIOutputStore:
+    max_index_entries = 10000  # 内存中记录的内容哈希数量上限
+    
+    def __init__(self, root="output"):
+        self.root = root
+        self._index = collections.OrderedDict()  # sha256前16位(即文件名中的哈希) -> 已保存的文件路径
+        self._sources = collections.OrderedDict()  # 已保存的文件路径 -> 硬链接来源（ComfyUI的原文件）
+        self._lock = threading.Lock()
+    
+    # 当天的分片目录
+    def shard_dir(self):
+        now = datetime.datetime.now()
+        path = os.path.join(self.root, now.strftime("%Y"), now.strftime("%m"), now.strftime("%d"))
+        os.makedirs(path, exist_ok=True)
+        return path
+    
+    # 分片目录中的临时文件路径，以点开头，发布前不会被当作结果
+    def temp_path(self, ext):
+        return os.path.join(self.shard_dir(), f".{uuid.uuid4().hex}{ext}.tmp")
+    
+    # 查找相同内容已保存的文件
+    def lookup(self, digest):
+        key = digest[:16]
+        with self._lock:
+            path = self._index.get(key)
+            if path is not None:
+                self._index.move_to_end(key)
+        if path is not None and os.path.exists(path):
+            return path
+        return None
+    
+    def _remember(self, digest, path):
+        key = digest[:16]
+        with self._lock:
+            self._index[key] = path
+            self._index.move_to_end(key)
+            while len(self._index) > self.max_index_entries:
+                self._index.popitem(last=False)
+    
+    # 启动时从磁盘上以内容哈希命名的文件重建去重索引，按修改时间保留最新的文件，返回记录的数量
+    def rebuild_index(self):
+        if not os.path.isdir(self.root):
+            return 0
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                digest, sep, rest = name.partition("_")
+                if not sep or len(digest) != 16 or rest.startswith(".") or name.endswith(".tmp"):
+                    continue
+                try:
+                    int(digest, 16)
+                    path = os.path.join(dirpath, name)
+                    found.append((os.path.getmtime(path), digest, path))
+                except (ValueError, OSError):
+                    continue
+        found.sort()
+        for _, digest, path in found[-self.max_index_entries:]:
+            with self._lock:
+                self._index.setdefault(digest, path)
+                self._index.move_to_end(digest)
+        return len(found)
+    
+    def _final_path(self, digest, job_id, ext):
+        return os.path.join(self.shard_dir(), f"{digest[:16]}_{job_id[:8]}{ext}")
+    
+    # 发布已写完的临时文件，返回最终路径；相同内容已存在时删除临时文件并返回已有文件
+    def commit(self, temp_path, digest, job_id, ext):
+        try:
+            existing = self.lookup(digest)
+            if existing is not None:
+                return existing
+            final_path = self._final_path(digest, job_id, ext)
+            try:
+                os.link(temp_path, final_path)
+            except FileExistsError:
+                # 文件名包含内容哈希，已存在的文件内容相同
+                pass
+            except OSError:
+                # 文件系统不支持硬链接时直接改名
+                os.replace(temp_path, final_path)
+            self._remember(digest, final_path)
+            return final_path
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    
+    # 把本机上的文件以硬链接加入存储，不在同一文件系统时抛出OSError；
+    # 先比较设备号，跨文件系统时不读取文件内容计算哈希
+    def add_local(self, source, job_id):
+        os.makedirs(self.root, exist_ok=True)
+        if os.stat(source).st_dev != os.stat(self.root).st_dev:
+            raise OSError(f"{source} 与 {self.root} 不在同一文件系统")
+        hasher = hashlib.sha256()
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        existing = self.lookup(digest)
+        if existing is not None:
+            self._remember_source(existing, source)
+            return existing
+        final_path = self._final_path(digest, job_id, os.path.splitext(source)[1] or ".png")
+        try:
+            os.link(source, final_path)
+        except FileExistsError:
+            pass
+        self._remember(digest, final_path)
+        self._remember_source(final_path, source)
+        return final_path
+    
+    def _remember_source(self, path, source):
+        with self._lock:
+            self._sources[os.path.abspath(path)] = os.path.abspath(source)
+            while len(self._sources) > self.max_index_entries:
+                self._sources.popitem(last=False)
+    
+    # 输出文件的来源路径，不是从ComfyUI输出硬链接而来时返回None
+    def source_of(self, path):
+        with self._lock:
+            return self._sources.get(os.path.abspath(path))
+
+# 全局共享的输出存储
+comfyui_outputs = ComfyUIOutputStore()
+
+# 获取一张输出图像并存入输出存储，保留ComfyUI输出的原始文件格式，返回图像路径：
+# 能直接访问ComfyUI的输出文件时，与output文件夹在同一文件系统上则创建硬链接，
+# 否则直接使用ComfyUI的文件；都不行时才通过HTTP下载
+async def save_comfyui_output(backend, image_info, job_id):
+    filename = image_info["filename"]
+    ext = os.path.splitext(filename)[1] or ".png"
+    
+    local_path = await asyncio.to_thread(backend.resolve_local_file, image_info)
+    if local_path:
+        try:
+            output_filename = await asyncio.to_thread(comfyui_outputs.add_local, local_path, job_id)
+            workflow_log.debug("已为ComfyUI输出文件创建硬链接: %s -> %s", local_path, output_filename)
+            return output_filename
+        except OSError as e:
+            # temp文件夹会被ComfyUI清理，只有output中的文件可以直接使用
+            if image_info.get("type", "output") == "output":
+                workflow_log.debug("无法创建硬链接(%s)，直接使用ComfyUI输出文件: %s", e, local_path)
+                return local_path
+    
+    temp_path = await asyncio.to_thread(comfyui_outputs.temp_path, ext)
+    hasher = hashlib.sha256()
+    await backend.async_client.download(filename, temp_path, image_info.get("subfolder", ""),
+                                        image_info.get("type", "output"), hasher=hasher)
+    return await asyncio.to_thread(comfyui_outputs.commit, temp_path, hasher.hexdigest(), job_id, ext)
+
+# 读取PNG中的文本块（ComfyUI保存的prompt/workflow），只读取图像数据之前的块，不解码像素
+def read_png_text_chunks(path, keys=("prompt", "workflow")):
+    texts = {}
+    with open(path, "rb") as f:
+        if f.read(8) != b"\x89PNG\r\n\x1a\n":
+            return texts
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack(">I4s", header)
+            if chunk_type in (b"IDAT", b"IEND"):
+                break
+            if chunk_type not in (b"tEXt", b"iTXt"):
+                f.seek(length + 4, 1)
+                continue
+            data = f.read(length)
+            f.seek(4, 1)
+            key, _, value = data.partition(b"\0")
+            key = key.decode("latin-1")
+            if key not in keys:
+                continue
+            if chunk_type == b"tEXt":
+                texts[key] = value.decode("latin-1")
             else:
-                print("没有找到生成的图像")
-                generation_event.set()
+                # iTXt: 压缩标志、压缩方法、语言标签、翻译后的关键字、文本
+                compressed = value[:1] == b"\1"
+                _, _, value = value[2:].partition(b"\0")
+                _, _, value = value.partition(b"\0")
+                texts[key] = (zlib.decompress(value) if compressed else value).decode("utf-8")
+    return texts
+
+# 从工作流中提取种子、使用的模型和提示词，用于生成记录和提示词搜索
+def summarize_workflow(workflow):
+    seed = None
+    models = []
+    texts = []
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        for key, value in node.get("inputs", {}).items():
+            if isinstance(value, list):
+                # 节点之间的连线
+                continue
+            if key in ("seed", "noise_seed") and seed is None and isinstance(value, int):
+                seed = value
+            elif key.endswith("_name") and key != "sampler_name" and isinstance(value, str) and value != "None":
+                if value not in models:
+                    models.append(value)
+            elif key in ("text", "prompt", "text_g", "text_l") and isinstance(value, str) and value.strip():
+                texts.append(value.strip())
+    return seed, models, "\n".join(texts)
+
+# 生成记录索引(SQLite, WAL模式)：记录每个任务的界面、参数、种子、模型、prompt_id、
+# 各阶段时间和输出文件，并支持按提示词全文搜索（SQLite不支持FTS5时退化为LIKE查询）
+class GenerationIndex:
+    def __init__(self, db_path="generations.db"):
+        self.db_path = db_path
+        self.fts = True
+        self._conn = None
+        self._lock = threading.Lock()
+    
+    def _connect(self):
+        if self._conn is not None:
+            return self._conn
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                prompt_id TEXT UNIQUE,
+                tab TEXT,
+                status TEXT,
+                seed INTEGER,
+                models TEXT,
+                prompt_text TEXT,
+                params TEXT,
+                created_at REAL,
+                submitted_at REAL,
+                started_at REAL,
+                finished_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs(created_at);
+            CREATE TABLE IF NOT EXISTS outputs (
+                path TEXT PRIMARY KEY,
+                job_id INTEGER,
+                created_at REAL,
+                source TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_outputs_created ON outputs(created_at);
+            CREATE INDEX IF NOT EXISTS idx_outputs_job ON outputs(job_id);
+        """)
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS jobs_fts USING fts5(prompt_text)")
+        except sqlite3.OperationalError:
+            history_log.warning("SQLite不支持FTS5，提示词搜索使用LIKE查询")
+            self.fts = False
+        # 旧版本的输出表没有来源列
+        if "source" not in {row["name"] for row in conn.execute("PRAGMA table_info(outputs)")}:
+            conn.execute("ALTER TABLE outputs ADD COLUMN source TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outputs_source ON outputs(source)")
+        # 旧版本记录的是相对路径，统一转换为绝对路径，与清理文件时传入的路径一致
+        relative = [(self._path(row["path"]), row["path"]) for row in conn.execute("SELECT path FROM outputs")
+                    if not os.path.isabs(row["path"])]
+        if relative:
+            conn.executemany("UPDATE OR REPLACE outputs SET path = ? WHERE path = ?", relative)
+        conn.commit()
+        self._conn = conn
+        return conn
+    
+    # 输出文件在索引中统一使用绝对路径
+    @staticmethod
+    def _path(path):
+        return os.path.abspath(path)
+    
+    def _insert_job(self, conn, prompt_id, tab, status, workflow, created_at,
+                    submitted_at=None, started_at=None, finished_at=None):
+        seed, models, prompt_text = summarize_workflow(workflow)
+        # 同一prompt_id再次记录时原地更新，保留行号，输出记录和全文索引仍然指向同一任务
+        cursor = conn.execute(
+            "INSERT INTO jobs (prompt_id, tab, status, seed, models, prompt_text, params, "
+            "created_at, submitted_at, started_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(prompt_id) DO UPDATE SET tab = excluded.tab, status = excluded.status, "
+            "seed = excluded.seed, models = excluded.models, prompt_text = excluded.prompt_text, "
+            "params = excluded.params, submitted_at = excluded.submitted_at, "
+            "started_at = excluded.started_at, finished_at = excluded.finished_at",
+            (prompt_id, tab, status, seed, json.dumps(models, ensure_ascii=False), prompt_text,
+             json.dumps(workflow, ensure_ascii=False), created_at, submitted_at, started_at, finished_at))
+        if prompt_id is None:
+            job_id = cursor.lastrowid
+        else:
+            # 更新时lastrowid不可靠，按prompt_id取回行号
+            job_id = conn.execute("SELECT id FROM jobs WHERE prompt_id = ?", (prompt_id,)).fetchone()["id"]
+        if self.fts:
+            conn.execute("DELETE FROM jobs_fts WHERE rowid = ?", (job_id,))
+            conn.execute("INSERT INTO jobs_fts (rowid, prompt_text) VALUES (?, ?)", (job_id, prompt_text))
+        return job_id
+    
+    # 记录一个任务及其输出文件；sources为输出路径 -> 来源文件（ComfyUI的原文件），补录时跳过这些来源
+    def record(self, prompt_id, tab, status, workflow, outputs, submitted_at=None, started_at=None, finished_at=None,
+               sources=None):
+        sources = sources or {}
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                job_id = self._insert_job(conn, prompt_id, tab, status, workflow, submitted_at or time.time(),
+                                          submitted_at, started_at, finished_at)
+                now = time.time()
+                conn.executemany("INSERT OR REPLACE INTO outputs (path, job_id, created_at, source) VALUES (?, ?, ?, ?)",
+                                 [(self._path(path), job_id, now,
+                                   self._path(sources[path]) if sources.get(path) else None) for path in outputs])
+    
+    # 文件被清理后删除对应的输出记录，任务记录保留
+    def remove_outputs(self, paths):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany("DELETE FROM outputs WHERE path = ?", [(self._path(path),) for path in paths])
+    
+    # 最近生成且仍然存在的输出文件
+    def latest_output(self, limit=20):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT path FROM outputs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        for row in rows:
+            if os.path.exists(row["path"]):
+                return row["path"]
+        return None
+    
+    # 把用户输入的每个词转成FTS5字符串字面量，词之间为AND，引号、括号、冒号等不会被当作查询语法
+    @staticmethod
+    def _fts_query(query):
+        return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+    
+    # 按提示词搜索任务，返回任务信息和输出文件列表，最近的在前；查询无法解析时返回空列表
+    def search(self, query, limit=50):
+        query = query.strip()
+        if not query:
+            return []
+        with self._lock:
+            conn = self._connect()
+            try:
+                if self.fts:
+                    rows = conn.execute(
+                        "SELECT jobs.* FROM jobs_fts JOIN jobs ON jobs.id = jobs_fts.rowid "
+                        "WHERE jobs_fts MATCH ? ORDER BY jobs.created_at DESC LIMIT ?",
+                        (self._fts_query(query), limit)).fetchall()
+                else:
+                    rows = conn.execute(
+                        "SELECT * FROM jobs WHERE prompt_text LIKE ? ORDER BY created_at DESC LIMIT ?",
+                        (f"%{query}%", limit)).fetchall()
+            except sqlite3.OperationalError as e:
+                history_log.warning("搜索生成记录失败: %r, %s", query, e)
+                return []
+            results = []
+            for row in rows:
+                job = dict(row)
+                job["models"] = json.loads(job["models"] or "[]")
+                job["params"] = json.loads(job["params"] or "{}")
+                job["outputs"] = [r["path"] for r in conn.execute(
+                    "SELECT path FROM outputs WHERE job_id = ? ORDER BY created_at", (row["id"],))]
+                results.append(job)
+        return results
+    
+    # 把目录中尚未记录的PNG补录到索引，参数从ComfyUI写入的prompt文本块读取，返回补录数量
+    def backfill(self, directory):
+        if not os.path.isdir(directory):
+            return 0
+        with self._lock:
+            # 已记录的输出和它们的来源文件都不再补录，硬链接到output的ComfyUI原图不会被记录两次
+            known = set()
+            for row in self._connect().execute("SELECT path, source FROM outputs"):
+                known.add(row["path"])
+                if row["source"]:
+                    known.add(row["source"])
+        count = 0
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for file in files:
+                if not file.lower().endswith(".png"):
+                    continue
+                path = self._path(os.path.join(root, file))
+                if path in known:
+                    continue
+                try:
+                    prompt_text = read_png_text_chunks(path, ("prompt",)).get("prompt")
+                    workflow = json.loads(prompt_text) if prompt_text else {}
+                    created_at = os.path.getmtime(path)
+                except Exception as e:
+                    history_log.warning("读取图像信息失败: %s, %s", path, e)
+                    continue
+                with self._lock:
+                    conn = self._connect()
+                    with conn:
+                        job_id = self._insert_job(conn, None, "backfill", "success", workflow, created_at,
+                                                  finished_at=created_at)
+                        conn.execute("INSERT OR REPLACE INTO outputs (path, job_id, created_at) VALUES (?, ?, ?)",
+                                     (path, job_id, created_at))
+                count += 1
+        return count
+
+# 全局共享的生成记录索引
+generation_index = GenerationIndex()
+
+# 在线程池中记录任务，不阻塞事件循环，记录失败不影响生成结果
+def record_generation(job, tab, workflow, outputs, submitted_at):
+    if job is None or not job.submitted:
+        return
+    def record():
+        try:
+            generation_index.record(job.prompt_id, tab, job.state, workflow, outputs,
+                                    submitted_at, job.started_at, time.time(),
+                                    sources={path: comfyui_outputs.source_of(path) for path in outputs})
+        except Exception as e:
+            workflow_log.warning("记录生成结果失败: %s", e)
+    asyncio.get_running_loop().run_in_executor(None, record)
+
+# 输出文件夹监视器：增量记录各文件夹中最新的图像，并按提交前写入SaveImage文件名前缀的
+# 任务标记把ComfyUI新输出的文件归属到等待中的任务，出错兜底时不再遍历整个目录
+class OutputWatcher:
+    image_extensions = (".png", ".jpg", ".jpeg", ".webp")
+    poll_interval = 5  # 轮询间隔（秒），只在没有watchdog时使用
+    full_scan_every = 60  # 轮询时每隔多少次检查一遍所有子目录，其余时候只检查当前活跃的子目录
+    max_attributed_jobs = 200  # 最多保留归属记录的任务数
+    
+    def __init__(self):
+        self.directories = {}  # 监视的目录 -> 是否把新文件归属到任务
+        self.latest_by_folder = {}  # 文件夹 -> 最新图像路径
+        self.latest_path = None
+        self.expected = {}  # 任务标记 -> job
+        self.attributed = collections.OrderedDict()  # prompt_id -> 归属到该任务的文件
+        self._dir_mtimes = {}
+        self._dir_entries = {}  # 目录 -> (文件名集合, 子目录列表, 最近修改的子目录)
+        self._lock = threading.Lock()
+        self._observer = None
+        self._thread = None
+    
+    def watch(self, directory, attribute=False):
+        self.directories[os.path.abspath(directory)] = attribute
+    
+    def start(self):
+        directories = [d for d in self.directories if os.path.isdir(d)]
+        if not directories:
+            return
+        if Observer is not None:
+            self._observer = Observer()
+            for directory in directories:
+                self._observer.schedule(_OutputEventHandler(self), directory, recursive=True)
+            self._observer.daemon = True
+            self._observer.start()
+            history_log.info("使用文件系统通知监视输出文件夹: %s", ", ".join(directories))
+        else:
+            self._thread = threading.Thread(target=self._run_polling, name="output-watcher", daemon=True)
+            self._thread.start()
+            history_log.info("未安装watchdog，每%s秒轮询输出文件夹中当前活跃的子目录: %s",
+                             self.poll_interval, ", ".join(directories))
+    
+    # 解析SaveImage的文件名前缀：连接到其他节点（如简易字符串）时取该节点的字符串值
+    @staticmethod
+    def _resolve_prefix(workflow, prefix):
+        if isinstance(prefix, list) and prefix:
+            source = workflow.get(str(prefix[0]))
+            inputs = source.get("inputs", {}) if isinstance(source, dict) else {}
+            prefix = next((inputs[key] for key in ("string", "text", "value") if isinstance(inputs.get(key), str)), None)
+        return prefix if isinstance(prefix, str) and prefix else "ComfyUI"
+    
+    # 提交前在每个SaveImage节点的文件名前缀后加上该任务唯一的标记并登记任务，
+    # 返回写入标记后的工作流（只复制被修改的节点）；没有SaveImage节点时不登记
+    def expect(self, job, workflow):
+        tag = uuid.uuid4().hex[:12]
+        patched = dict(workflow)
+        save_nodes = [node_id for node_id, node in workflow.items()
+                      if isinstance(node, dict) and "filename_prefix" in node.get("inputs", {})]
+        if not save_nodes:
+            return workflow
+        for node_id in save_nodes:
+            node = workflow[node_id]
+            prefix = self._resolve_prefix(workflow, node["inputs"]["filename_prefix"])
+            patched[node_id] = {**node, "inputs": {**node["inputs"], "filename_prefix": f"{prefix}_{tag}"}}
+        with self._lock:
+            self.expected[tag] = job
+        return patched
+    
+    def forget(self, job):
+        with self._lock:
+            for tag in [tag for tag, expected_job in self.expected.items() if expected_job is job]:
+                del self.expected[tag]
+    
+    def latest_for_job(self, prompt_id):
+        with self._lock:
+            paths = self.attributed.get(prompt_id)
+            return paths[-1] if paths else None
+    
+    def latest(self):
+        return self.latest_path
+    
+    def _attribute_dir(self, path):
+        for directory, attribute in self.directories.items():
+            if attribute and path.startswith(directory + os.sep):
+                return True
+        return False
+    
+    # 记录一个新文件：更新所在文件夹的最新图像，文件名带有任务标记时归属到该任务
+    def add(self, path):
+        name = os.path.basename(path)
+        if name.startswith(".") or not name.lower().endswith(self.image_extensions):
+            return
+        path = os.path.abspath(path)
+        with self._lock:
+            self.latest_by_folder[os.path.dirname(path)] = path
+            self.latest_path = path
+            if not self._attribute_dir(path):
+                return
+            # ComfyUI保存的文件名为"前缀_计数器_.png"，标记在前缀末尾
+            job = next((job for tag, job in self.expected.items() if f"_{tag}_" in name), None)
+            if job is None:
+                return
+            self.attributed.setdefault(job.prompt_id, []).append(path)
+            self.attributed.move_to_end(job.prompt_id)
+            while len(self.attributed) > self.max_attributed_jobs:
+                self.attributed.popitem(last=False)
+    
+    # 轮询：每次只检查目录自身的修改时间，只有发生变化的目录才重新列出文件；
+    # 平时只沿着最近修改的子目录（当前的日期文件夹）向下检查，定期才检查全部子目录，
+    # 避免每次轮询都遍历整个输出目录（尤其是\\wsl$共享）
+    def _run_polling(self):
+        polls = 0
+        while True:
+            full_scan = polls % self.full_scan_every == 0
+            for directory in list(self.directories):
+                self._poll_directory(directory, polls == 0, full_scan)
+            polls += 1
+            time.sleep(self.poll_interval)
+    
+    def _poll_directory(self, directory, first_scan, full_scan=True):
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return
+        names, subdirs, active = self._dir_entries.get(directory, (set(), [], None))
+        if self._dir_mtimes.get(directory) != mtime:
+            self._dir_mtimes[directory] = mtime
+            new_names = set()
+            new_subdirs = []
+            active, active_mtime = None, None
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.is_dir():
+                            new_subdirs.append(entry.path)
+                            subdir_mtime = entry.stat().st_mtime
+                            if active_mtime is None or subdir_mtime > active_mtime:
+                                active, active_mtime = entry.path, subdir_mtime
+                        else:
+                            new_names.add(entry.name)
+                            # 首次扫描只建立基准，之后出现的文件才是新文件
+                            if not first_scan and entry.name not in names:
+                                self.add(entry.path)
+            except OSError:
+                return
+            names, subdirs = new_names, new_subdirs
+            self._dir_entries[directory] = (names, subdirs, active)
+        # 首次扫描之后新出现的子目录，其中的文件也都是新文件
+        for subdir in (subdirs if full_scan else [active] if active else []):
+            self._poll_directory(subdir, first_scan, full_scan)
+
+# watchdog事件：新建或移动到监视目录中的文件
+class _OutputEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+    
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watcher.add(event.src_path)
+    
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.watcher.add(event.dest_path)
+
+# 全局共享的输出文件夹监视器：ComfyUI的输出文件夹用于归属任务，本地output文件夹只记录最新图像
+output_watcher = OutputWatcher()
+output_watcher.watch(os.path.join(WSL_COMFYUI_PATH, "output"), attribute=True)
+output_watcher.watch("output")
+
+# 单个文件夹的保留策略：超过max_age_days的文件先被清理，总大小仍超过max_bytes时
+# 按order指定的顺序继续清理（"age"最旧的优先，"lru"最久未使用的优先）；
+# prefixes不为空时只清理以这些前缀开头的文件，match不为空时只清理文件名使其返回True的文件，
+# min_age秒内的新文件不清理
+class RetentionPolicy:
+    def __init__(self, directory, max_bytes=0, max_age_days=0, prefixes=None, order="age",
+                 recursive=False, min_age=3600, on_evict=None, match=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.prefixes = tuple(prefixes) if prefixes else None
+        self.match = match
+        self.order = order
+        self.recursive = recursive
+        self.min_age = min_age
+        self.on_evict = on_evict  # 删除文件后的回调，参数为被删除的路径列表
+
+# 文件保留管理：后台线程定期按各文件夹的策略清理文件并统计占用，
+# 正在排队或生成中的任务使用的文件会被固定，不会被清理
+class RetentionManager:
+    sweep_interval = 600  # 清理间隔（秒）
+    
+    def __init__(self):
+        self.policies = []
+        self.usage = {}  # 文件夹 -> {"files": 文件数, "bytes": 总大小, "evicted": 上次清理的文件数}
+        self._pins = collections.Counter()
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def add_policy(self, policy):
+        self.policies.append(policy)
+    
+    def pin(self, paths):
+        with self._lock:
+            for path in paths:
+                self._pins[os.path.abspath(path)] += 1
+    
+    def unpin(self, paths):
+        with self._lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                self._pins[path] -= 1
+                if self._pins[path] <= 0:
+                    del self._pins[path]
+    
+    # 记录文件被使用，用于"lru"顺序
+    def touch(self, path):
+        with self._lock:
+            self._last_used[os.path.abspath(path)] = time.time()
+    
+    # 固定工作流中LoadImage节点引用的input文件，返回固定的路径列表，任务结束后需要unpin
+    def pin_workflow_inputs(self, workflow, input_dir):
+        if not input_dir:
+            return []
+        paths = []
+        for node in workflow.values():
+            if isinstance(node, dict) and node.get("class_type") == "LoadImage":
+                image = node.get("inputs", {}).get("image")
+                if isinstance(image, str):
+                    paths.append(os.path.join(input_dir, image))
+        self.pin(paths)
+        for path in paths:
+            self.touch(path)
+        return paths
+    
+    def _scan(self, policy):
+        files = []
+        directories = [policy.directory]
+        while directories:
+            directory = directories.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            # 隐藏目录（如预览图缓存）由各自的策略管理
+                            if policy.recursive and not entry.name.startswith("."):
+                                directories.append(entry.path)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            files.append((os.path.abspath(entry.path), entry.name, stat.st_size, stat.st_mtime))
+            except OSError:
+                continue
+        return files
+    
+    # 按策略清理一个文件夹，返回(文件数, 总大小, 清理的文件数)
+    def _sweep_policy(self, policy):
+        files = self._scan(policy)
+        total = sum(size for _, _, size, _ in files)
+        now = time.time()
+        with self._lock:
+            pins = set(self._pins)
+            last_used = dict(self._last_used)
+        
+        candidates = [f for f in files
+                      if f[0] not in pins and now - f[3] >= policy.min_age
+                      and (policy.prefixes is None or f[1].startswith(policy.prefixes))
+                      and (policy.match is None or policy.match(f[1]))]
+        if policy.order == "lru":
+            candidates.sort(key=lambda f: max(f[3], last_used.get(f[0], 0)))
+        else:
+            candidates.sort(key=lambda f: f[3])
+        
+        evicted = []
+        for path, name, size, mtime in candidates:
+            expired = policy.max_age_days and now - mtime > policy.max_age_days * 86400
+            over_quota = policy.max_bytes and total > policy.max_bytes
+            if not expired and not over_quota:
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                retention_log.warning("清理文件失败: %s, %s", path, e)
+                continue
+            total -= size
+            evicted.append(path)
+        
+        if evicted:
+            with self._lock:
+                for path in evicted:
+                    self._last_used.pop(path, None)
+            if policy.on_evict:
+                try:
+                    policy.on_evict(evicted)
+                except Exception as e:
+                    retention_log.warning("清理文件后的处理失败: %s", e)
+        return len(files) - len(evicted), total, len(evicted)
+    
+    def sweep(self):
+        for policy in self.policies:
+            if not os.path.isdir(policy.directory):
+                continue
+            count, total, evicted = self._sweep_policy(policy)
+            self.usage[policy.directory] = {"files": count, "bytes": total, "evicted": evicted}
+            # 占用情况只写入调试日志，有文件被清理时才记录为info，不输出到控制台
+            level = logging.INFO if evicted else logging.DEBUG
+            if retention_log.isEnabledFor(level):
+                quota = f"{policy.max_bytes // (1024 * 1024)} MB" if policy.max_bytes else "不限"
+                retention_log.log(level, "文件夹占用: %s - %s 个文件，%.1f MB（上限 %s），本次清理 %s 个",
+                                  policy.directory, count, total / (1024 * 1024), quota, evicted)
+    
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                retention_log.error("清理文件夹时出错: %s", e, exc_info=True)
+            time.sleep(self.sweep_interval)
+    
+    def start(self):
+        if not self.policies or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+# 本程序按内容哈希命名上传的input图片：前缀_哈希前16位.扩展名（见upload_input_image）。
+# 用户原有的图片和工作流模板默认引用的图片（如image_20250630_102440.png）不符合该格式
+def is_hashed_input_upload(name):
+    stem = os.path.splitext(name)[0]
+    prefix, sep, digest = stem.rpartition("_")
+    if prefix not in ("upload", "pose", "image", "fr_input") or len(digest) != 16:
+        return False
+    return all(c in "0123456789abcdef" for c in digest)
+
+# 全局共享的文件保留管理：
+# ComfyUI input文件夹只清理本程序按内容哈希命名上传的图片，output文件夹清理后同步删除生成记录中的输出
+retention_manager = RetentionManager()
+retention_manager.add_policy(RetentionPolicy(
+    os.path.join(WSL_COMFYUI_PATH, "input"),
+    max_bytes=int(COMFYUI_INPUT_QUOTA_MB * 1024 * 1024),
+    max_age_days=COMFYUI_INPUT_MAX_AGE_DAYS,
+    match=is_hashed_input_upload,
+    order="lru"))
+retention_manager.add_policy(RetentionPolicy(
+    "output",
+    max_bytes=int(COMFYUI_OUTPUT_QUOTA_MB * 1024 * 1024),
+    max_age_days=COMFYUI_OUTPUT_MAX_AGE_DAYS,
+    recursive=True,
+    on_evict=generation_index.remove_outputs))
+retention_manager.add_policy(RetentionPolicy(
+    os.path.join("output", ".previews"),
+    max_bytes=int(COMFYUI_PREVIEW_QUOTA_MB * 1024 * 1024),
+    recursive=True,
+    order="lru",
+    min_age=600))
+
+# 界面显示用的压缩预览图：长边不超过display_preview_size，保存为WebP，
+# 按原图路径缓存在output/.previews中，原图更新后重新生成；原图足够小时直接使用原图
+display_preview_size = 1280
+display_preview_quality = 82
+
+def make_display_preview(path):
+    if not path or not os.path.exists(path):
+        return path
+    try:
+        key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+        preview_dir = os.path.join("output", ".previews", key[:2])
+        preview_path = os.path.join(preview_dir, f"{key[2:20]}.webp")
+        if os.path.exists(preview_path) and os.path.getmtime(preview_path) >= os.path.getmtime(path):
+            retention_manager.touch(preview_path)
+            return preview_path
+        
+        with Image.open(path) as img:
+            if max(img.size) <= display_preview_size and os.path.getsize(path) <= 2 * 1024 * 1024:
+                return path
+            # JPEG可以在解码时直接按比例缩小，减少解码开销
+            img.draft("RGB", (display_preview_size, display_preview_size))
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+            img.thumbnail((display_preview_size, display_preview_size), Image.LANCZOS)
+            os.makedirs(preview_dir, exist_ok=True)
+            temp_path = f"{preview_path}.{uuid.uuid4().hex}.tmp"
+            img.save(temp_path, "WEBP", quality=display_preview_quality, method=4)
+        os.replace(temp_path, preview_path)
+        return preview_path
+    except Exception as e:
+        workflow_log.warning("生成预览图失败: %s，直接显示原图", e)
+        return path
+
+# 生成结果在界面上的显示：图像组件显示压缩预览图，文件组件提供原图下载
+async def prepare_result_display(path):
+    if not path:
+        return None, None
+    preview_path = await asyncio.to_thread(make_display_preview, path)
+    return preview_path, path
+
+# 发送工作流到ComfyUI并获取结果，返回保存后的图像路径（return_all_images时为路径列表）
+async def send_workflow_to_comfyui(workflow_data, progress=None, return_all_images=False, input_image_path=None, preview=None, backend=None, tab=None):
+    ws_hub = None
+    job = None
+    workflow_copy = workflow_data
+    submitted_at = None
+    pinned_inputs = []  # 固定的input文件，任务结束前不会被清理
+    generated_images = []  # 存储所有生成图像的保存路径
+    # 未指定服务器时选择队列最短的ComfyUI服务器
+    if backend is None:
+        backend = comfyui_pool.select()
+    comfyui_pool.acquire(backend)
+    try:
+        # 并行下载并保存生成的图像，每张下载完成后立即交给进度总线，界面不必等所有图像下载完；
+        # 返回的结果按输出顺序排列，下载失败的图像跳过
+        async def on_image_generated(images):
+            workflow_log.debug("处理生成的图像: 发现 %s 张图片", len(images))
+            saved = [None] * len(images)
+            
+            async def download(i, image_info):
+                try:
+                    workflow_log.debug("开始下载图像 %s: %s", i+1, image_info["filename"])
+                    return i, await save_comfyui_output(backend, image_info, job.prompt_id)
+                except httpx.HTTPStatusError as e:
+                    workflow_log.warning("图像 %s 下载失败，状态码: %s", i+1, e.response.status_code)
+                except Exception as e:
+                    workflow_log.warning("下载图像 %s 失败: %s", i+1, e)
+                return i, None
+            
+            downloads = [download(i, image_info) for i, image_info in enumerate(images)]
+            for finished, next_done in enumerate(asyncio.as_completed(downloads), 1):
+                i, path = await next_done
+                if path is not None:
+                    saved[i] = path
+                    workflow_log.info("图像 %s 已保存到: %s", i+1, path)
+                    if preview is not None:
+                        preview.add_result(i, path)
+                if len(images) > 1:
+                    on_progress_update(None, f"正在下载生成的图像: {finished}/{len(images)}")
+            generated_images.extend(path for path in saved if path is not None)
         
         # 创建进度回调函数
         def on_progress_update(value, message):
-            nonlocal current_progress
-            current_progress["value"] = value
-            current_progress["message"] = message
-            
-            print(f"WebSocket接收到进度更新: {value:.2f} - {message}")
             if progress is not None:
                 try:
                     progress(value, message)
-                    print(f"UI进度已更新: {value:.2f}")
                 except Exception as e:
-                    print(f"更新UI进度失败: {e}")
+                    workflow_log.warning("更新UI进度失败: %s", e)
         
-        # 更新进度 - 10%
         if progress is not None:
-            progress(0.1, "正在连接ComfyUI...")
-        
-        # ComfyUI API地址
-        api_url = f"http://{COMFYUI_SERVER}/api/prompt"
-        
-        # 使用深度复制避免修改原始数据
-        workflow_copy = copy.deepcopy(workflow_data)
+            progress(None, "正在连接ComfyUI...")
         
         # 处理输入图像路径，如果提供了
         if input_image_path and os.path.exists(input_image_path):
-            print(f"处理工作流中的输入图像: {input_image_path}")
-            # 获取文件名（不包含路径）
-            filename = os.path.basename(input_image_path)
-            
-            # 检查所有可能包含图像路径的节点
-            for node_id, node_data in workflow_copy.items():
-                if "inputs" in node_data:
-                    # LoadImage节点检查
-                    if "image" in node_data["inputs"] and "class_type" in node_data and node_data["class_type"] == "LoadImage":
-                        node_data["inputs"]["image"] = filename
-                        print(f"已将图像文件名 {filename} 设置到节点 {node_id} 的image字段")
-        
-        # 准备API请求数据
-        prompt_data = {
-            "prompt": workflow_copy,
-            "client_id": client_id
-        }
+            workflow_log.debug("处理工作流中的输入图像: %s", input_image_path)
+            # 上传到ComfyUI（已在input文件夹中或已上传过的图片直接使用文件名）
+            filename = await asyncio.to_thread(backend.client.upload_input_image, input_image_path)
+            
+            # 按补丁计划写入图像加载节点，不修改传入的工作流
+            workflow_copy, image_nodes = apply_workflow_input_image(workflow_data, filename, tab)
+            workflow_log.debug("已将图像文件名 %s 设置到节点 %s 的image字段", filename, image_nodes)
+        
+        # 任务结束前固定工作流引用的input文件，避免被清理
+        pinned_inputs = retention_manager.pin_workflow_inputs(workflow_copy, backend.client.input_dir)
+        
+        # 服务器熔断期间直接失败，不再等待连接和执行
+        if not backend.breaker.allow():
+            raise ComfyUIExecutionError(f"ComfyUI服务器不可用: {backend.server}，请稍后重试")
+        
+        # 提交前先在共享WebSocket上登记任务，避免漏掉执行事件
+        # prompt_id由客户端预先生成，收到的事件可以直接对应到任务
+        ws_hub = await asyncio.to_thread(backend.get_websocket)
+        client_id = ws_hub.client_id
+        job = ComfyUIJob(str(uuid.uuid4()), on_progress_update, preview.push if preview else None)
+        ws_hub.register(job)
+        if preview is not None:
+            preview.job = job
+        # 在输出文件名前缀中写入任务标记，出错兜底时只查找该任务自己的输出
+        workflow_copy = output_watcher.expect(job, workflow_copy)
         
         # 发送工作流并获取提示ID
-        print(f"发送工作流到ComfyUI... ClientID: {client_id}")
+        workflow_log.debug("发送工作流到ComfyUI... ClientID: %s", client_id)
         
-        response = requests.post(api_url, json=prompt_data)
+        response = await backend.async_client.submit_prompt(workflow_copy, client_id, job.prompt_id)
         
         if response.status_code != 200:
-            print(f"提交工作流失败: {response.status_code}")
-            print(response.text)
+            workflow_log.warning("提交工作流失败: %s，响应: %s", response.status_code, response.text)
             if progress is not None:
                 progress(1.0, "提交工作流失败，尝试查找最新图像...")
-            return find_latest_image()
+            return await asyncio.to_thread(find_latest_image, job)
             
+        # 旧版本ComfyUI会忽略客户端指定的prompt_id，以服务器返回的为准
         prompt_id = response.json()["prompt_id"]
-        print(f"成功提交工作流，Prompt ID: {prompt_id}")
+        if prompt_id != job.prompt_id:
+            ws_hub.rekey(job, prompt_id)
+        job.submitted = True
+        comfyui_pool.mark_submitted(backend, prompt_id)
+        submitted_at = time.time()
+        workflow_log.info("成功提交工作流，Prompt ID: %s", prompt_id)
         
-        # 更新进度 - 15%
         if progress is not None:
-            progress(0.15, "工作流已提交，正在建立WebSocket连接...")
+            progress(None, "工作流已提交，等待ComfyUI执行...")
         
-        # 检查队列状态，确认工作流已入队
-        queue_response = requests.get(f"http://{COMFYUI_SERVER}/api/queue")
-        queue_data = queue_response.json()
-        print(f"队列状态: {queue_data}")
+        # 等待工作流执行完成，无超时限制
+        workflow_log.debug("开始等待工作流执行，无超时限制")
+        images = await wait_for_comfyui_job(job, backend, ws_hub, progress)
+        if job.started_at is not None and job.state == "success":
+            backend.record_duration(time.time() - job.started_at)
         
-        # 创建并启动WebSocket连接
-        print(f"创建WebSocket连接，客户端ID: {client_id}")
-        ws_client = ComfyUIWebSocket(client_id, prompt_id, on_image_generated, on_progress_update)
-        ws_client.start()
-        
-        # 等待一会儿确保WebSocket连接建立
-        print("等待WebSocket连接建立...")
-        time.sleep(2)
-        
-        # 设置超时时间为10分钟，兼容低配置电脑
-        timeout = 600  # 10分钟
-
-        # 等待工作流执行完成
-        start_time = time.time()
-        websocket_check_time = time.time()
-        progress_update_time = time.time()
-        
-        # 显示进度
-        print(f"开始等待工作流执行，无超时限制")
-        while not generation_event.is_set():
-            current_time = time.time()
-            
-            # 每5秒检查一次WebSocket连接状态，如果WebSocket没有响应则使用HTTP API检查状态
-            if current_time - websocket_check_time > 5:
-                websocket_check_time = current_time
-                
-                # 如果WebSocket连接建立但超过15秒没有收到消息，使用HTTP API检查状态（从原来的10秒增加）
-                if (not ws_client.connection_successful or 
-                    (ws_client.last_progress_time > 0 and current_time - ws_client.last_progress_time > 15)):
-                    print("WebSocket连接可能不活跃，使用HTTP API检查状态")
-                    try:
-                        # 检查队列状态
-                        status_response = requests.get(f"http://{COMFYUI_SERVER}/api/queue")
-                        queue_data = status_response.json()
-                        is_executing = bool(queue_data.get("queue_running"))
-                        print(f"HTTP API检查 - 队列状态: {'正在执行' if is_executing else '空队列'}")
-                        
-                        # 检查历史记录中是否有我们的工作流
-                        history_response = requests.get(f"http://{COMFYUI_SERVER}/api/history")
-                        if history_response.status_code == 200:
-                            history_data = history_response.json()
-                            if prompt_id in history_data:
-                                print(f"在历史记录中找到工作流: {prompt_id}")
-                                
-                                # 检查是否已完成
-                                prompt_info = history_data[prompt_id]
-                                if "outputs" in prompt_info:
-                                    outputs = prompt_info["outputs"]
-                                    
-                                    # 查找所有输出节点
-                                    for node_id, node_output in outputs.items():
-                                        if "images" in node_output:
-                                            images = []
-                                            for img_data in node_output["images"]:
-                                                img_info = {
-                                                    "filename": img_data["filename"],
-                                                    "subfolder": img_data.get("subfolder", ""),
-                                                    "type": "output"
-                                                }
-                                                images.append(img_info)
-                                                
-                                            if images:
-                                                print(f"从历史记录中找到 {len(images)} 张图像")
-                                                on_image_generated(images)
-                                                break
-                                
-                                # 如果在历史记录中但没有输出，说明正在执行
-                                elapsed = current_time - start_time
-                                if not generation_event.is_set():
-                                    # 使用经过的时间作为简单进度估计
-                                    progress_percent = min(0.8, 0.25 + (elapsed / 300) * 0.55)  # 假设最长需要5分钟
-                                    if progress is not None and not ws_client.execution_completed:
-                                        progress(progress_percent, f"正在生成图像... (HTTP检查)")
-                    except Exception as e:
-                        print(f"HTTP API检查失败: {e}")
-                        import traceback
-                        traceback.print_exc()
-            
-            # 每0.5秒从当前进度变量更新一次UI，确保UI总能得到更新
-            if current_time - progress_update_time > 0.5:
-                progress_update_time = current_time
-                if progress is not None and current_progress["value"] > 0.15:
-                    try:
-                        progress(current_progress["value"], current_progress["message"])
-                        print(f"定期更新UI进度: {current_progress['value']:.2f} - {current_progress['message']}")
-                    except Exception as e:
-                        print(f"定期更新UI进度失败: {e}")
-            
-            time.sleep(0.1)
-            
-        # 如果已过超时时间但还未收到图像
-        if not generation_event.is_set():
-            print("等待超时，尝试最后一次获取图像")
-            
-            # 尝试通过HTTP API获取最新的历史记录
+        # 完全命中缓存时可能收不到executed事件，从历史记录补充输出
+        if not images:
             try:
-                print("尝试通过HTTP API查询历史记录获取图像")
-                history_response = requests.get(f"http://{COMFYUI_SERVER}/api/history")
-                if history_response.status_code == 200:
-                    history_data = history_response.json()
-                    if prompt_id in history_data:
-                        print(f"在历史记录中找到工作流: {prompt_id}")
-                        
-                        # 检查输出
-                        prompt_info = history_data[prompt_id]
-                        if "outputs" in prompt_info:
-                            outputs = prompt_info["outputs"]
-                            
-                            # 查找所有输出节点
-                            for node_id, node_output in outputs.items():
-                                if "images" in node_output:
-                                    images = []
-                                    for img_data in node_output["images"]:
-                                        img_info = {
-                                            "filename": img_data["filename"],
-                                            "subfolder": img_data.get("subfolder", ""),
-                                            "type": "output"
-                                        }
-                                        images.append(img_info)
-                                        
-                                    if images:
-                                        print(f"从历史记录中找到 {len(images)} 张图像")
-                                        on_image_generated(images)
-                                        generation_event.set()
-                                        break
+                images = await fetch_history_images_async(backend.async_client, prompt_id) or []
             except Exception as e:
-                print(f"通过HTTP API查询历史记录失败: {e}")
-            
-            if not generation_event.is_set():
-                if progress is not None:
-                    progress(0.95, "等待超时，尝试查找最新保存的图像...")
-                result = find_latest_image()
-                if return_all_images and result:
-                    generated_images.append(result)
-                
-        # 确保WebSocket已关闭
-        print("关闭WebSocket连接")
-        if ws_client.running:
-            ws_client.close()
+                workflow_log.warning("通过HTTP API查询历史记录失败: %s", e)
+        
+        if images:
+            await on_image_generated(images)
         
         # 返回结果图像
         if generated_images:
             if return_all_images:
-                print(f"返回所有 {len(generated_images)} 张生成的图像")
+                workflow_log.debug("返回所有 %s 张生成的图像", len(generated_images))
                 return generated_images
             else:
-                print("返回第一张生成的图像")
+                workflow_log.debug("返回第一张生成的图像")
                 return generated_images[0]
         else:
-            print("没有图像生成，返回None")
+            workflow_log.debug("没有图像生成，返回None")
             return None
+    
+    except asyncio.CancelledError:
+        # 用户取消或页面关闭：从ComfyUI队列中删除或中断该任务，不再占用GPU
+        if job is not None and not job.done:
+            job.fail("interrupted", "任务已被取消")
+            try:
+                await backend.cancel_prompt(job.prompt_id)
+            except Exception as e:
+                workflow_log.warning("取消ComfyUI任务失败: %s", e)
+        raise
+    
+    except ComfyUIExecutionError as e:
+        workflow_log.warning("工作流执行失败: %s", e)
+        if progress is not None:
+            progress(1.0, f"工作流执行失败: {e}")
+        return [] if return_all_images else None
         
     except Exception as e:
-        print(f"与ComfyUI接口通信错误: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        # 记录到日志文件
-        logging.error(f"与ComfyUI接口通信错误: {str(e)}")
-        logging.error(traceback.format_exc())
+        workflow_log.error("与ComfyUI接口通信错误: %s", e, exc_info=True)
         # 更新进度 - 错误状态
         if progress is not None:
             progress(1.0, f"错误: {str(e)}")
-        # 出错时尝试查找最近保存的图像
-        latest_image = find_latest_image()
+        # 出错时尝试查找该任务已经保存的图像，任务还未创建时不查找
+        latest_image = await asyncio.to_thread(find_latest_image, job) if job is not None else None
         if return_all_images and latest_image:
             return [latest_image]
         return latest_image
+    
+    finally:
+        # 任务结束后从共享WebSocket上注销，连接本身保持复用
+        if ws_hub is not None and job is not None:
+            ws_hub.unregister(job)
+        if job is not None:
+            output_watcher.forget(job)
+        retention_manager.unpin(pinned_inputs)
+        comfyui_pool.release(backend, job.prompt_id if job is not None else None)
+        record_generation(job, tab, workflow_copy, generated_images, submitted_at)
 
 # 发送图生图工作流到ComfyUI并获取结果
-def send_img2img_workflow_to_comfyui(workflow_data, input_image_path=None, progress=None):
+async def send_img2img_workflow_to_comfyui(workflow_data, input_image_path=None, progress=None, preview=None, backend=None, tab="img2img"):
+    ws_hub = None
+    job = None
+    workflow_copy = workflow_data
+    submitted_at = None
+    pinned_inputs = []  # 固定的input文件，任务结束前不会被清理
+    generated_image_path = [None]  # 使用列表存储图像路径，以便在回调中修改
+    # 未指定服务器时选择队列最短的ComfyUI服务器
+    if backend is None:
+        backend = comfyui_pool.select()
+    comfyui_pool.acquire(backend)
     try:
         # 验证输入图像
         if not input_image_path or not os.path.exists(input_image_path):
             error_msg = f"输入图像无效或不存在: {input_image_path}"
-            logging.error(error_msg)
+            workflow_log.error(error_msg)
             if progress:
                 progress(1.0, error_msg)
             return None
@@ -1335,343 +3126,189 @@ def send_img2img_workflow_to_comfyui(workflow_data, input_image_path=None, progr
         file_ext = os.path.splitext(input_image_path)[1].lower()
         if file_ext not in valid_extensions:
             error_msg = f"不支持的图像文件类型: {file_ext}，支持的类型: {', '.join(valid_extensions)}"
-            logging.error(error_msg)
+            workflow_log.error(error_msg)
             if progress:
                 progress(1.0, error_msg)
             return None
         
-        # 生成客户端ID
-        client_id = str(uuid.uuid4())
-        generated_image_path = [None]  # 使用列表存储图像路径，以便在回调中修改
-        generation_event = threading.Event()
-        
-        # 记录当前进度的变量
-        current_progress = {"value": 0.1, "message": "正在初始化..."}
-        
-        # 创建回调函数处理生成的图像
-        def on_image_generated(images):
-            if images:
-                print(f"处理生成的图像: 发现 {len(images)} 张图片")
-                image_info = images[0]  # 获取第一张图像的信息
-                filename = image_info["filename"]
-                subfolder = image_info.get("subfolder", "")
-                img_type = image_info.get("type", "output")
-                
-                # 构建图像URL
-                image_url = f"http://{COMFYUI_SERVER}/view?filename={filename}&subfolder={subfolder}&type={img_type}"
-                print(f"生成的图像URL: {image_url}")
-                
-                try:
-                    # 下载图像
-                    print(f"开始下载图像: {image_url}")
-                    response = requests.get(image_url)
-                    if response.status_code == 200:
-                        print("图像下载成功，准备保存")
-                        # 确保output文件夹存在
-                        os.makedirs("output", exist_ok=True)
-                        
-                        # 使用时间戳创建文件名
-                        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                        output_filename = f"output/img2img_{timestamp}.png"
-                        
-                        # 保存图像
-                        image = Image.open(BytesIO(response.content))
-                        image.save(output_filename)
-                        generated_image_path[0] = output_filename
-                        print(f"图像已保存到: {output_filename}")
-                        
-                        # 通知主线程图像已生成
-                        generation_event.set()
-                    else:
-                        print(f"图像下载失败，状态码: {response.status_code}")
-                        print(response.text[:200] if len(response.text) > 200 else response.text)
-                except Exception as e:
-                    print(f"下载图像失败: {e}")
-                    generation_event.set()
-            else:
-                print("没有找到生成的图像")
-                generation_event.set()
+        # 下载并保存生成的图像
+        async def on_image_generated(images):
+            workflow_log.debug("处理生成的图像: 发现 %s 张图片", len(images))
+            image_info = images[0]  # 获取第一张图像的信息
+            
+            try:
+                workflow_log.debug("开始下载图像: %s", image_info["filename"])
+                output_filename = await save_comfyui_output(backend, image_info, job.prompt_id)
+                generated_image_path[0] = output_filename
+                workflow_log.info("图像已保存到: %s", output_filename)
+            except httpx.HTTPStatusError as e:
+                workflow_log.warning("图像下载失败，状态码: %s", e.response.status_code)
+            except Exception as e:
+                workflow_log.warning("下载图像失败: %s", e)
         
         # 创建进度回调函数
         def on_progress_update(value, message):
-            nonlocal current_progress
-            current_progress["value"] = value
-            current_progress["message"] = message
-            
-            print(f"WebSocket接收到进度更新: {value:.2f} - {message}")
             if progress is not None:
                 try:
                     progress(value, message)
-                    print(f"UI进度已更新: {value:.2f}")
                 except Exception as e:
-                    print(f"更新UI进度失败: {e}")
+                    workflow_log.warning("更新UI进度失败: %s", e)
         
-        # 更新进度 - 10%
         if progress is not None:
-            progress(0.1, "正在准备输入图像...")
+            progress(None, "正在准备输入图像...")
         
         # 处理输入图像
         try:
-            # 找到图生图工作流中的图像加载节点
-            image_node_found = False
-            
-            # 可能的图像输入节点ID列表 - 根据实际工作流调整
-            possible_image_node_ids = ["2", "3", "10", "82", "image_loader"]
-            
-            # 获取文件名（不包含路径）
-            filename = os.path.basename(input_image_path)
+            # 上传到ComfyUI（已在input文件夹中或已上传过的图片直接使用文件名）
+            filename = await asyncio.to_thread(backend.client.upload_input_image, input_image_path)
             
-            # 使用深度复制避免修改原始数据
-            workflow_copy = copy.deepcopy(workflow_data)
+            # 图像加载节点在编译补丁计划时已按class_type解析，只复制被修改的节点
+            workflow_copy, image_nodes = apply_workflow_input_image(workflow_data, filename, tab)
+            workflow_log.debug("已将输入图像文件名 %s 添加到工作流节点 %s", filename, image_nodes)
             
-            for node_id in possible_image_node_ids:
-                if node_id in workflow_copy and "inputs" in workflow_copy[node_id]:
-                    if "image" in workflow_copy[node_id]["inputs"]:
-                        # 使用文件名而不是base64编码的图像数据
-                        workflow_copy[node_id]["inputs"]["image"] = filename
-                        print(f"已将输入图像文件名 {filename} 添加到工作流节点 {node_id}")
-                        image_node_found = True
-                        break
-            
-            if not image_node_found:
-                # 搜索所有节点，查找包含image字段的节点
-                for node_id, node_data in workflow_copy.items():
-                    if "inputs" in node_data:
-                        if "image" in node_data["inputs"]:
-                            node_data["inputs"]["image"] = filename
-                            print(f"通过搜索找到图像节点 {node_id}，已设置文件名 {filename}")
-                            image_node_found = True
-                            break
-            
-            if not image_node_found:
+            if not image_nodes:
                 error_msg = "错误：无法在工作流中找到图像输入节点"
-                print(error_msg)
+                workflow_log.error(error_msg)
                 if progress is not None:
                     progress(1.0, error_msg)
                 return None
                 
         except Exception as e:
             error_msg = f"处理输入图像时出错: {e}"
-            print(error_msg)
-            import traceback
-            traceback.print_exc()
+            workflow_log.error(error_msg, exc_info=True)
             if progress is not None:
                 progress(1.0, error_msg)
             return None
         
-        # 更新进度 - 15%
         if progress is not None:
-            progress(0.15, "正在连接ComfyUI...")
+            progress(None, "正在连接ComfyUI...")
         
-        # ComfyUI API地址
-        api_url = f"http://{COMFYUI_SERVER}/api/prompt"
+        # 任务结束前固定工作流引用的input文件，避免被清理
+        pinned_inputs = retention_manager.pin_workflow_inputs(workflow_copy, backend.client.input_dir)
         
-        # 准备API请求数据
-        prompt_data = {
-            "prompt": workflow_copy,
-            "client_id": client_id
-        }
+        # 服务器熔断期间直接失败，不再等待连接和执行
+        if not backend.breaker.allow():
+            raise ComfyUIExecutionError(f"ComfyUI服务器不可用: {backend.server}，请稍后重试")
+        
+        # 提交前先在共享WebSocket上登记任务，避免漏掉执行事件
+        ws_hub = await asyncio.to_thread(backend.get_websocket)
+        client_id = ws_hub.client_id
+        job = ComfyUIJob(str(uuid.uuid4()), on_progress_update, preview.push if preview else None)
+        ws_hub.register(job)
+        if preview is not None:
+            preview.job = job
+        # 在输出文件名前缀中写入任务标记，出错兜底时只查找该任务自己的输出
+        workflow_copy = output_watcher.expect(job, workflow_copy)
         
         # 发送工作流并获取提示ID
-        print(f"发送图生图工作流到ComfyUI... ClientID: {client_id}")
+        workflow_log.debug("发送图生图工作流到ComfyUI... ClientID: %s", client_id)
         
         try:
-            response = requests.post(api_url, json=prompt_data, timeout=10)  # 添加超时
+            response = await backend.async_client.submit_prompt(workflow_copy, client_id, job.prompt_id)
             
             if response.status_code != 200:
                 error_msg = f"提交图生图工作流失败: {response.status_code}"
-                print(error_msg)
-                print(response.text)
+                workflow_log.warning("%s，响应: %s", error_msg, response.text)
                 if progress is not None:
                     progress(1.0, error_msg)
-                return find_latest_image()
+                return await asyncio.to_thread(find_latest_image, job)
                 
+            # 旧版本ComfyUI会忽略客户端指定的prompt_id，以服务器返回的为准
             prompt_id = response.json()["prompt_id"]
-            print(f"成功提交图生图工作流，Prompt ID: {prompt_id}")
-        except requests.exceptions.RequestException as e:
+            if prompt_id != job.prompt_id:
+                ws_hub.rekey(job, prompt_id)
+            job.submitted = True
+            comfyui_pool.mark_submitted(backend, prompt_id)
+            submitted_at = time.time()
+            workflow_log.info("成功提交图生图工作流，Prompt ID: %s", prompt_id)
+        except httpx.HTTPError as e:
             error_msg = f"连接ComfyUI服务器失败: {e}"
-            print(error_msg)
+            workflow_log.warning(error_msg)
             if progress is not None:
                 progress(1.0, error_msg)
-            return find_latest_image()
+            return await asyncio.to_thread(find_latest_image, job)
         
-        # 更新进度 - 15%
         if progress is not None:
-            progress(0.15, "工作流已提交，正在建立WebSocket连接...")
-        
-        # 检查队列状态，确认工作流已入队
-        queue_response = requests.get(f"http://{COMFYUI_SERVER}/api/queue")
-        queue_data = queue_response.json()
-        print(f"队列状态: {queue_data}")
-        
-        # 创建并启动WebSocket连接
-        print(f"创建WebSocket连接，客户端ID: {client_id}")
-        ws_client = ComfyUIWebSocket(client_id, prompt_id, on_image_generated, on_progress_update)
-        ws_client.start()
-        
-        # 等待一会儿确保WebSocket连接建立
-        print("等待WebSocket连接建立...")
-        time.sleep(2)
+            progress(None, "工作流已提交，等待ComfyUI执行...")
         
         # 设置超时时间为10分钟，兼容低配置电脑
         timeout = 600  # 10分钟
-
+        
         # 等待工作流执行完成
-        start_time = time.time()
-        websocket_check_time = time.time()
-        progress_update_time = time.time()
+        workflow_log.debug("开始等待工作流执行，超时时间: %s秒", timeout)
+        images = await wait_for_comfyui_job(job, backend, ws_hub, progress, timeout=timeout)
+        if job.started_at is not None and job.state == "success":
+            backend.record_duration(time.time() - job.started_at)
+        
+        # 超时或完全命中缓存时，最后通过历史记录获取一次图像
+        if not images:
+            workflow_log.debug("未从WebSocket获取到图像，尝试通过HTTP API查询历史记录获取图像")
+            try:
+                images = await fetch_history_images_async(backend.async_client, prompt_id)
+            except Exception as e:
+                workflow_log.warning("通过HTTP API查询历史记录失败: %s", e)
         
-        # 显示进度
-        print(f"开始等待工作流执行，超时时间: {timeout}秒")
-        while not generation_event.is_set() and time.time() - start_time < timeout:
-            current_time = time.time()
-            
-            # 每5秒检查一次WebSocket连接状态，如果WebSocket没有响应则使用HTTP API检查状态
-            if current_time - websocket_check_time > 5:
-                websocket_check_time = current_time
-                
-                # 如果WebSocket连接建立但超过15秒没有收到消息，使用HTTP API检查状态（从原来的10秒增加）
-                if (not ws_client.connection_successful or 
-                    (ws_client.last_progress_time > 0 and current_time - ws_client.last_progress_time > 15)):
-                    print("WebSocket连接可能不活跃，使用HTTP API检查状态")
-                    try:
-                        # 检查队列状态
-                        status_response = requests.get(f"http://{COMFYUI_SERVER}/api/queue")
-                        queue_data = status_response.json()
-                        is_executing = bool(queue_data.get("queue_running"))
-                        print(f"HTTP API检查 - 队列状态: {'正在执行' if is_executing else '空队列'}")
-                        
-                        # 检查历史记录中是否有我们的工作流
-                        history_response = requests.get(f"http://{COMFYUI_SERVER}/api/history")
-                        if history_response.status_code == 200:
-                            history_data = history_response.json()
-                            if prompt_id in history_data:
-                                print(f"在历史记录中找到工作流: {prompt_id}")
-                                
-                                # 检查是否已完成
-                                prompt_info = history_data[prompt_id]
-                                if "outputs" in prompt_info:
-                                    outputs = prompt_info["outputs"]
-                                    
-                                    # 查找所有输出节点
-                                    for node_id, node_output in outputs.items():
-                                        if "images" in node_output:
-                                            images = []
-                                            for img_data in node_output["images"]:
-                                                img_info = {
-                                                    "filename": img_data["filename"],
-                                                    "subfolder": img_data.get("subfolder", ""),
-                                                    "type": "output"
-                                                }
-                                                images.append(img_info)
-                                                
-                                            if images:
-                                                print(f"从历史记录中找到 {len(images)} 张图像")
-                                                on_image_generated(images)
-                                                break
-                                
-                                # 如果在历史记录中但没有输出，说明正在执行
-                                elapsed = current_time - start_time
-                                if not generation_event.is_set():
-                                    # 使用经过的时间作为简单进度估计
-                                    progress_percent = min(0.8, 0.25 + (elapsed / 300) * 0.55)  # 假设最长需要5分钟
-                                    if progress is not None and not ws_client.execution_completed:
-                                        progress(progress_percent, f"正在生成图像... (HTTP检查)")
-                    except Exception as e:
-                        print(f"HTTP API检查失败: {e}")
-                        import traceback
-                        traceback.print_exc()
-            
-            # 每0.5秒从当前进度变量更新一次UI，确保UI总能得到更新
-            if current_time - progress_update_time > 0.5:
-                progress_update_time = current_time
-                if progress is not None and current_progress["value"] > 0.15:
-                    try:
-                        progress(current_progress["value"], current_progress["message"])
-                        print(f"定期更新UI进度: {current_progress['value']:.2f} - {current_progress['message']}")
-                    except Exception as e:
-                        print(f"定期更新UI进度失败: {e}")
-            
-            time.sleep(0.1)
-            
-        # 如果已过超时时间但还未收到图像
-        if not generation_event.is_set():
-            print("等待超时，尝试最后一次获取图像")
-            
-            # 尝试通过HTTP API获取最新的历史记录
+        # 等待超时且任务仍未结束时取消ComfyUI上的任务，避免继续占用GPU
+        if images is None and not job.done:
+            workflow_log.warning("等待超时，取消ComfyUI任务: %s", prompt_id)
+            job.fail("interrupted", "等待超时，任务已取消")
             try:
-                print("尝试通过HTTP API查询历史记录获取图像")
-                history_response = requests.get(f"http://{COMFYUI_SERVER}/api/history")
-                if history_response.status_code == 200:
-                    history_data = history_response.json()
-                    if prompt_id in history_data:
-                        print(f"在历史记录中找到工作流: {prompt_id}")
-                        
-                        # 检查输出
-                        prompt_info = history_data[prompt_id]
-                        if "outputs" in prompt_info:
-                            outputs = prompt_info["outputs"]
-                            
-                            # 查找所有输出节点
-                            for node_id, node_output in outputs.items():
-                                if "images" in node_output:
-                                    images = []
-                                    for img_data in node_output["images"]:
-                                        img_info = {
-                                            "filename": img_data["filename"],
-                                            "subfolder": img_data.get("subfolder", ""),
-                                            "type": "output"
-                                        }
-                                        images.append(img_info)
-                                        
-                                    if images:
-                                        print(f"从历史记录中找到 {len(images)} 张图像")
-                                        on_image_generated(images)
-                                        generation_event.set()
-                                        break
+                await backend.cancel_prompt(prompt_id)
             except Exception as e:
-                print(f"通过HTTP API查询历史记录失败: {e}")
-            
-            if not generation_event.is_set():
-                if progress is not None:
-                    progress(0.95, "等待超时，尝试查找最新保存的图像...")
-                result = find_latest_image()
-                if result:
-                    generated_image_path[0] = result
-                
-        # 确保WebSocket已关闭
-        print("关闭WebSocket连接")
-        if ws_client.running:
-            ws_client.close()
+                workflow_log.warning("取消ComfyUI任务失败: %s", e)
+        
+        if images:
+            await on_image_generated(images)
         
         # 如果有生成的图像，返回路径
         if generated_image_path[0]:
             if progress is not None:
                 progress(1.0, "图像生成完成！")
-            print(f"返回生成的图像路径: {generated_image_path[0]}")
+            workflow_log.info("返回生成的图像路径: %s", generated_image_path[0])
             return generated_image_path[0]
         
         # 尝试查找最新保存的图像
-        print("未找到生成的图像，尝试查找最新保存的图像...")
+        workflow_log.info("未找到生成的图像，尝试查找最新保存的图像...")
         if progress is not None:
             progress(0.95, "未找到生成的图像，尝试查找最新保存的图像...")
-        result = find_latest_image()
+        result = await asyncio.to_thread(find_latest_image, job)
         if progress is not None:
             progress(1.0, "完成")
         return result
+    
+    except asyncio.CancelledError:
+        # 用户取消或页面关闭：从ComfyUI队列中删除或中断该任务，不再占用GPU
+        if job is not None and not job.done:
+            job.fail("interrupted", "任务已被取消")
+            try:
+                await backend.cancel_prompt(job.prompt_id)
+            except Exception as e:
+                workflow_log.warning("取消ComfyUI任务失败: %s", e)
+        raise
+    
+    except ComfyUIExecutionError as e:
+        workflow_log.warning("图生图工作流执行失败: %s", e)
+        if progress is not None:
+            progress(1.0, f"工作流执行失败: {e}")
+        return None
         
     except Exception as e:
-        print(f"与ComfyUI接口通信错误: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        # 记录到日志文件
-        logging.error(f"与ComfyUI接口通信错误: {str(e)}")
-        logging.error(traceback.format_exc())
+        workflow_log.error("与ComfyUI接口通信错误: %s", e, exc_info=True)
         # 更新进度 - 错误状态
         if progress is not None:
             progress(1.0, f"错误: {str(e)}")
-        # 出错时尝试查找最近保存的图像
-        return find_latest_image()
+        # 出错时尝试查找该任务已经保存的图像，任务还未创建时不查找
+        return await asyncio.to_thread(find_latest_image, job) if job is not None else None
+    
+    finally:
+        # 任务结束后从共享WebSocket上注销，连接本身保持复用
+        if ws_hub is not None and job is not None:
+            ws_hub.unregister(job)
+        if job is not None:
+            output_watcher.forget(job)
+        retention_manager.unpin(pinned_inputs)
+        comfyui_pool.release(backend, job.prompt_id if job is not None else None)
+        record_generation(job, tab, workflow_copy, [path for path in generated_image_path if path], submitted_at)
 
 # 提取当前参数
 params = extract_adjustable_params()
@@ -1689,10 +3326,28 @@ def ensure_model_in_list(model_list, value):
     return model_list
 
 # 查找最新生成的图片
-def find_latest_image():
+# 指定任务时只返回监视器归属到该任务的文件，找不到时返回None，不会返回其他任务的图像；
+# 不指定任务时依次使用监视器、生成记录，最后才遍历目录
+def find_latest_image(job=None):
+    if job is not None:
+        return output_watcher.latest_for_job(job.prompt_id)
+    
+    latest = output_watcher.latest()
+    if latest and os.path.exists(latest):
+        return latest
+    
+    # 其次从生成记录中查找，避免遍历整个目录
+    try:
+        latest = generation_index.latest_output()
+        if latest:
+            return latest
+    except Exception as e:
+        logging.error(f"查询生成记录失败: {e}")
+    
     try:
         # 从workflows.json中获取保存路径的格式
         save_path_format = ""
+        workflow = get_workflow_template("txt2img")
         if "3" in workflow and "inputs" in workflow["3"]:
             save_path_format = workflow["3"]["inputs"].get("filename_prefix", "")
         
@@ -1866,8 +3521,10 @@ with gr.Blocks(title="文生图 - ComfyUI接口") as txt2img_demo:
                 noise_seed = gr.Number(value=params["noise_seed"], label="随机种子", precision=0)
                 random_seed_btn = gr.Button("随机生成种子")
             
-            # 生成按钮
-            generate_btn = gr.Button("生成图像", variant="primary", size="lg")
+            # 生成按钮和取消按钮
+            with gr.Row():
+                generate_btn = gr.Button("生成图像", variant="primary", size="lg")
+                cancel_btn = gr.Button("取消生成", variant="stop", size="lg")
         
         # 右侧图片显示区
         with gr.Column(scale=1):
@@ -1896,6 +3553,7 @@ with gr.Blocks(title="文生图 - ComfyUI接口") as txt2img_demo:
             # 添加状态显示区
             status_text = gr.Markdown("准备就绪")
             image_output = gr.Image(label="生成的图片", type="filepath")
+            image_file_output = gr.File(label="下载原图")
             
             # 添加浏览输出文件夹按钮
             open_output_btn_txt2img = gr.Button("浏览输出文件夹")
@@ -1913,8 +3571,17 @@ with gr.Blocks(title="文生图 - ComfyUI接口") as txt2img_demo:
         unet_model, clip_model1, clip_model2, vae_model  # 添加模型选择参数
     ]
     
+    # 参数预设，页面加载时恢复该用户上次使用的参数
+    add_param_preset_controls(txt2img_demo, "txt2img", list(zip([
+        "width", "height", "sampler_name", "scheduler", "steps", "denoise", "guidance", "noise_seed",
+        "lora_01", "strength_01", "lora_02", "strength_02", "lora_03", "strength_03", "lora_04", "strength_04",
+        "face_prompt", "clothes_prompt", "environment_prompt",
+        "unet_name", "clip_name1", "clip_name2", "vae_name",
+    ], all_inputs)))
+    
     # 生成图像按钮的点击事件
-    def generate_image(*args, progress=gr.Progress()):
+    @comfyui_admission_control(3)
+    async def generate_image(*args, bus, user, progress=gr.Progress()):
         updated_params = {}
         
         # 将输入参数整合到一个字典中
@@ -1942,35 +3609,53 @@ with gr.Blocks(title="文生图 - ComfyUI接口") as txt2img_demo:
         updated_params["clip_name2"] = args[21]
         updated_params["vae_name"] = args[22]
         
-        # 保存参数到JSON文件
-        progress(0.05, "保存参数到配置文件...")
-        saved_workflow = save_workflow(updated_params)
+        # 在工作流模板的副本上写入本次参数
+        progress(0.05, "准备工作流...")
+        saved_workflow = save_workflow(updated_params, user)
         
-        # 创建状态更新的函数
+        # 状态文字，生成过程中由进度总线更新
         status_text = "图像生成完成！"
         
-        def progress_callback(value, message):
-            nonlocal status_text
-            status_text = message
-            progress(value, message)
-            print(f"UI进度更新: {value:.2f} - {message}")
-        
-        # 发送工作流到ComfyUI并获取生成结果
-        result_image = send_workflow_to_comfyui(saved_workflow, progress_callback)
+        # 发送工作流到ComfyUI并获取生成结果，等待期间按固定频率刷新进度和采样预览图
+        task = bus.start(send_workflow_to_comfyui(saved_workflow, bus.update, preview=bus, tab="txt2img"))
+        async for value, status_text, preview_image in bus.stream(task):
+            progress(value, status_text)
+            yield (preview_image if preview_image is not None else gr.update()), gr.update(), status_text
+        result_image = await task
+        # 最终状态由任务的结束状态决定：执行失败或被中断时显示发送流程报告的原因
+        job_succeeded = bus.job is not None and bus.job.state == "success"
+        if result_image:
+            status_text = "图像生成完成！" if job_succeeded else bus.message
+        elif job_succeeded:
+            status_text = "生成失败：未能找到本任务生成的图像"
+        else:
+            status_text = bus.message or "生成失败"
         
         # 返回生成的图像
-        return result_image, status_text
+        preview_path, full_path = await prepare_result_display(result_image)
+        yield preview_path, full_path, status_text
     
     # 随机种子按钮的点击事件
     random_seed_btn.click(fn=generate_random_seed, inputs=None, outputs=noise_seed)
     
     # 生成按钮的点击事件
-    generate_btn.click(
+    generate_event = generate_btn.click(
         fn=generate_image, 
         inputs=all_inputs, 
-        outputs=[image_output, status_text],
-        show_progress="full"
+        outputs=[image_output, image_file_output, status_text],
+        show_progress="full",
+        concurrency_limit=None  # 异步处理函数等待时不占用线程，不限制同时等待的任务数
     )
+    
+    # 取消按钮：取消正在进行的生成，处理函数退出时会删除或中断ComfyUI上的任务
+    cancel_btn.click(fn=None, inputs=None, outputs=None, cancels=[generate_event])
+    
+    # 按提示词搜索生成记录
+    add_generation_search()
+    
+    # 页面关闭时取消该会话未完成的任务
+    if hasattr(txt2img_demo, "unload"):
+        txt2img_demo.unload(cancel_session_jobs)
 
 # 图生图界面
 with gr.Blocks(title="图生图 - ComfyUI接口") as img2img_demo:
@@ -2009,45 +3694,30 @@ with gr.Blocks(title="图生图 - ComfyUI接口") as img2img_demo:
                 if img is None:
                     return None, "未上传图片", "图片尺寸: 使用上传图片的原始尺寸", None
                     
-                # 确保ComfyUI的input文件夹存在
-                comfyui_input_path = os.path.join(WSL_COMFYUI_PATH, "input")
-                os.makedirs(comfyui_input_path, exist_ok=True)
-                
-                # 获取当前时间作为文件名
-                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                # 通过ComfyUI的/upload/image接口上传，内容相同的图片不会重复上传
+                try:
+                    filename = comfyui_pool.default.client.upload_input_image(img, "upload")
+                except Exception as e:
+                    http_log.warning("上传图片到ComfyUI失败: %s", e)
+                    return None, f"上传图片到ComfyUI失败: {str(e)}", "图片尺寸: 未知", gr.update()
                 
-                # 构建文件路径
-                if isinstance(img, str):  # 如果已经是文件路径
-                    ext = os.path.splitext(img)[1].lower()
-                    if not ext:
-                        ext = ".png"  # 默认扩展名
-                    file_path = os.path.join(comfyui_input_path, f"upload_{timestamp}{ext}")
-                    
-                    # 复制文件
-                    shutil.copy2(img, file_path)
-                    
-                    # 获取图片尺寸
-                    try:
-                        with Image.open(file_path) as img_obj:
+                # 获取图片尺寸
+                try:
+                    if isinstance(img, str):  # 如果已经是文件路径
+                        with Image.open(img) as img_obj:
                             width, height = img_obj.size
-                            dimension_text = f"图片尺寸: {width} x {height} 像素"
-                    except Exception as e:
-                        dimension_text = f"无法获取图片尺寸: {str(e)}"
-                else:  # 如果是PIL图像对象
-                    file_path = os.path.join(comfyui_input_path, f"upload_{timestamp}.png")
-                    img.save(file_path)
-                    
-                    # 获取图片尺寸
-                    try:
+                    else:  # 如果是PIL图像对象
                         width, height = img.size
-                        dimension_text = f"图片尺寸: {width} x {height} 像素"
-                    except Exception as e:
-                        dimension_text = f"无法获取图片尺寸: {str(e)}"
+                    dimension_text = f"图片尺寸: {width} x {height} 像素"
+                except Exception as e:
+                    dimension_text = f"无法获取图片尺寸: {str(e)}"
                 
-                # 获取文件名（不包含路径）
-                filename = os.path.basename(file_path)
+                # ComfyUI在本机时使用input文件夹中的文件，否则继续使用上传的原图
+                file_path = os.path.join(WSL_COMFYUI_PATH, "input", filename)
+                if not os.path.exists(file_path):
+                    file_path = img if isinstance(img, str) else None
                 
-                print(f"已保存上传图片到ComfyUI的input文件夹: {file_path}")
+                http_log.info("已上传图片到ComfyUI的input文件夹: %s", filename)
                 
                 # 更新下拉菜单选项
                 new_images = get_input_folder_images()
@@ -2060,7 +3730,7 @@ with gr.Blocks(title="图生图 - ComfyUI接口") as img2img_demo:
                     except Exception as e:
                         print(f"获取文件大小出错: {e}")
                 
-                return file_path, f"已保存图片: {file_path} (文件名: {filename})", dimension_text, gr.update(choices=dropdown_choices, value=file_path)
+                return file_path, f"已保存图片: {file_path} (文件名: {filename})", dimension_text, gr.update(choices=dropdown_choices, value=file_path if file_path in [path for _, path in dropdown_choices] else None)
             
             input_image = gr.Image(label="上传图片", type="filepath")
             image_path_text = gr.Textbox(label="图片路径", interactive=False)
@@ -2189,8 +3859,10 @@ with gr.Blocks(title="图生图 - ComfyUI接口") as img2img_demo:
                 i2i_noise_seed = gr.Number(value=img2img_params.get("noise_seed", 0), label="随机种子", precision=0)
                 i2i_random_seed_btn = gr.Button("随机生成种子")
             
-            # 生成按钮
-            i2i_generate_btn = gr.Button("生成图像", variant="primary", size="lg")
+            # 生成按钮和取消按钮
+            with gr.Row():
+                i2i_generate_btn = gr.Button("生成图像", variant="primary", size="lg")
+                i2i_cancel_btn = gr.Button("取消生成", variant="stop", size="lg")
         
         # 右侧图片显示区
         with gr.Column(scale=1):
@@ -2219,6 +3891,7 @@ with gr.Blocks(title="图生图 - ComfyUI接口") as img2img_demo:
             # 添加状态显示区
             i2i_status_text = gr.Markdown("准备就绪")
             i2i_image_output = gr.Image(label="生成的图片", type="filepath")
+            i2i_image_file_output = gr.File(label="下载原图")
             
             # 添加浏览输出文件夹按钮
             open_output_btn = gr.Button("浏览输出文件夹")
@@ -2240,8 +3913,20 @@ with gr.Blocks(title="图生图 - ComfyUI接口") as img2img_demo:
         i2i_redraw_strength  # 添加图生图重绘幅度滑动条
     ]
     
+    # 参数预设，页面加载时恢复该用户上次使用的参数（输入图像和尺寸不在其中）
+    add_param_preset_controls(img2img_demo, "img2img", [
+        ("sampler_name", i2i_sampler), ("scheduler", i2i_scheduler), ("steps", i2i_steps),
+        ("guidance", i2i_guidance), ("noise_seed", i2i_noise_seed),
+        ("lora_01", i2i_lora_01), ("strength_01", i2i_strength_01), ("lora_02", i2i_lora_02), ("strength_02", i2i_strength_02),
+        ("lora_03", i2i_lora_03), ("strength_03", i2i_strength_03), ("lora_04", i2i_lora_04), ("strength_04", i2i_strength_04),
+        ("face_prompt", i2i_face_prompt), ("clothes_prompt", i2i_clothes_prompt), ("environment_prompt", i2i_environment_prompt),
+        ("unet_name", i2i_unet_model), ("clip_name1", i2i_clip_model1), ("clip_name2", i2i_clip_model2), ("vae_name", i2i_vae_model),
+        ("redraw_strength", i2i_redraw_strength),
+    ])
+    
     # 图生图生成函数
-    def generate_img2img(*args, progress=gr.Progress()):
+    @comfyui_admission_control(3)
+    async def generate_img2img(*args, bus, user, progress=gr.Progress()):
         input_image_path = args[0]
         # 由于删除了宽高参数和去噪强度参数，需要调整索引
         sampler_name = args[1]
@@ -2276,11 +3961,13 @@ with gr.Blocks(title="图生图 - ComfyUI接口") as img2img_demo:
                 print(f"使用文本框中的图片路径: {input_image_path}")
         
         if not input_image_path:
-            return None, "错误：请先上传或选择输入图像"
+            yield None, None, "错误：请先上传或选择输入图像"
+            return
         
         # 确保input_image_path是一个有效的文件路径
         if not os.path.exists(input_image_path):
-            return None, f"错误：输入图像路径无效 - {input_image_path}"
+            yield None, None, f"错误：输入图像路径无效 - {input_image_path}"
+            return
         
         # 打印使用的输入图像
         print(f"使用输入图像: {input_image_path}")
@@ -2322,99 +4009,59 @@ with gr.Blocks(title="图生图 - ComfyUI接口") as img2img_demo:
         updated_params["vae_name"] = vae_name
         updated_params["redraw_strength"] = i2i_redraw_strength  # 图生图重绘幅度参数
         
-        # 保存参数到JSON文件
-        progress(0.05, "保存参数到配置文件...")
-        saved_workflow = save_img2img_workflow(updated_params)
+        # 在工作流模板的副本上写入本次参数
+        progress(0.05, "准备工作流...")
+        saved_workflow = save_img2img_workflow(updated_params, user)
         
-        # 创建状态更新的函数
+        # 状态文字，生成过程中由进度总线更新
         status_text = "图像生成完成！"
         
-        def progress_callback(value, message):
-            nonlocal status_text
-            status_text = message
-            progress(value, message)
-            print(f"UI进度更新: {value:.2f} - {message}")
-        
-        # 发送工作流到ComfyUI并获取生成结果
+        # 发送工作流到ComfyUI并获取生成结果，等待期间按固定频率刷新进度和采样预览图
         try:
-            result_image = send_img2img_workflow_to_comfyui(saved_workflow, input_image_path, progress_callback)
+            task = bus.start(send_img2img_workflow_to_comfyui(saved_workflow, input_image_path, bus.update, preview=bus))
+            async for value, status_text, preview_image in bus.stream(task):
+                progress(value, status_text)
+                yield (preview_image if preview_image is not None else gr.update()), gr.update(), status_text
+            result_image = await task
             
             # 如果生成成功，显示成功信息
             if result_image and os.path.exists(result_image):
-                return result_image, "图像生成完成！"
+                preview_path, full_path = await prepare_result_display(result_image)
+                yield preview_path, full_path, "图像生成完成！"
             else:
-                return None, "图像生成失败，未能获取结果图像"
+                yield None, None, "图像生成失败，未能获取结果图像"
         except Exception as e:
             import traceback
             error_msg = f"处理过程中出错: {str(e)}"
             print(error_msg)
             print(traceback.format_exc())
-            return None, error_msg
+            yield None, None, error_msg
     
     # 随机种子按钮的点击事件
     i2i_random_seed_btn.click(fn=generate_random_seed, inputs=None, outputs=i2i_noise_seed)
     
     # 生成按钮的点击事件
-    i2i_generate_btn.click(
+    i2i_generate_event = i2i_generate_btn.click(
         fn=generate_img2img, 
         inputs=i2i_all_inputs, 
-        outputs=[i2i_image_output, i2i_status_text],
-        show_progress="full"
+        outputs=[i2i_image_output, i2i_image_file_output, i2i_status_text],
+        show_progress="full",
+        concurrency_limit=None  # 异步处理函数等待时不占用线程，不限制同时等待的任务数
     )
+    
+    # 取消按钮：取消正在进行的生成，处理函数退出时会删除或中断ComfyUI上的任务
+    i2i_cancel_btn.click(fn=None, inputs=None, outputs=None, cancels=[i2i_generate_event])
+    
+    # 按提示词搜索生成记录
+    add_generation_search()
+    
+    # 页面关闭时取消该会话未完成的任务
+    if hasattr(img2img_demo, "unload"):
+        img2img_demo.unload(cancel_session_jobs)
 
-# 读取三视图工作流文件
-def load_random_three_views_workflow():
-    # 首先尝试当前目录的workflows文件夹
-    try:
-        with open("workflows/Random_three_views.json", "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        import sys
-        import os
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "workflows", "Random_three_views.json")
-        try:
-            with open(workflow_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print(f"错误：无法找到Random_three_views.json文件，已尝试路径: workflows/Random_three_views.json 和 {workflow_path}")
-            raise
-
-# 保存三视图工作流文件
-def save_random_three_views_workflow_json(workflow_data):
-    # 首先尝试当前目录的workflows文件夹
-    try:
-        os.makedirs("workflows", exist_ok=True)
-        with open("workflows/Random_three_views.json", "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "workflows", "Random_three_views.json")
-        os.makedirs(os.path.dirname(workflow_path), exist_ok=True)
-        with open(workflow_path, "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
-
-# 加载三视图工作流
-try:
-    random_three_views_workflow = load_random_three_views_workflow()
-    # 检查303节点
-    if "303" in random_three_views_workflow:
-        if "inputs" in random_three_views_workflow["303"] and "text" in random_three_views_workflow["303"]["inputs"]:
-            default_image_name = random_three_views_workflow["303"]["inputs"]["text"]
-            print(f"加载时发现303节点默认图片名称: '{default_image_name}'")
-        else:
-            print(f"警告：303节点结构不完整: {random_three_views_workflow['303']}")
-    else:
-        print("警告：未找到303节点")
-except Exception as e:
-    logging.error(f"加载三视图工作流失败: {e}")
-    random_three_views_workflow = {}  # 使用空字典作为默认值
-
-# 提取三视图可调节参数
+# 提取三视图可调节参数：按三视图的补丁计划读取模板中的当前值
 def extract_random_three_views_params():
-    params = {
+    params = read_workflow_params("three_views", {
         # 设置所有可能需要的参数的默认值，确保即使工作流结构不同也能正常运行
         "width": 1280,  # 默认值修改为1280
         "height": 1280, # 默认值修改为1280
@@ -2440,322 +4087,45 @@ def extract_random_three_views_params():
         "controlnet_name": "flux/Shakker-Labs/diffusion_pytorch_model.safetensors", # 添加ControlNet模型默认路径
         "image_name": "character_sheet_flux",  # 提供正确的默认值
         "pose_image": None  # 添加姿势图参数
-    }
-    
-    # 如果工作流为空，直接返回默认参数
-    if not random_three_views_workflow:
-        print("三视图工作流为空，使用默认参数")
-        return params
-    
-    # 打印工作流的节点ID，帮助调试
-    print(f"三视图工作流节点ID: {list(random_three_views_workflow.keys())}")
-    
-    # 直接输出25节点的完整内容，帮助调试
-    if "25" in random_three_views_workflow:
-        print(f"节点25的完整内容: {json.dumps(random_three_views_workflow['25'], ensure_ascii=False, indent=2)}")
-    
-    # 检查10节点（姿势图）
-    if "10" in random_three_views_workflow:
-        print(f"节点10存在，开始提取姿势图参数")
-    
-    try:
-        # 提取25节点参数（图片命名）- 优先提取这个节点数据并打印出来
-        if "25" in random_three_views_workflow:
-            if "inputs" in random_three_views_workflow["25"] and "string" in random_three_views_workflow["25"]["inputs"]:
-                params["image_name"] = random_three_views_workflow["25"]["inputs"]["string"]
-                print(f"成功从节点25提取图片名称: '{params['image_name']}'")
-            else:
-                print("节点25存在，但没有inputs.string字段")
-                # 如果节点存在但没有string字段，检查其他可能的字段
-                if "inputs" in random_three_views_workflow["25"]:
-                    print(f"节点25的inputs字段包含: {list(random_three_views_workflow['25']['inputs'].keys())}")
-                    # 检查其他可能包含名称的字段
-                    for key, value in random_three_views_workflow["25"]["inputs"].items():
-                        print(f"节点25的字段 {key}: {value}")
-                        if isinstance(value, str) and value:
-                            params["image_name"] = value
-                            print(f"从字段 {key} 中找到可能的图片名称: '{value}'")
-                else:
-                    print(f"节点25的结构: {random_three_views_workflow['25']}")
-        else:
-            print("工作流中不存在节点25，使用默认值")
-        
-        # 提取10节点参数（姿势图）
-        if "10" in random_three_views_workflow and "inputs" in random_three_views_workflow["10"]:
-            if "image" in random_three_views_workflow["10"]["inputs"]:
-                pose_image = random_three_views_workflow["10"]["inputs"]["image"]
-                print(f"从节点10提取姿势图: {pose_image}")
-                params["pose_image"] = pose_image
-        
-        # 提取18节点参数（提示词）
-        if "18" in random_three_views_workflow and "inputs" in random_three_views_workflow["18"]:
-            if "text" in random_three_views_workflow["18"]["inputs"]:
-                params["prompt"] = random_three_views_workflow["18"]["inputs"]["text"]
-                print(f"从节点18提取提示词: {params['prompt'][:30]}..." if len(params["prompt"]) > 30 else f"从节点18提取提示词: {params['prompt']}")
-        
-        # 提取图像尺寸参数 - 从21、23、24节点提取
-        if "21" in random_three_views_workflow and "inputs" in random_three_views_workflow["21"]:
-            if "width" in random_three_views_workflow["21"]["inputs"] and "height" in random_three_views_workflow["21"]["inputs"]:
-                params["width"] = random_three_views_workflow["21"]["inputs"].get("width", 1280)
-                params["height"] = random_three_views_workflow["21"]["inputs"].get("height", 1280)
-                print(f"从节点21提取图像尺寸: {params['width']}x{params['height']}")
-        # 如果21节点不存在尺寸信息，尝试从23节点提取
-        elif "23" in random_three_views_workflow and "inputs" in random_three_views_workflow["23"]:
-            if "width" in random_three_views_workflow["23"]["inputs"] and "height" in random_three_views_workflow["23"]["inputs"]:
-                params["width"] = random_three_views_workflow["23"]["inputs"].get("width", 1280)
-                params["height"] = random_three_views_workflow["23"]["inputs"].get("height", 1280)
-                print(f"从节点23提取图像尺寸: {params['width']}x{params['height']}")
-        # 如果23节点不存在尺寸信息，尝试从24节点提取
-        elif "24" in random_three_views_workflow and "inputs" in random_three_views_workflow["24"]:
-            if "width" in random_three_views_workflow["24"]["inputs"] and "height" in random_three_views_workflow["24"]["inputs"]:
-                params["width"] = random_three_views_workflow["24"]["inputs"].get("width", 1280)
-                params["height"] = random_three_views_workflow["24"]["inputs"].get("height", 1280)
-                print(f"从节点24提取图像尺寸: {params['width']}x{params['height']}")
-        
-        # 确保宽高相等（方形图）且在有效范围内
-        if params["width"] != params["height"]:
-            # 如果不相等，使用较大的值
-            size = max(params["width"], params["height"])
-            # 确保在有效范围内
-            size = max(1280, min(size, 2048))
-            params["width"] = size
-            params["height"] = size
-            print(f"调整图像尺寸为方形: {size}x{size}")
-        
-        # 提取12节点参数（ControlNet模型）
-        if "12" in random_three_views_workflow and "inputs" in random_three_views_workflow["12"]:
-            if "control_net_name" in random_three_views_workflow["12"]["inputs"]:
-                params["controlnet_name"] = random_three_views_workflow["12"]["inputs"]["control_net_name"]
-                print(f"从节点12提取ControlNet模型: {params['controlnet_name']}")
-        
-        # 更新提取UNET模型 - 使用13号节点
-        if "13" in random_three_views_workflow and "inputs" in random_three_views_workflow["13"]:
-            if "unet_name" in random_three_views_workflow["13"]["inputs"]:
-                params["unet_name"] = random_three_views_workflow["13"]["inputs"]["unet_name"]
-                print(f"从节点13提取UNET模型: {params['unet_name']}")
-        
-        # 更新提取CLIP模型 - 使用14号节点
-        if "14" in random_three_views_workflow and "inputs" in random_three_views_workflow["14"]:
-            if "clip_name1" in random_three_views_workflow["14"]["inputs"]:
-                params["clip_name1"] = random_three_views_workflow["14"]["inputs"]["clip_name1"]
-            if "clip_name2" in random_three_views_workflow["14"]["inputs"]:
-                params["clip_name2"] = random_three_views_workflow["14"]["inputs"]["clip_name2"]
-            print(f"从节点14提取CLIP模型")
-        
-        # 更新提取VAE模型 - 使用15号节点
-        if "15" in random_three_views_workflow and "inputs" in random_three_views_workflow["15"]:
-            if "vae_name" in random_three_views_workflow["15"]["inputs"]:
-                params["vae_name"] = random_three_views_workflow["15"]["inputs"]["vae_name"]
-                print(f"从节点15提取VAE模型: {params['vae_name']}")
-        
-        # 更新提取LoRA参数 - 使用17号节点
-        if "17" in random_three_views_workflow and "inputs" in random_three_views_workflow["17"]:
-            for lora_key in ["lora_01", "lora_02", "lora_03", "lora_04"]:
-                if lora_key in random_three_views_workflow["17"]["inputs"]:
-                    params[lora_key] = random_three_views_workflow["17"]["inputs"][lora_key]
-            for strength_key in ["strength_01", "strength_02", "strength_03", "strength_04"]:
-                if strength_key in random_three_views_workflow["17"]["inputs"]:
-                    params[strength_key] = random_three_views_workflow["17"]["inputs"][strength_key]
-            print(f"从节点17提取LoRA参数")
-        
-        # 提取采样器参数 - 适配不同节点ID
-        for node_id in ["3"]:  # 更新采样器节点ID
-            if node_id in random_three_views_workflow and "inputs" in random_three_views_workflow[node_id]:
-                if "sampler_name" in random_three_views_workflow[node_id]["inputs"]:
-                    params["sampler_name"] = random_three_views_workflow[node_id]["inputs"]["sampler_name"]
-                    print(f"从节点 {node_id} 提取采样器: {params['sampler_name']}")
-                    break
-        
-        # 提取调度器参数 - 适配不同节点ID
-        for node_id in ["2"]:  # 更新调度器节点ID
-            if node_id in random_three_views_workflow and "inputs" in random_three_views_workflow[node_id]:
-                if "scheduler" in random_three_views_workflow[node_id]["inputs"]:
-                    params["scheduler"] = random_three_views_workflow[node_id]["inputs"]["scheduler"]
-                if "steps" in random_three_views_workflow[node_id]["inputs"]:
-                    params["steps"] = random_three_views_workflow[node_id]["inputs"]["steps"]
-                if "denoise" in random_three_views_workflow[node_id]["inputs"]:
-                    params["denoise"] = random_three_views_workflow[node_id]["inputs"]["denoise"]
-                print(f"从节点 {node_id} 提取调度器参数")
-                break
-        
-        # 提取随机噪声种子 - 适配不同节点ID
-        for node_id in ["16"]:  # 更新随机种子节点ID
-            if node_id in random_three_views_workflow and "inputs" in random_three_views_workflow[node_id]:
-                if "noise_seed" in random_three_views_workflow[node_id]["inputs"]:
-                    params["noise_seed"] = random_three_views_workflow[node_id]["inputs"]["noise_seed"]
-                    print(f"从节点 {node_id} 提取随机种子: {params['noise_seed']}")
-                    break
-        
-        # 提取引导参数 - 适配不同节点ID
-        for node_id in ["8"]:  # 更新引导参数节点ID
-            if node_id in random_three_views_workflow and "inputs" in random_three_views_workflow[node_id]:
-                if "guidance" in random_three_views_workflow[node_id]["inputs"]:
-                    params["guidance"] = random_three_views_workflow[node_id]["inputs"]["guidance"]
-                    print(f"从节点 {node_id} 提取引导参数: {params['guidance']}")
-                    break
+    })
     
-    except Exception as e:
-        print(f"提取三视图参数时出错: {e}")
-        import traceback
-        traceback.print_exc()
+    # 确保宽高相等（方形图）且在有效范围内
+    if params["width"] != params["height"]:
+        # 如果不相等，使用较大的值
+        size = max(params["width"], params["height"])
+        # 确保在有效范围内
+        size = max(1280, min(size, 2048))
+        params["width"] = size
+        params["height"] = size
+        print(f"调整图像尺寸为方形: {size}x{size}")
     
     print(f"三视图参数提取完成，图片名称: '{params['image_name']}'，姿势图: {params['pose_image']}")
     return params
 
 # 保存三视图调整后的参数
-def save_random_three_views_workflow(params):
-    workflow_copy = copy.deepcopy(random_three_views_workflow)
-    
+def save_random_three_views_workflow(params, user=None):
     # 如果工作流为空，使用默认结构
-    if not workflow_copy:
+    template = get_workflow_template("three_views")
+    if not template:
         logging.warning("三视图工作流为空，无法保存参数")
-        return workflow_copy
+        return {}
     
     # 确保宽高相等（方形图）且在有效范围内
     size = max(512, min(params["width"], 2048))
     params["width"] = size
     params["height"] = size
-    
-    # 更新25节点参数（图片命名）
-    if "25" in workflow_copy:
-        if "inputs" not in workflow_copy["25"]:
-            workflow_copy["25"]["inputs"] = {}
-        if "string" in workflow_copy["25"]["inputs"]:
-            workflow_copy["25"]["inputs"]["string"] = params["image_name"]
-            print(f"已将图片名称 '{params['image_name']}' 保存到三视图工作流25号节点的string字段")
-        else:
-            workflow_copy["25"]["inputs"]["string"] = params["image_name"]
-            print(f"已将图片名称 '{params['image_name']}' 保存到三视图工作流25号节点")
-    else:
-        print(f"警告：工作流中不存在25节点，无法保存图片名称 '{params['image_name']}'")
-        # 尝试创建25节点
-        try:
-            workflow_copy["25"] = {
-                "inputs": {
-                    "string": params["image_name"]
-                },
-                "class_type": "Simple String"  # 正确的类型
-            }
-            print(f"已创建25节点并设置图片名称为 '{params['image_name']}'")
-        except Exception as e:
-            print(f"创建25节点失败: {e}")
-    
-    # 更新10节点参数（姿势图）
-    if params.get("pose_image") and "10" in workflow_copy:
-        if "inputs" not in workflow_copy["10"]:
-            workflow_copy["10"]["inputs"] = {}
-        workflow_copy["10"]["inputs"]["image"] = params["pose_image"]
-        print(f"已将姿势图 {params['pose_image']} 保存到三视图工作流10号节点")
-    
-    # 更新18节点参数（提示词）
-    if "18" in workflow_copy:
-        if "inputs" not in workflow_copy["18"]:
-            workflow_copy["18"]["inputs"] = {}
-        workflow_copy["18"]["inputs"]["text"] = params["prompt"]
-        print(f"已将提示词保存到三视图工作流18号节点")
-    else:
-        print(f"警告：工作流中不存在18号节点，无法保存提示词")
-        # 尝试创建18节点
-        try:
-            workflow_copy["18"] = {
-                "inputs": {
-                    "text": params["prompt"],
-                    "clip": ["17", 1]
-                },
-                "class_type": "CLIPTextEncode"  # 提示词节点的正确类型
-            }
-            print(f"已创建18节点并设置提示词")
-        except Exception as e:
-            print(f"创建18节点失败: {e}")
-    
-    # 更新12节点参数（ControlNet模型）
-    if "12" in workflow_copy:
-        if "inputs" not in workflow_copy["12"]:
-            workflow_copy["12"]["inputs"] = {}
-        workflow_copy["12"]["inputs"]["control_net_name"] = params.get("controlnet_name", "flux/Shakker-Labs/diffusion_pytorch_model.safetensors")
-        print(f"已将ControlNet模型 {params.get('controlnet_name')} 保存到三视图工作流12号节点")
-    else:
-        print(f"警告：工作流中不存在12号节点，无法保存ControlNet模型")
-    
-    # 更新图像尺寸到多个节点
-    # 更新21节点的尺寸参数
-    if "21" in workflow_copy:
-        if "inputs" not in workflow_copy["21"]:
-            workflow_copy["21"]["inputs"] = {}
-        workflow_copy["21"]["inputs"]["width"] = size
-        workflow_copy["21"]["inputs"]["height"] = size
-        print(f"已将尺寸 {size}x{size} 保存到三视图工作流21号节点")
-    
-    # 更新23节点的尺寸参数
-    if "23" in workflow_copy:
-        if "inputs" not in workflow_copy["23"]:
-            workflow_copy["23"]["inputs"] = {}
-        workflow_copy["23"]["inputs"]["width"] = size
-        workflow_copy["23"]["inputs"]["height"] = size
-        print(f"已将尺寸 {size}x{size} 保存到三视图工作流23号节点")
-    
-    # 更新24节点的尺寸参数
-    if "24" in workflow_copy:
-        if "inputs" not in workflow_copy["24"]:
-            workflow_copy["24"]["inputs"] = {}
-        workflow_copy["24"]["inputs"]["width"] = size
-        workflow_copy["24"]["inputs"]["height"] = size
-        print(f"已将尺寸 {size}x{size} 保存到三视图工作流24号节点")
-    
-    # 更新采样器
-    if "3" in workflow_copy:  # 更新为3号节点
-        workflow_copy["3"]["inputs"]["sampler_name"] = params["sampler_name"]
-        print(f"已将采样器 {params['sampler_name']} 保存到三视图工作流3号节点")
-    
-    # 更新调度器
-    if "2" in workflow_copy:  # 更新为2号节点
-        workflow_copy["2"]["inputs"]["scheduler"] = params["scheduler"]
-        workflow_copy["2"]["inputs"]["steps"] = params["steps"]
-        workflow_copy["2"]["inputs"]["denoise"] = params["denoise"]
-        print(f"已将调度器参数保存到三视图工作流2号节点")
-    
-    # 更新随机噪声种子
-    if "16" in workflow_copy:  # 更新为16号节点
-        workflow_copy["16"]["inputs"]["noise_seed"] = params["noise_seed"]
-        print(f"已将随机种子 {params['noise_seed']} 保存到三视图工作流16号节点")
-    
-    # 更新引导参数
-    if "8" in workflow_copy:  # 更新为8号节点
-        workflow_copy["8"]["inputs"]["guidance"] = params["guidance"]
-        print(f"已将引导参数 {params['guidance']} 保存到三视图工作流8号节点")
-    
-    # 更新UNET模型参数 - 使用13号节点
-    if "13" in workflow_copy:
-        workflow_copy["13"]["inputs"]["unet_name"] = params["unet_name"]
-        print(f"已将UNET模型 {params['unet_name']} 保存到三视图工作流13号节点")
-    
-    # 更新CLIP模型参数 - 使用14号节点
-    if "14" in workflow_copy:
-        if "clip_name1" in params:
-            workflow_copy["14"]["inputs"]["clip_name1"] = params["clip_name1"]
-        if "clip_name2" in params:
-            workflow_copy["14"]["inputs"]["clip_name2"] = params["clip_name2"]
-        print(f"已将CLIP模型保存到三视图工作流14号节点")
-    
-    # 更新VAE模型参数 - 使用15号节点
-    if "15" in workflow_copy and "vae_name" in params:
-        workflow_copy["15"]["inputs"]["vae_name"] = params["vae_name"]
-        print(f"已将VAE模型 {params['vae_name']} 保存到三视图工作流15号节点")
-    
-    # 更新LoRA参数 - 使用17号节点
-    if "17" in workflow_copy:
-        workflow_copy["17"]["inputs"]["lora_01"] = params["lora_01"]
-        workflow_copy["17"]["inputs"]["strength_01"] = params["strength_01"]
-        workflow_copy["17"]["inputs"]["lora_02"] = params["lora_02"]
-        workflow_copy["17"]["inputs"]["strength_02"] = params["strength_02"]
-        workflow_copy["17"]["inputs"]["lora_03"] = params["lora_03"]
-        workflow_copy["17"]["inputs"]["strength_03"] = params["strength_03"]
-        workflow_copy["17"]["inputs"]["lora_04"] = params["lora_04"]
-        workflow_copy["17"]["inputs"]["strength_04"] = params["strength_04"]
-        print(f"已将LoRA参数保存到三视图工作流17号节点")
-    
-    # 保存工作流
-    save_random_three_views_workflow_json(workflow_copy)
+    params.setdefault("controlnet_name", "flux/Shakker-Labs/diffusion_pytorch_model.safetensors")
+    
+    # 按编译好的补丁计划写入参数，只复制被修改的节点
+    plan = get_workflow_patch_plan("three_views")
+    workflow_copy = plan.apply(template, params)
+    for param in ("image_name", "prompt"):
+        if not plan.nodes_for(param):
+            workflow_log.warning("三视图工作流中没有找到参数 %s 对应的节点", param)
+    
+    # 记住该用户最近一次使用的参数，工作流模板保持不变
+    if user is not None:
+        user_params.remember(user, "three_views", params)
     return workflow_copy
 
 # 提取三视图参数
@@ -2789,45 +4159,30 @@ with gr.Blocks(title="三视图 - ComfyUI接口") as random_three_views_demo:
                 if img is None:
                     return None, "未上传图片", "图片尺寸: 未知", None
                     
-                # 确保ComfyUI的input文件夹存在
-                comfyui_input_path = os.path.join(WSL_COMFYUI_PATH, "input")
-                os.makedirs(comfyui_input_path, exist_ok=True)
-                
-                # 获取当前时间作为文件名
-                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                # 通过ComfyUI的/upload/image接口上传，内容相同的图片不会重复上传
+                try:
+                    filename = comfyui_pool.default.client.upload_input_image(img, "pose")
+                except Exception as e:
+                    http_log.warning("上传姿势图到ComfyUI失败: %s", e)
+                    return None, f"上传姿势图到ComfyUI失败: {str(e)}", "图片尺寸: 未知", gr.update()
                 
-                # 构建文件路径
-                if isinstance(img, str):  # 如果已经是文件路径
-                    ext = os.path.splitext(img)[1].lower()
-                    if not ext:
-                        ext = ".png"  # 默认扩展名
-                    file_path = os.path.join(comfyui_input_path, f"pose_{timestamp}{ext}")
-                    
-                    # 复制文件
-                    shutil.copy2(img, file_path)
-                    
-                    # 获取图片尺寸
-                    try:
-                        with Image.open(file_path) as img_obj:
+                # 获取图片尺寸
+                try:
+                    if isinstance(img, str):  # 如果已经是文件路径
+                        with Image.open(img) as img_obj:
                             width, height = img_obj.size
-                            dimension_text = f"图片尺寸: {width} x {height} 像素"
-                    except Exception as e:
-                        dimension_text = f"无法获取图片尺寸: {str(e)}"
-                else:  # 如果是PIL图像对象
-                    file_path = os.path.join(comfyui_input_path, f"pose_{timestamp}.png")
-                    img.save(file_path)
-                    
-                    # 获取图片尺寸
-                    try:
+                    else:  # 如果是PIL图像对象
                         width, height = img.size
-                        dimension_text = f"图片尺寸: {width} x {height} 像素"
-                    except Exception as e:
-                        dimension_text = f"无法获取图片尺寸: {str(e)}"
+                    dimension_text = f"图片尺寸: {width} x {height} 像素"
+                except Exception as e:
+                    dimension_text = f"无法获取图片尺寸: {str(e)}"
                 
-                # 获取文件名（不包含路径）
-                filename = os.path.basename(file_path)
+                # ComfyUI在本机时使用input文件夹中的文件，否则继续使用上传的原图
+                file_path = os.path.join(WSL_COMFYUI_PATH, "input", filename)
+                if not os.path.exists(file_path):
+                    file_path = img if isinstance(img, str) else None
                 
-                print(f"已保存姿势图到ComfyUI的input文件夹: {file_path}")
+                http_log.info("已上传姿势图到ComfyUI的input文件夹: %s", filename)
                 
                 # 更新下拉菜单选项
                 new_images = get_input_folder_images()
@@ -2840,7 +4195,7 @@ with gr.Blocks(title="三视图 - ComfyUI接口") as random_three_views_demo:
                     except Exception as e:
                         print(f"获取文件大小出错: {e}")
                 
-                return file_path, f"已保存姿势图: {file_path} (文件名: {filename})", dimension_text, gr.update(choices=dropdown_choices, value=file_path)
+                return file_path, f"已保存姿势图: {file_path} (文件名: {filename})", dimension_text, gr.update(choices=dropdown_choices, value=file_path if file_path in [path for _, path in dropdown_choices] else None)
             
             # 打开input文件夹的函数
             def open_pose_input_folder():
@@ -3053,8 +4408,10 @@ with gr.Blocks(title="三视图 - ComfyUI接口") as random_three_views_demo:
                 rtv_noise_seed = gr.Number(value=rtv_params["noise_seed"], label="随机种子", precision=0)
                 rtv_random_seed_btn = gr.Button("随机生成种子")
             
-            # 生成按钮
-            rtv_generate_btn = gr.Button("生成三视图", variant="primary", size="lg")
+            # 生成按钮和取消按钮
+            with gr.Row():
+                rtv_generate_btn = gr.Button("生成三视图", variant="primary", size="lg")
+                rtv_cancel_btn = gr.Button("取消生成", variant="stop", size="lg")
         
         # 右侧图片显示区
         with gr.Column(scale=1):
@@ -3083,6 +4440,7 @@ with gr.Blocks(title="三视图 - ComfyUI接口") as random_three_views_demo:
             # 添加状态显示区
             rtv_status_text = gr.Markdown("准备就绪")
             rtv_image_output = gr.Image(label="生成的图片", type="filepath")
+            rtv_image_file_output = gr.File(label="下载原图")
             
             # 添加浏览输出文件夹按钮
             open_output_btn_rtv = gr.Button("浏览输出文件夹")
@@ -3102,8 +4460,19 @@ with gr.Blocks(title="三视图 - ComfyUI接口") as random_three_views_demo:
         rtv_pose_image   # 添加姿势图参数
     ]
     
+    # 参数预设，页面加载时恢复该用户上次使用的参数（姿势图不在其中）
+    add_param_preset_controls(random_three_views_demo, "three_views", [
+        ("width", rtv_size), ("sampler_name", rtv_sampler), ("scheduler", rtv_scheduler), ("steps", rtv_steps),
+        ("denoise", rtv_denoise), ("guidance", rtv_guidance), ("noise_seed", rtv_noise_seed),
+        ("lora_01", rtv_lora_01), ("strength_01", rtv_strength_01), ("lora_02", rtv_lora_02), ("strength_02", rtv_strength_02),
+        ("lora_03", rtv_lora_03), ("strength_03", rtv_strength_03), ("lora_04", rtv_lora_04), ("strength_04", rtv_strength_04),
+        ("prompt", rtv_prompt), ("unet_name", rtv_unet_model), ("clip_name1", rtv_clip_model1), ("clip_name2", rtv_clip_model2),
+        ("vae_name", rtv_vae_model), ("controlnet_name", rtv_controlnet_model), ("image_name", rtv_image_name),
+    ])
+    
     # 修改generate_random_three_views函数的参数处理部分
-    def generate_random_three_views(*args, progress=gr.Progress()):
+    @comfyui_admission_control(3)
+    async def generate_random_three_views(*args, bus, user, progress=gr.Progress()):
         updated_params = {}
         
         # 将输入参数整合到一个字典中
@@ -3138,11 +4507,19 @@ with gr.Blocks(title="三视图 - ComfyUI接口") as random_three_views_demo:
         updated_params["image_name"] = args[21]  # 添加图片名称参数
         updated_params["pose_image"] = args[22]  # 添加姿势图参数
         
+        # 先选定执行任务的ComfyUI服务器，姿势图需要上传到同一个服务器
+        backend = comfyui_pool.select()
+        
         # 处理姿势图路径
         pose_image_path = updated_params["pose_image"]
         if pose_image_path:
-            # 如果是完整路径，则提取文件名
-            pose_filename = os.path.basename(pose_image_path)
+            # 上传到ComfyUI（已在input文件夹中或已上传过的图片直接使用文件名）
+            try:
+                pose_filename = await asyncio.to_thread(backend.client.upload_input_image, pose_image_path, "pose")
+            except Exception as e:
+                http_log.warning("上传姿势图到ComfyUI失败: %s", e)
+                yield None, None, f"上传姿势图到ComfyUI失败: {str(e)}"
+                return
             print(f"使用姿势图: {pose_filename}")
             updated_params["pose_image"] = pose_filename
         
@@ -3150,73 +4527,57 @@ with gr.Blocks(title="三视图 - ComfyUI接口") as random_three_views_demo:
         print(f"使用图像尺寸: {updated_params['width']}x{updated_params['height']} (方形图)")
         print(f"使用ControlNet模型: {updated_params['controlnet_name']}")
         
-        # 保存参数到JSON文件
-        progress(0.05, "保存参数到配置文件...")
-        saved_workflow = save_random_three_views_workflow(updated_params)
+        # 在工作流模板的副本上写入本次参数
+        progress(0.05, "准备工作流...")
+        saved_workflow = save_random_three_views_workflow(updated_params, user)
         
-        # 创建状态更新的函数
+        # 状态文字，生成过程中由进度总线更新
         status_text = "三视图生成完成！"
         
-        def progress_callback(value, message):
-            nonlocal status_text
-            status_text = message
-            progress(value, message)
-            print(f"UI进度更新: {value:.2f} - {message}")
-        
-        # 发送工作流到ComfyUI并获取生成结果
-        result_image = send_workflow_to_comfyui(saved_workflow, progress_callback)
+        # 发送工作流到ComfyUI并获取生成结果，等待期间按固定频率刷新进度和采样预览图
+        task = bus.start(send_workflow_to_comfyui(saved_workflow, bus.update, preview=bus, backend=backend, tab="three_views"))
+        async for value, status_text, preview_image in bus.stream(task):
+            progress(value, status_text)
+            yield (preview_image if preview_image is not None else gr.update()), gr.update(), status_text
+        result_image = await task
+        # 最终状态由任务的结束状态决定：执行失败或被中断时显示发送流程报告的原因
+        job_succeeded = bus.job is not None and bus.job.state == "success"
+        if result_image:
+            status_text = "三视图生成完成！" if job_succeeded else bus.message
+        elif job_succeeded:
+            status_text = "生成失败：未能找到本任务生成的图像"
+        else:
+            status_text = bus.message or "生成失败"
         
         # 返回生成的图像
-        return result_image, status_text
+        preview_path, full_path = await prepare_result_display(result_image)
+        yield preview_path, full_path, status_text
     
     # 随机种子按钮的点击事件
     rtv_random_seed_btn.click(fn=generate_random_seed, inputs=None, outputs=rtv_noise_seed)
     
     # 生成按钮的点击事件
-    rtv_generate_btn.click(
+    rtv_generate_event = rtv_generate_btn.click(
         fn=generate_random_three_views, 
         inputs=rtv_all_inputs, 
-        outputs=[rtv_image_output, rtv_status_text],
-        show_progress="full"
+        outputs=[rtv_image_output, rtv_image_file_output, rtv_status_text],
+        show_progress="full",
+        concurrency_limit=None  # 异步处理函数等待时不占用线程，不限制同时等待的任务数
     )
+    
+    # 取消按钮：取消正在进行的生成，处理函数退出时会删除或中断ComfyUI上的任务
+    rtv_cancel_btn.click(fn=None, inputs=None, outputs=None, cancels=[rtv_generate_event])
+    
+    # 按提示词搜索生成记录
+    add_generation_search()
+    
+    # 页面关闭时取消该会话未完成的任务
+    if hasattr(random_three_views_demo, "unload"):
+        random_three_views_demo.unload(cancel_session_jobs)
 
-# 读取放大及面部修复工作流文件
-def load_magnified_facial_restoration_workflow():
-    # 首先尝试当前目录的workflows文件夹
-    try:
-        with open("workflows/Magnified_facial_restoration.json", "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        import sys
-        import os
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "workflows", "Magnified_facial_restoration.json")
-        try:
-            with open(workflow_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print(f"错误：无法找到Magnified_facial_restoration.json文件，已尝试路径: workflows/Magnified_facial_restoration.json 和 {workflow_path}")
-            raise
-
-# 保存放大及面部修复工作流文件
-def save_magnified_facial_restoration_workflow_json(workflow_data):
-    # 首先尝试当前目录的workflows文件夹
-    try:
-        os.makedirs("workflows", exist_ok=True)
-        with open("workflows/Magnified_facial_restoration.json", "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
-    except FileNotFoundError:
-        # 如果当前目录没有，则尝试相对于exe的目录
-        exe_dir = os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
-        workflow_path = os.path.join(exe_dir, "workflows", "Magnified_facial_restoration.json")
-        os.makedirs(os.path.dirname(workflow_path), exist_ok=True)
-        with open(workflow_path, "w", encoding="utf-8") as f:
-            json.dump(workflow_data, f, ensure_ascii=False, indent=2)
-
-# 提取放大及面部修复可调节参数
+# 提取放大及面部修复可调节参数：按放大工作流的补丁计划读取模板中的当前值
 def extract_magnified_facial_restoration_params():
-    params = {
+    return read_workflow_params("magnify", {
         # 设置默认参数
         "upscale_by": 2,
         "seed": 384340151733828,
@@ -3245,191 +4606,22 @@ def extract_magnified_facial_restoration_params():
         "negative_prompt": "",
         "image_name": "character_sheet_flux",
         "input_image": None
-    }
-    
-    # 如果工作流为空，直接返回默认参数
-    if not magnified_facial_restoration_workflow:
-        print("放大及面部修复工作流为空，使用默认参数")
-        return params
-    
-    try:
-        # 打印工作流的节点ID，帮助调试
-        print(f"放大及面部修复工作流节点ID: {list(magnified_facial_restoration_workflow.keys())}")
-        
-        # 提取303节点参数（图片命名）
-        if "303" in magnified_facial_restoration_workflow and "inputs" in magnified_facial_restoration_workflow["303"]:
-            if "string" in magnified_facial_restoration_workflow["303"]["inputs"]:
-                params["image_name"] = magnified_facial_restoration_workflow["303"]["inputs"]["string"]
-                print(f"从节点303提取图片名称: '{params['image_name']}'")
-        
-        # 提取361节点参数（输入图像）
-        if "361" in magnified_facial_restoration_workflow and "inputs" in magnified_facial_restoration_workflow["361"]:
-            if "image" in magnified_facial_restoration_workflow["361"]["inputs"]:
-                params["input_image"] = magnified_facial_restoration_workflow["361"]["inputs"]["image"]
-                print(f"从节点361提取输入图像: {params['input_image']}")
-        
-        # 提取157节点参数（正向提示词）
-        if "157" in magnified_facial_restoration_workflow and "inputs" in magnified_facial_restoration_workflow["157"]:
-            if "text" in magnified_facial_restoration_workflow["157"]["inputs"]:
-                params["positive_prompt"] = magnified_facial_restoration_workflow["157"]["inputs"]["text"]
-                print(f"从节点157提取正向提示词: {params['positive_prompt'][:30]}..." if len(params['positive_prompt']) > 30 else f"从节点157提取正向提示词: {params['positive_prompt']}")
-        
-        # 提取364节点参数（负向提示词）
-        if "364" in magnified_facial_restoration_workflow and "inputs" in magnified_facial_restoration_workflow["364"]:
-            if "text" in magnified_facial_restoration_workflow["364"]["inputs"]:
-                params["negative_prompt"] = magnified_facial_restoration_workflow["364"]["inputs"]["text"]
-                print(f"从节点364提取负向提示词: {params['negative_prompt'][:30]}..." if len(params['negative_prompt']) > 30 else f"从节点364提取负向提示词: {params['negative_prompt']}")
-        
-        # 提取82节点参数（SD放大参数）
-        if "82" in magnified_facial_restoration_workflow and "inputs" in magnified_facial_restoration_workflow["82"]:
-            sd_upscale_params = magnified_facial_restoration_workflow["82"]["inputs"]
-            for key in ["upscale_by", "seed", "steps", "cfg", "sampler_name", "scheduler", "denoise", 
-                       "tile_width", "tile_height", "mask_blur", "tile_padding", "seam_fix_mode", 
-                       "seam_fix_denoise", "seam_fix_width", "seam_fix_mask_blur", "seam_fix_padding", 
-                       "force_uniform_tiles", "tiled_decode"]:
-                if key in sd_upscale_params:
-                    params[key] = sd_upscale_params[key]
-            print(f"从节点82提取SD放大参数")
-        
-        # 提取83节点参数（放大模型）
-        if "83" in magnified_facial_restoration_workflow and "inputs" in magnified_facial_restoration_workflow["83"]:
-            if "model_name" in magnified_facial_restoration_workflow["83"]["inputs"]:
-                params["upscale_model"] = magnified_facial_restoration_workflow["83"]["inputs"]["model_name"]
-                print(f"从节点83提取放大模型: {params['upscale_model']}")
-        
-        # 提取161节点参数（UNET模型）
-        if "161" in magnified_facial_restoration_workflow and "inputs" in magnified_facial_restoration_workflow["161"]:
-            if "unet_name" in magnified_facial_restoration_workflow["161"]["inputs"]:
-                params["unet_name"] = magnified_facial_restoration_workflow["161"]["inputs"]["unet_name"]
-                print(f"从节点161提取UNET模型: {params['unet_name']}")
-        
-        # 提取160节点参数（CLIP模型）
-        if "160" in magnified_facial_restoration_workflow and "inputs" in magnified_facial_restoration_workflow["160"]:
-            if "clip_name1" in magnified_facial_restoration_workflow["160"]["inputs"]:
-                params["clip_name1"] = magnified_facial_restoration_workflow["160"]["inputs"]["clip_name1"]
-            if "clip_name2" in magnified_facial_restoration_workflow["160"]["inputs"]:
-                params["clip_name2"] = magnified_facial_restoration_workflow["160"]["inputs"]["clip_name2"]
-            print(f"从节点160提取CLIP模型")
-        
-        # 提取159节点参数（VAE模型）
-        if "159" in magnified_facial_restoration_workflow and "inputs" in magnified_facial_restoration_workflow["159"]:
-            if "vae_name" in magnified_facial_restoration_workflow["159"]["inputs"]:
-                params["vae_name"] = magnified_facial_restoration_workflow["159"]["inputs"]["vae_name"]
-                print(f"从节点159提取VAE模型: {params['vae_name']}")
-        
-        # 注释掉183节点参数提取，因为该节点未使用
-        # # 提取183节点参数（面部细化参数）
-        # if "183" in magnified_facial_restoration_workflow and "inputs" in magnified_facial_restoration_workflow["183"]:
-        #     if "guide_size" in magnified_facial_restoration_workflow["183"]["inputs"]:
-        #         params["guide_size"] = magnified_facial_restoration_workflow["183"]["inputs"]["guide_size"]
-        #         print(f"从节点183提取guide_size: {params['guide_size']}")
-        #     # 可以提取更多的面部细化参数...
-            
-    except Exception as e:
-        print(f"提取放大及面部修复参数时出错: {e}")
-        import traceback
-        traceback.print_exc()
-    
-    return params
+    })
 
 # 保存放大及面部修复调整后的参数
-def save_magnified_facial_restoration_workflow(params):
-    workflow_copy = copy.deepcopy(magnified_facial_restoration_workflow)
-    
+def save_magnified_facial_restoration_workflow(params, user=None):
     # 如果工作流为空，使用默认结构
-    if not workflow_copy:
+    template = get_workflow_template("magnify")
+    if not template:
         logging.warning("放大及面部修复工作流为空，无法保存参数")
-        return workflow_copy
+        return {}
     
-    try:
-        # 更新303节点参数（图片命名）
-        if "303" in workflow_copy:
-            if "inputs" not in workflow_copy["303"]:
-                workflow_copy["303"]["inputs"] = {}
-            workflow_copy["303"]["inputs"]["string"] = params["image_name"]
-            print(f"已将图片名称 '{params['image_name']}' 保存到放大及面部修复工作流303节点")
-        
-        # 更新361节点参数（输入图像）
-        if params.get("input_image") and "361" in workflow_copy:
-            if "inputs" not in workflow_copy["361"]:
-                workflow_copy["361"]["inputs"] = {}
-            # ComfyUI期望的格式是直接使用图片名称，它会自动在input目录下查找
-            # 确保只使用文件名，而不是完整路径
-            if params["input_image"] and isinstance(params["input_image"], str):
-                # 如果是路径，只获取文件名部分
-                filename = os.path.basename(params["input_image"])
-                workflow_copy["361"]["inputs"]["image"] = filename
-                print(f"已将输入图像 {filename} 保存到放大及面部修复工作流361节点")
-            else:
-                workflow_copy["361"]["inputs"]["image"] = params["input_image"]
-                print(f"已将输入图像 {params['input_image']} 保存到放大及面部修复工作流361节点")
-        
-        # 更新157节点参数（正向提示词）
-        if "157" in workflow_copy:
-            if "inputs" not in workflow_copy["157"]:
-                workflow_copy["157"]["inputs"] = {}
-            workflow_copy["157"]["inputs"]["text"] = params["positive_prompt"]
-            print(f"已将正向提示词保存到放大及面部修复工作流157节点")
-        
-        # 更新364节点参数（负向提示词）
-        if "364" in workflow_copy:
-            if "inputs" not in workflow_copy["364"]:
-                workflow_copy["364"]["inputs"] = {}
-            workflow_copy["364"]["inputs"]["text"] = params["negative_prompt"]
-            print(f"已将负向提示词保存到放大及面部修复工作流364节点")
-        
-        # 更新82节点参数（SD放大参数）
-        if "82" in workflow_copy:
-            if "inputs" not in workflow_copy["82"]:
-                workflow_copy["82"]["inputs"] = {}
-            
-            # 更新所有SD放大参数
-            for key in ["upscale_by", "seed", "steps", "cfg", "sampler_name", "scheduler", "denoise", 
-                       "tile_width", "tile_height", "mask_blur", "tile_padding", "seam_fix_mode", 
-                       "seam_fix_denoise", "seam_fix_width", "seam_fix_mask_blur", "seam_fix_padding", 
-                       "force_uniform_tiles", "tiled_decode"]:
-                if key in params:
-                    workflow_copy["82"]["inputs"][key] = params[key]
-            print(f"已将SD放大参数保存到放大及面部修复工作流82节点")
-        
-        # 更新83节点参数（放大模型）
-        if "83" in workflow_copy:
-            if "inputs" not in workflow_copy["83"]:
-                workflow_copy["83"]["inputs"] = {}
-            workflow_copy["83"]["inputs"]["model_name"] = params["upscale_model"]
-            print(f"已将放大模型 {params['upscale_model']} 保存到放大及面部修复工作流83节点")
-        
-        # 更新161节点参数（UNET模型）
-        if "161" in workflow_copy:
-            if "inputs" not in workflow_copy["161"]:
-                workflow_copy["161"]["inputs"] = {}
-            workflow_copy["161"]["inputs"]["unet_name"] = params["unet_name"]
-            print(f"已将UNET模型 {params['unet_name']} 保存到放大及面部修复工作流161节点")
-        
-        # 更新160节点参数（CLIP模型）
-        if "160" in workflow_copy:
-            if "inputs" not in workflow_copy["160"]:
-                workflow_copy["160"]["inputs"] = {}
-            workflow_copy["160"]["inputs"]["clip_name1"] = params["clip_name1"]
-            workflow_copy["160"]["inputs"]["clip_name2"] = params["clip_name2"]
-            print(f"已将CLIP模型保存到放大及面部修复工作流160节点")
-        
-        # 更新159节点参数（VAE模型）
-        if "159" in workflow_copy:
-            if "inputs" not in workflow_copy["159"]:
-                workflow_copy["159"]["inputs"] = {}
-            workflow_copy["159"]["inputs"]["vae_name"] = params["vae_name"]
-            print(f"已将VAE模型 {params['vae_name']} 保存到放大及面部修复工作流159节点")
-        
-        # 可以添加更多参数的保存...
-        
-    except Exception as e:
-        print(f"保存放大及面部修复参数时出错: {e}")
-        import traceback
-        traceback.print_exc()
+    # 按编译好的补丁计划写入参数，只复制被修改的节点
+    workflow_copy = get_workflow_patch_plan("magnify").apply(template, params)
     
-    # 保存工作流
-    save_magnified_facial_restoration_workflow_json(workflow_copy)
+    # 记住该用户最近一次使用的参数，工作流模板保持不变
+    if user is not None:
+        user_params.remember(user, "magnify", params)
     return workflow_copy
 
 # 提取放大及面部修复参数
@@ -3444,7 +4636,7 @@ with gr.Blocks(title="图片放大 - ComfyUI接口") as magnified_facial_restora
     print(f"界面初始化时的图片名称: '{mfr_params.get('image_name', '')}'")
     
     # 生成放大图像函数
-    def generate_magnified_facial_restoration(*args, progress=gr.Progress()):
+    async def generate_magnified_facial_restoration(*args, progress=gr.Progress()):
         input_image_path = args[0]  # 输入图像路径
         image_name = args[1]  # 图片名称
         positive_prompt = args[2]  # 正向提示词
@@ -3493,26 +4685,13 @@ with gr.Blocks(title="图片放大 - ComfyUI接口") as magnified_facial_restora
         # 打印使用的输入图像
         print(f"使用输入图像: {input_image_path}")
         
-        # 检查图片是否已经在ComfyUI input文件夹中
-        comfyui_input_path = os.path.join(WSL_COMFYUI_PATH, "input")
-        os.makedirs(comfyui_input_path, exist_ok=True)
-        filename = os.path.basename(input_image_path)
-        comfyui_file_path = os.path.join(comfyui_input_path, filename)
-        
-        # 如果不在ComfyUI input文件夹中，复制过去
-        if not input_image_path.startswith(WSL_COMFYUI_PATH):
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            ext = os.path.splitext(filename)[1].lower() or ".png"
-            new_filename = f"image_{timestamp}{ext}"
-            comfyui_file_path = os.path.join(comfyui_input_path, new_filename)
-            
-            try:
-                shutil.copy2(input_image_path, comfyui_file_path)
-                print(f"已将图片从 {input_image_path} 复制到 {comfyui_file_path}")
-                filename = new_filename
-            except Exception as e:
-                print(f"复制图片出错: {e}")
-                return None, f"错误：复制图片到ComfyUI失败 - {str(e)}"
+        # 选定执行任务的ComfyUI服务器，并把图片上传到该服务器（已在input文件夹中或已上传过的图片直接使用文件名）
+        backend = comfyui_pool.select()
+        try:
+            filename = await asyncio.to_thread(backend.client.upload_input_image, input_image_path, "image")
+        except Exception as e:
+            http_log.warning("上传图片出错: %s", e)
+            return None, f"错误：上传图片到ComfyUI失败 - {str(e)}"
         
         # 将输入参数整合到一个字典中
         updated_params = {
@@ -3545,8 +4724,8 @@ with gr.Blocks(title="图片放大 - ComfyUI接口") as magnified_facial_restora
             "seed": seed
         }
         
-        # 保存参数到JSON文件
-        progress(0.05, "保存参数到配置文件...")
+        # 在工作流模板的副本上写入本次参数
+        progress(0.05, "准备工作流...")
         saved_workflow = save_magnified_facial_restoration_workflow(updated_params)
         
         # 创建状态更新的函数
@@ -3556,12 +4735,11 @@ with gr.Blocks(title="图片放大 - ComfyUI接口") as magnified_facial_restora
             nonlocal status_text
             status_text = message
             progress(value, message)
-            print(f"UI进度更新: {value:.2f} - {message}")
         
         # 发送工作流到ComfyUI并获取生成结果
         try:
             # 将输入图像路径作为额外参数传入
-            result_image = send_workflow_to_comfyui(saved_workflow, progress_callback, input_image_path=input_image_path)
+            result_image = await send_workflow_to_comfyui(saved_workflow, progress_callback, input_image_path=input_image_path, backend=backend)
             
             # 如果生成成功，显示成功信息
             if result_image and os.path.exists(result_image):
@@ -3595,45 +4773,30 @@ with gr.Blocks(title="图片放大 - ComfyUI接口") as magnified_facial_restora
                 if img is None:
                     return None, "未上传图片", "图片尺寸: 未知", None
                     
-                # 确保ComfyUI的input文件夹存在
-                comfyui_input_path = os.path.join(WSL_COMFYUI_PATH, "input")
-                os.makedirs(comfyui_input_path, exist_ok=True)
-                
-                # 获取当前时间作为文件名
-                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                # 通过ComfyUI的/upload/image接口上传，内容相同的图片不会重复上传
+                try:
+                    filename = comfyui_pool.default.client.upload_input_image(img, "image")
+                except Exception as e:
+                    http_log.warning("上传输入图像到ComfyUI失败: %s", e)
+                    return None, f"上传输入图像到ComfyUI失败: {str(e)}", "图片尺寸: 未知", gr.update()
                 
-                # 构建文件路径
-                if isinstance(img, str):  # 如果已经是文件路径
-                    ext = os.path.splitext(img)[1].lower()
-                    if not ext:
-                        ext = ".png"  # 默认扩展名
-                    file_path = os.path.join(comfyui_input_path, f"image_{timestamp}{ext}")
-                    
-                    # 复制文件
-                    shutil.copy2(img, file_path)
-                    
-                    # 获取图片尺寸
-                    try:
-                        with Image.open(file_path) as img_obj:
+                # 获取图片尺寸
+                try:
+                    if isinstance(img, str):  # 如果已经是文件路径
+                        with Image.open(img) as img_obj:
                             width, height = img_obj.size
-                            dimension_text = f"图片尺寸: {width} x {height} 像素"
-                    except Exception as e:
-                        dimension_text = f"无法获取图片尺寸: {str(e)}"
-                else:  # 如果是PIL图像对象
-                    file_path = os.path.join(comfyui_input_path, f"image_{timestamp}.png")
-                    img.save(file_path)
-                    
-                    # 获取图片尺寸
-                    try:
+                    else:  # 如果是PIL图像对象
                         width, height = img.size
-                        dimension_text = f"图片尺寸: {width} x {height} 像素"
-                    except Exception as e:
-                        dimension_text = f"无法获取图片尺寸: {str(e)}"
+                    dimension_text = f"图片尺寸: {width} x {height} 像素"
+                except Exception as e:
+                    dimension_text = f"无法获取图片尺寸: {str(e)}"
                 
-                # 获取文件名（不包含路径）
-                filename = os.path.basename(file_path)
+                # ComfyUI在本机时使用input文件夹中的文件，否则继续使用上传的原图
+                file_path = os.path.join(WSL_COMFYUI_PATH, "input", filename)
+                if not os.path.exists(file_path):
+                    file_path = img if isinstance(img, str) else None
                 
-                print(f"已保存输入图像到ComfyUI的input文件夹: {file_path}")
+                http_log.info("已上传输入图像到ComfyUI的input文件夹: %s", filename)
                 
                 # 更新下拉菜单选项
                 new_images = get_input_folder_images()
@@ -3646,7 +4809,7 @@ with gr.Blocks(title="图片放大 - ComfyUI接口") as magnified_facial_restora
                     except Exception as e:
                         print(f"获取文件大小出错: {e}")
                 
-                return file_path, f"已保存图片: {file_path} (文件名: {filename})", dimension_text, gr.update(choices=dropdown_choices, value=file_path)
+                return file_path, f"已保存图片: {file_path} (文件名: {filename})", dimension_text, gr.update(choices=dropdown_choices, value=file_path if file_path in [path for _, path in dropdown_choices] else None)
             
             # 打开input文件夹的函数
             def open_mfr_input_folder():
@@ -3839,8 +5002,10 @@ with gr.Blocks(title="图片放大 - ComfyUI接口") as magnified_facial_restora
                 mfr_seed = gr.Number(value=mfr_params.get("seed", 384340151733828), label="随机种子", precision=0)
                 mfr_random_seed_btn = gr.Button("随机生成种子")
             
-            # 生成按钮
-            mfr_generate_btn = gr.Button("生成放大图像", variant="primary", size="lg")
+            # 生成按钮和取消按钮
+            with gr.Row():
+                mfr_generate_btn = gr.Button("生成放大图像", variant="primary", size="lg")
+                mfr_cancel_btn = gr.Button("取消生成", variant="stop", size="lg")
         
         # 右侧图片显示区
         with gr.Column(scale=1):
@@ -3869,6 +5034,7 @@ with gr.Blocks(title="图片放大 - ComfyUI接口") as magnified_facial_restora
             # 添加状态显示区
             mfr_status_text = gr.Markdown("准备就绪")
             mfr_image_output = gr.Image(label="生成的图片", type="filepath")
+            mfr_image_file_output = gr.File(label="下载原图")
             
             # 添加浏览输出文件夹按钮
             open_output_btn_mfr = gr.Button("浏览输出文件夹")
@@ -3890,13 +5056,34 @@ with gr.Blocks(title="图片放大 - ComfyUI接口") as magnified_facial_restora
         mfr_positive_prompt, mfr_negative_prompt  # 添加更多参数
     ]
     
+    # 参数预设，页面加载时恢复该用户上次使用的参数（输入图像不在其中）
+    add_param_preset_controls(magnified_facial_restoration_demo, "magnify", [
+        ("image_name", mfr_image_name), ("sampler_name", mfr_sampler), ("scheduler", mfr_scheduler),
+        ("steps", mfr_steps), ("cfg", mfr_cfg), ("denoise", mfr_denoise),
+        ("tile_width", mfr_tile_width), ("tile_height", mfr_tile_height), ("tile_padding", mfr_tile_padding), ("mask_blur", mfr_mask_blur),
+        ("seam_fix_mode", mfr_seam_fix_mode), ("seam_fix_denoise", mfr_seam_fix_denoise), ("seam_fix_width", mfr_seam_fix_width),
+        ("seam_fix_mask_blur", mfr_seam_fix_mask_blur), ("seam_fix_padding", mfr_seam_fix_padding),
+        ("force_uniform_tiles", mfr_force_uniform_tiles), ("tiled_decode", mfr_tiled_decode), ("seed", mfr_seed),
+        ("upscale_by", mfr_upscale_by), ("unet_name", mfr_unet_model), ("clip_name1", mfr_clip_model1), ("clip_name2", mfr_clip_model2),
+        ("vae_name", mfr_vae_model), ("upscale_model", mfr_upscale_model),
+        ("positive_prompt", mfr_positive_prompt), ("negative_prompt", mfr_negative_prompt),
+    ])
+    
     # 生成图像按钮的点击事件
-    def generate_mfr(*args, progress=gr.Progress()):
+    @comfyui_admission_control(3)
+    async def generate_mfr(*args, bus, user, progress=gr.Progress()):
         updated_params = {}
         
         # 将输入参数整合到一个字典中
         updated_params["image_name"] = args[0]
-        updated_params["input_image"] = args[1]
+        # 选定执行任务的ComfyUI服务器，输入图像上传到该服务器（已在input文件夹中或已上传过的图片直接使用文件名）
+        backend = comfyui_pool.select()
+        try:
+            updated_params["input_image"] = await asyncio.to_thread(backend.client.upload_input_image, args[1], "image")
+        except Exception as e:
+            http_log.warning("上传输入图像到ComfyUI失败: %s", e)
+            yield None, None, f"上传输入图像到ComfyUI失败: {str(e)}"
+            return
         updated_params["sampler_name"] = args[2]
         updated_params["scheduler"] = args[3]
         updated_params["steps"] = args[4]
@@ -3923,75 +5110,77 @@ with gr.Blocks(title="图片放大 - ComfyUI接口") as magnified_facial_restora
         updated_params["positive_prompt"] = args[25]
         updated_params["negative_prompt"] = args[26]
         
-        # 保存参数到JSON文件
-        progress(0.05, "保存参数到配置文件...")
-        saved_workflow = save_magnified_facial_restoration_workflow(updated_params)
+        # 在工作流模板的副本上写入本次参数
+        progress(0.05, "准备工作流...")
+        saved_workflow = save_magnified_facial_restoration_workflow(updated_params, user)
         
-        # 创建状态更新的函数
+        # 状态文字，生成过程中由进度总线更新
         status_text = "图像生成完成！"
-        is_completed = False
-        
-        def progress_callback(value, message):
-            nonlocal status_text, is_completed
-            status_text = message
-            progress(value, message)
-            print(f"UI进度更新: {value:.2f} - {message}")
-            
-            # 当进度达到0.95时，增加提示信息
-            if value >= 0.95 and not is_completed:
-                status_text = "完成工作流执行，正在寻找并合成最终图像，请耐心等待..."
-                progress(0.95, status_text)
-                print("放大工作流执行接近完成，正在等待最终图像合成...")
         
-        # 发送工作流到ComfyUI并获取生成结果
+        # 发送工作流到ComfyUI并获取生成结果，等待期间按固定频率刷新进度和采样预览图
         try:
-            result_image = send_workflow_to_comfyui(saved_workflow, progress_callback)
-            is_completed = True
+            task = bus.start(send_workflow_to_comfyui(saved_workflow, bus.update, preview=bus, backend=backend, tab="magnify"))
+            async for value, status_text, preview_image in bus.stream(task):
+                progress(value, status_text)
+                yield (preview_image if preview_image is not None else gr.update()), gr.update(), status_text
+            result_image = await task
+            # 最终状态由任务的结束状态决定：执行失败或被中断时显示发送流程报告的原因
+            job_succeeded = bus.job is not None and bus.job.state == "success"
             
             # 检查是否成功获取图像
             if result_image:
-                status_text = "图像生成完成！"
+                status_text = "图像生成完成！" if job_succeeded else bus.message
+                progress(1.0, "完成")
+            elif not job_succeeded:
+                status_text = bus.message or "生成失败"
                 progress(1.0, "完成")
             else:
-                # 如果没有获取到图像，尝试查找最新的图像
-                print("未找到生成的图像，尝试查找最新保存的图像...")
-                status_text = "未找到生成的图像，尝试查找最新保存的图像..."
-                progress(0.95, status_text)
-                
-                result_image = find_latest_image()
+                # 如果没有获取到图像，只查找归属到本任务的输出，不使用其他任务的图像
+                job_log.info("未找到生成的图像，尝试查找本任务保存的图像...")
+                result_image = await asyncio.to_thread(find_latest_image, bus.job)
                 if result_image:
-                    status_text = "已找到最新保存的图像"
-                    progress(1.0, "完成")
+                    status_text = "已找到本任务保存的图像"
                 else:
-                    status_text = "未能找到任何生成的图像"
-                    progress(1.0, "完成")
+                    status_text = "生成失败：未能找到本任务生成的图像"
+                progress(1.0, "完成")
         except Exception as e:
             print(f"生成图像过程中出错: {e}")
             import traceback
             traceback.print_exc()
             status_text = f"生成图像失败: {str(e)}"
-            is_completed = True
-            # 尝试查找最新的图像作为备选
-            result_image = find_latest_image()
+            # 尝试查找本任务已保存的图像作为备选
+            result_image = await asyncio.to_thread(find_latest_image, bus.job) if bus.job is not None else None
         
         # 返回生成的图像
-        return result_image, status_text
+        preview_path, full_path = await prepare_result_display(result_image)
+        yield preview_path, full_path, status_text
     
     # 随机种子按钮的点击事件
     mfr_random_seed_btn.click(fn=generate_random_seed, inputs=None, outputs=mfr_seed)
     
     # 生成按钮的点击事件
-    mfr_generate_btn.click(
+    mfr_generate_event = mfr_generate_btn.click(
         fn=generate_mfr, 
         inputs=mfr_all_inputs, 
-        outputs=[mfr_image_output, mfr_status_text],
-        show_progress="full"
+        outputs=[mfr_image_output, mfr_image_file_output, mfr_status_text],
+        show_progress="full",
+        concurrency_limit=None  # 异步处理函数等待时不占用线程，不限制同时等待的任务数
     )
+    
+    # 取消按钮：取消正在进行的生成，处理函数退出时会删除或中断ComfyUI上的任务
+    mfr_cancel_btn.click(fn=None, inputs=None, outputs=None, cancels=[mfr_generate_event])
+    
+    # 按提示词搜索生成记录
+    add_generation_search()
+    
+    # 页面关闭时取消该会话未完成的任务
+    if hasattr(magnified_facial_restoration_demo, "unload"):
+        magnified_facial_restoration_demo.unload(cancel_session_jobs)
 
 # 保存面部修复调整后的参数
-# 提取面部修复可调节参数
+# 提取面部修复可调节参数：按面部修复的补丁计划读取模板中的当前值
 def extract_facial_restoration_params():
-    params = {
+    return read_workflow_params("facial_restoration", {
         # 设置默认参数
         "seed": 12346,
         "steps": 20,
@@ -4030,197 +5219,26 @@ def extract_facial_restoration_params():
         "image_name": "character_sheet_flux",
         "input_image": None,
         "bbox_model": "bbox/face_yolov8m.pt"
-    }
-    
-    # 如果工作流为空，直接返回默认参数
-    if not facial_restoration_workflow:
-        print("面部修复工作流为空，使用默认参数")
-        return params
-    
-    try:
-        # 打印工作流的节点ID，帮助调试
-        print(f"面部修复工作流节点ID: {list(facial_restoration_workflow.keys())}")
-        
-        # 提取303节点参数（图片命名）
-        if "303" in facial_restoration_workflow and "inputs" in facial_restoration_workflow["303"]:
-            if "string" in facial_restoration_workflow["303"]["inputs"]:
-                params["image_name"] = facial_restoration_workflow["303"]["inputs"]["string"]
-                print(f"从节点303提取图片名称: '{params['image_name']}'")
-        
-        # 提取361节点参数（输入图像）
-        if "361" in facial_restoration_workflow and "inputs" in facial_restoration_workflow["361"]:
-            if "image" in facial_restoration_workflow["361"]["inputs"]:
-                params["input_image"] = facial_restoration_workflow["361"]["inputs"]["image"]
-                print(f"从节点361提取输入图像: {params['input_image']}")
-        
-        # 提取157节点参数（正向提示词）
-        if "157" in facial_restoration_workflow and "inputs" in facial_restoration_workflow["157"]:
-            if "text" in facial_restoration_workflow["157"]["inputs"]:
-                params["positive_prompt"] = facial_restoration_workflow["157"]["inputs"]["text"]
-                print(f"从节点157提取正向提示词: {params['positive_prompt'][:30]}..." if len(params['positive_prompt']) > 30 else f"从节点157提取正向提示词: {params['positive_prompt']}")
-        
-        # 提取364节点参数（负向提示词）
-        if "364" in facial_restoration_workflow and "inputs" in facial_restoration_workflow["364"]:
-            if "text" in facial_restoration_workflow["364"]["inputs"]:
-                params["negative_prompt"] = facial_restoration_workflow["364"]["inputs"]["text"]
-                print(f"从节点364提取负向提示词: {params['negative_prompt'][:30]}..." if len(params['negative_prompt']) > 30 else f"从节点364提取负向提示词: {params['negative_prompt']}")
-        
-        # 提取18节点参数（检测加载器）
-        if "18" in facial_restoration_workflow and "inputs" in facial_restoration_workflow["18"]:
-            if "model_name" in facial_restoration_workflow["18"]["inputs"]:
-                params["bbox_model"] = facial_restoration_workflow["18"]["inputs"]["model_name"]
-                print(f"从节点18提取检测模型: {params['bbox_model']}")
-        
-        # 提取183节点参数（面部细化参数）
-        if "183" in facial_restoration_workflow and "inputs" in facial_restoration_workflow["183"]:
-            face_detailer_params = facial_restoration_workflow["183"]["inputs"]
-            for key in ["guide_size", "guide_size_for", "max_size", "seed", "steps", "cfg", 
-                       "sampler_name", "scheduler", "denoise", "feather", "noise_mask", 
-                       "force_inpaint", "bbox_threshold", "bbox_dilation", "bbox_crop_factor",
-                       "sam_detection_hint", "sam_dilation", "sam_threshold", "sam_bbox_expansion", 
-                       "sam_mask_hint_threshold", "sam_mask_hint_use_negative", "drop_size", 
-                       "refiner_ratio", "cycle", "inpaint_model", "noise_mask_feather", 
-                       "tiled_encode", "tiled_decode"]:
-                if key in face_detailer_params:
-                    params[key] = face_detailer_params[key]
-            print(f"从节点183提取面部细化参数")
-        
-        # 提取161节点参数（UNET模型）
-        if "161" in facial_restoration_workflow and "inputs" in facial_restoration_workflow["161"]:
-            if "unet_name" in facial_restoration_workflow["161"]["inputs"]:
-                params["unet_name"] = facial_restoration_workflow["161"]["inputs"]["unet_name"]
-                print(f"从节点161提取UNET模型: {params['unet_name']}")
-        
-        # 提取160节点参数（CLIP模型）
-        if "160" in facial_restoration_workflow and "inputs" in facial_restoration_workflow["160"]:
-            if "clip_name1" in facial_restoration_workflow["160"]["inputs"]:
-                params["clip_name1"] = facial_restoration_workflow["160"]["inputs"]["clip_name1"]
-            if "clip_name2" in facial_restoration_workflow["160"]["inputs"]:
-                params["clip_name2"] = facial_restoration_workflow["160"]["inputs"]["clip_name2"]
-            print(f"从节点160提取CLIP模型")
-        
-        # 提取159节点参数（VAE模型）
-        if "159" in facial_restoration_workflow and "inputs" in facial_restoration_workflow["159"]:
-            if "vae_name" in facial_restoration_workflow["159"]["inputs"]:
-                params["vae_name"] = facial_restoration_workflow["159"]["inputs"]["vae_name"]
-                print(f"从节点159提取VAE模型: {params['vae_name']}")
-            
-    except Exception as e:
-        print(f"提取面部修复参数时出错: {e}")
-        import traceback
-        traceback.print_exc()
-    
-    return params
+    })
 
-def save_facial_restoration_workflow(params):
-    workflow_copy = copy.deepcopy(facial_restoration_workflow)
-    
+def save_facial_restoration_workflow(params, user=None):
     # 如果工作流为空，使用默认结构
-    if not workflow_copy:
+    template = get_workflow_template("facial_restoration")
+    if not template:
         logging.warning("面部修复工作流为空，无法保存参数")
-        return workflow_copy
+        return {}
     
-    try:
-        # 更新303节点参数（图片命名）
-        if "303" in workflow_copy:
-            if "inputs" not in workflow_copy["303"]:
-                workflow_copy["303"]["inputs"] = {}
-            workflow_copy["303"]["inputs"]["string"] = params["image_name"]
-            print(f"已将图片名称 '{params['image_name']}' 保存到面部修复工作流303节点")
-        
-        # 更新361节点参数（输入图像）
-        if params.get("input_image") and "361" in workflow_copy:
-            if "inputs" not in workflow_copy["361"]:
-                workflow_copy["361"]["inputs"] = {}
-            # ComfyUI期望的格式是直接使用图片名称，它会自动在input目录下查找
-            # 确保只使用文件名，而不是完整路径
-            if params["input_image"] and isinstance(params["input_image"], str):
-                # 如果是路径，只获取文件名部分
-                filename = os.path.basename(params["input_image"])
-                workflow_copy["361"]["inputs"]["image"] = filename
-                print(f"已将输入图像 {filename} 保存到面部修复工作流361节点")
-            else:
-                workflow_copy["361"]["inputs"]["image"] = params["input_image"]
-                print(f"已将输入图像 {params['input_image']} 保存到面部修复工作流361节点")
-        
-        # 更新157节点参数（正向提示词）
-        if "157" in workflow_copy:
-            if "inputs" not in workflow_copy["157"]:
-                workflow_copy["157"]["inputs"] = {}
-            workflow_copy["157"]["inputs"]["text"] = params["positive_prompt"]
-            print(f"已将正向提示词保存到面部修复工作流157节点")
-        
-        # 更新364节点参数（负向提示词）
-        if "364" in workflow_copy:
-            if "inputs" not in workflow_copy["364"]:
-                workflow_copy["364"]["inputs"] = {}
-            workflow_copy["364"]["inputs"]["text"] = params["negative_prompt"]
-            print(f"已将负向提示词保存到面部修复工作流364节点")
-            
-        # 更新18节点参数（检测加载器）
-        if "18" in workflow_copy:
-            if "inputs" not in workflow_copy["18"]:
-                workflow_copy["18"]["inputs"] = {}
-            workflow_copy["18"]["inputs"]["model_name"] = params["bbox_model"]
-            print(f"已将检测模型 {params['bbox_model']} 保存到面部修复工作流18节点")
-        
-        # 更新183节点参数（面部细化参数）
-        if "183" in workflow_copy:
-            if "inputs" not in workflow_copy["183"]:
-                workflow_copy["183"]["inputs"] = {}
-            
-            # 更新面部细化参数
-            face_detailer_params = ["guide_size", "guide_size_for", "max_size", "seed", "steps", "cfg", 
-                                   "sampler_name", "scheduler", "denoise", "feather", "noise_mask", 
-                                   "force_inpaint", "bbox_threshold", "bbox_dilation", "bbox_crop_factor",
-                                   "sam_detection_hint", "sam_dilation", "sam_threshold", "sam_bbox_expansion", 
-                                   "sam_mask_hint_threshold", "sam_mask_hint_use_negative", "drop_size", 
-                                   "refiner_ratio", "cycle", "inpaint_model", "noise_mask_feather", 
-                                   "tiled_encode", "tiled_decode"]
-            
-            for key in face_detailer_params:
-                if key in params:
-                    workflow_copy["183"]["inputs"][key] = params[key]
-            
-            print(f"已将面部细化参数保存到面部修复工作流183节点")
-        
-        # 更新161节点参数（UNET模型）
-        if "161" in workflow_copy:
-            if "inputs" not in workflow_copy["161"]:
-                workflow_copy["161"]["inputs"] = {}
-            workflow_copy["161"]["inputs"]["unet_name"] = params["unet_name"]
-            print(f"已将UNET模型 {params['unet_name']} 保存到面部修复工作流161节点")
-        
-        # 更新160节点参数（CLIP模型）
-        if "160" in workflow_copy:
-            if "inputs" not in workflow_copy["160"]:
-                workflow_copy["160"]["inputs"] = {}
-            workflow_copy["160"]["inputs"]["clip_name1"] = params["clip_name1"]
-            workflow_copy["160"]["inputs"]["clip_name2"] = params["clip_name2"]
-            print(f"已将CLIP模型保存到面部修复工作流160节点")
-        
-        # 更新159节点参数（VAE模型）
-        if "159" in workflow_copy:
-            if "inputs" not in workflow_copy["159"]:
-                workflow_copy["159"]["inputs"] = {}
-            workflow_copy["159"]["inputs"]["vae_name"] = params["vae_name"]
-            print(f"已将VAE模型 {params['vae_name']} 保存到面部修复工作流159节点")
-        
-        # 保存工作流文件
-        save_facial_restoration_workflow_json(workflow_copy)
-        print("已保存面部修复工作流")
-        
-        return workflow_copy
-    except Exception as e:
-        print(f"保存面部修复工作流参数时出错: {e}")
-        import traceback
-        traceback.print_exc()
-        return workflow_copy
+    # 按编译好的补丁计划写入参数，只复制被修改的节点
+    workflow_copy = get_workflow_patch_plan("facial_restoration").apply(template, params)
+    
+    # 记住该用户最近一次使用的参数，工作流模板保持不变
+    if user is not None:
+        user_params.remember(user, "facial_restoration", params)
+    return workflow_copy
 
 # 创建面部修复界面
 with gr.Blocks(title="面部修复 - ComfyUI接口") as fr_demo:
-    # 初始化工作流和参数
-    facial_restoration_workflow = load_facial_restoration_workflow()
+    # 初始化参数
     facial_restoration_params = extract_facial_restoration_params()
     
     # 定义UI组件
@@ -4263,6 +5281,7 @@ with gr.Blocks(title="面部修复 - ComfyUI接口") as fr_demo:
                             height=400,
                             interactive=False  # 设置为非交互式，即只读
                         )
+                        fr_original_file_output = gr.File(label="下载完整处理原图")
                     
                     with gr.Column(scale=1):
                         gr.Markdown("### 面部细节图像")
@@ -4272,6 +5291,7 @@ with gr.Blocks(title="面部修复 - ComfyUI接口") as fr_demo:
                             height=400,
                             interactive=False  # 设置为非交互式，即只读
                         )
+                        fr_image_file_output = gr.File(label="下载面部细节原图")
                 
                 with gr.Row():
                     fr_open_output_folder_btn = gr.Button("打开输出文件夹")
@@ -4492,9 +5512,10 @@ with gr.Blocks(title="面部修复 - ComfyUI接口") as fr_demo:
                             lines=2
                         )
                 
-                # 生成按钮
+                # 生成按钮和取消按钮
                 with gr.Row():
                     fr_generate_btn = gr.Button("开始面部修复", variant="primary")
+                    fr_cancel_btn = gr.Button("取消生成", variant="stop")
     
     # 定义所有输入参数列表
     fr_all_inputs = [
@@ -4524,28 +5545,30 @@ with gr.Blocks(title="面部修复 - ComfyUI接口") as fr_demo:
         fr_vae_name
     ]
     
+    # 参数预设，页面加载时恢复该用户上次使用的参数（输入图像不在其中）
+    add_param_preset_controls(fr_demo, "facial_restoration", list(zip([
+        "image_name", "positive_prompt", "negative_prompt", "steps", "cfg", "sampler_name", "scheduler", "denoise",
+        "guide_size", "max_size", "feather", "noise_mask", "force_inpaint", "bbox_threshold", "bbox_dilation",
+        "bbox_crop_factor", "guide_size_for", "seed", "bbox_model", "unet_name", "clip_name1", "clip_name2", "vae_name",
+    ], fr_all_inputs[1:])))
+    
     # 定义图像处理函数
-    def save_fr_image_to_input_folder(img):
+    def save_fr_image_to_input_folder(img, backend=None):
         if img is None:
             return None, "未选择图像", []
         
-        # 确保ComfyUI的input文件夹存在
-        os.makedirs(os.path.join(WSL_COMFYUI_PATH, "input"), exist_ok=True)
-        
-        # 生成随机文件名
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        random_suffix = random.randint(1000, 9999)
-        filename = f"fr_input_{timestamp}_{random_suffix}.png"
-        filepath = os.path.join(WSL_COMFYUI_PATH, "input", filename)
-        
-        # 保存图像
-        img.save(filepath)
-        print(f"已保存图像到: {filepath}")
+        # 通过ComfyUI的/upload/image接口上传，内容相同的图片不会重复上传
+        backend = backend or comfyui_pool.default
+        try:
+            filename = backend.client.upload_input_image(img, "fr_input")
+        except Exception as e:
+            http_log.warning("上传图像到ComfyUI失败: %s", e)
+            return None, f"上传图像到ComfyUI失败: {str(e)}", []
         
         # 刷新图像列表
         updated_choices = get_input_folder_images()
         
-        return filename, f"图像已保存到: {filepath}", updated_choices
+        return filename, f"图像已上传到ComfyUI: {filename}", updated_choices
     
     # 打开输入文件夹
     def open_fr_input_folder():
@@ -4614,17 +5637,24 @@ with gr.Blocks(title="面部修复 - ComfyUI接口") as fr_demo:
         return "已打开输出文件夹"
     
     # 生成函数
-    def generate_facial_restoration(*args, progress=gr.Progress()):
+    @comfyui_admission_control(5)
+    async def generate_facial_restoration(*args, bus, user, progress=gr.Progress()):
         # 将参数转换为字典
         fr_image_input = args[0]
         
         # 检查是否提供了图像
         if fr_image_input is None:
-            return None, None, "错误：请先上传或选择一张图像"
+            yield None, None, None, None, "错误：请先上传或选择一张图像"
+            return
         
         # 保存图像到输入文件夹
-        progress(0.02, "保存输入图像...")
-        image_filename, _, _ = save_fr_image_to_input_folder(fr_image_input)
+        # 选定执行任务的ComfyUI服务器，输入图像上传到该服务器
+        progress(0.02, "上传输入图像...")
+        backend = comfyui_pool.select()
+        image_filename, upload_status, _ = await asyncio.to_thread(save_fr_image_to_input_folder, fr_image_input, backend)
+        if not image_filename:
+            yield None, None, None, None, upload_status
+            return
         
         # 更新参数
         updated_params = facial_restoration_params.copy()
@@ -4653,87 +5683,99 @@ with gr.Blocks(title="面部修复 - ComfyUI接口") as fr_demo:
         updated_params["vae_name"] = args[23]
         updated_params["input_image"] = image_filename
         
-        # 保存参数到JSON文件
-        progress(0.05, "保存参数到配置文件...")
-        saved_workflow = save_facial_restoration_workflow(updated_params)
+        # 在工作流模板的副本上写入本次参数
+        progress(0.05, "准备工作流...")
+        saved_workflow = save_facial_restoration_workflow(updated_params, user)
         
-        # 创建状态更新的函数
+        # 状态文字，生成过程中由进度总线更新
         status_text = "图像生成完成！"
-        is_completed = False
         complete_image = None
         detail_image = None
         
-        def progress_callback(value, message):
-            nonlocal status_text, is_completed
-            status_text = message
-            progress(value, message)
-            print(f"UI进度更新: {value:.2f} - {message}")
-            
-            # 当进度达到0.95时，增加提示信息
-            if value >= 0.95 and not is_completed:
-                status_text = "完成工作流执行，正在寻找并合成最终图像，请耐心等待..."
-                progress(0.95, status_text)
-                print("面部修复工作流执行接近完成，正在等待最终图像合成...")
-        
         # 发送工作流到ComfyUI并获取生成结果
         try:
-            # 尝试获取两种图像结果
-            result_images = send_workflow_to_comfyui(saved_workflow, progress_callback, return_all_images=True)
-            is_completed = True
+            # 尝试获取两种图像结果，等待期间按固定频率刷新进度，并在完整图像位置显示采样预览图
+            task = bus.start(send_workflow_to_comfyui(saved_workflow, bus.update, return_all_images=True, preview=bus, backend=backend, tab="facial_restoration"))
+            async for value, status_text, preview_image in bus.stream(task):
+                progress(value, status_text)
+                complete_update = preview_image if preview_image is not None else gr.update()
+                detail_update = complete_file_update = detail_file_update = gr.update()
+                # 已下载完成的图像立即显示，不等另一张下载完：第一张为完整图像，第二张为面部细节图像
+                for index, path in bus.take_results():
+                    preview_path, full_path = await prepare_result_display(path)
+                    if index == 0:
+                        complete_update, complete_file_update = preview_path, full_path
+                    elif index == 1:
+                        detail_update, detail_file_update = preview_path, full_path
+                yield complete_update, detail_update, complete_file_update, detail_file_update, status_text
+            result_images = await task
+            # 最终状态由任务的结束状态决定：执行失败或被中断时显示发送流程报告的原因
+            job_succeeded = bus.job is not None and bus.job.state == "success"
             
             # 检查是否成功获取图像
             if result_images and len(result_images) >= 2:
                 complete_image = result_images[0]  # 179节点的完整图像
                 detail_image = result_images[1]    # 87节点的面部细节图像
-                status_text = "图像生成完成！"
+                status_text = "图像生成完成！" if job_succeeded else bus.message
                 progress(1.0, "完成")
             elif result_images and len(result_images) == 1:
                 # 如果只获取到一张图像，同时设置为两个输出
                 complete_image = result_images[0]
                 detail_image = result_images[0]
-                status_text = "仅获取到一张处理图像"
+                status_text = "仅获取到一张处理图像" if job_succeeded else bus.message
+                progress(1.0, "完成")
+            elif not job_succeeded:
+                status_text = bus.message or "生成失败"
                 progress(1.0, "完成")
             else:
-                # 如果没有获取到图像，尝试查找最新的图像
-                print("未找到生成的图像，尝试查找最新保存的图像...")
-                status_text = "未找到生成的图像，尝试查找最新保存的图像..."
-                progress(0.95, status_text)
-                
-                latest_image = find_latest_image()
+                # 如果没有获取到图像，只查找归属到本任务的输出，不使用其他任务的图像
+                job_log.info("未找到生成的图像，尝试查找本任务保存的图像...")
+                latest_image = await asyncio.to_thread(find_latest_image, bus.job)
                 if latest_image:
                     complete_image = latest_image
                     detail_image = latest_image
-                    status_text = "已找到最新保存的图像"
-                    progress(1.0, "完成")
+                    status_text = "已找到本任务保存的图像"
                 else:
-                    status_text = "未能找到任何生成的图像"
-                    progress(1.0, "完成")
+                    status_text = "生成失败：未能找到本任务生成的图像"
+                progress(1.0, "完成")
         except Exception as e:
             print(f"生成图像过程中出错: {e}")
             import traceback
             traceback.print_exc()
             status_text = f"生成图像失败: {str(e)}"
-            is_completed = True
-            # 尝试查找最新的图像作为备选
-            latest_image = find_latest_image()
+            # 尝试查找本任务已保存的图像作为备选
+            latest_image = await asyncio.to_thread(find_latest_image, bus.job) if bus.job is not None else None
             if latest_image:
                 complete_image = latest_image
                 detail_image = latest_image
         
-        # 返回生成的图像和原始图像
-        return complete_image, detail_image, status_text
+        # 返回生成的图像和原始图像：图像组件显示预览图，文件组件提供原图下载
+        complete_preview, complete_image = await prepare_result_display(complete_image)
+        detail_preview, detail_image = await prepare_result_display(detail_image)
+        yield complete_preview, detail_preview, complete_image, detail_image, status_text
     
     # 随机种子按钮的点击事件
     fr_random_seed_btn.click(fn=generate_random_seed, inputs=None, outputs=fr_seed)
     
     # 生成按钮的点击事件
-    fr_generate_btn.click(
+    fr_generate_event = fr_generate_btn.click(
         fn=generate_facial_restoration, 
         inputs=fr_all_inputs, 
-        outputs=[fr_original_image_output, fr_image_output, fr_status_text],
-        show_progress="full"
+        outputs=[fr_original_image_output, fr_image_output, fr_original_file_output, fr_image_file_output, fr_status_text],
+        show_progress="full",
+        concurrency_limit=None  # 异步处理函数等待时不占用线程，不限制同时等待的任务数
     )
     
+    # 取消按钮：取消正在进行的生成，处理函数退出时会删除或中断ComfyUI上的任务
+    fr_cancel_btn.click(fn=None, inputs=None, outputs=None, cancels=[fr_generate_event])
+    
+    # 按提示词搜索生成记录
+    add_generation_search()
+    
+    # 页面关闭时取消该会话未完成的任务
+    if hasattr(fr_demo, "unload"):
+        fr_demo.unload(cancel_session_jobs)
+    
     # 图像列表相关事件
     fr_image_list.change(
         fn=select_existing_fr_image,
@@ -4808,13 +5850,15 @@ with gr.Blocks(title="面部修复 - ComfyUI接口") as fr_demo:
             # 确保output文件夹存在
             os.makedirs("output", exist_ok=True)
             
-            # 使用时间戳生成文件名
+            # 使用时间戳生成文件名，保留原图的文件格式
+            source_path = getattr(image, "name", image)
             timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"facial_restoration_detail_{timestamp}.png"
+            ext = os.path.splitext(source_path)[1] or ".png"
+            filename = f"facial_restoration_detail_{timestamp}{ext}"
             filepath = os.path.join("output", filename)
             
-            # 保存图像
-            image.save(filepath)
+            # 复制原图
+            shutil.copyfile(source_path, filepath)
             print(f"已保存面部细节图像到: {filepath}")
             
             return f"面部细节图像已保存到: {filepath}"
@@ -4831,13 +5875,15 @@ with gr.Blocks(title="面部修复 - ComfyUI接口") as fr_demo:
             # 确保output文件夹存在
             os.makedirs("output", exist_ok=True)
             
-            # 使用时间戳生成文件名
+            # 使用时间戳生成文件名，保留原图的文件格式
+            source_path = getattr(image, "name", image)
             timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"facial_restoration_complete_{timestamp}.png"
+            ext = os.path.splitext(source_path)[1] or ".png"
+            filename = f"facial_restoration_complete_{timestamp}{ext}"
             filepath = os.path.join("output", filename)
             
-            # 保存图像
-            image.save(filepath)
+            # 复制原图
+            shutil.copyfile(source_path, filepath)
             print(f"已保存完整处理图像到: {filepath}")
             
             return f"完整处理图像已保存到: {filepath}"
@@ -4847,13 +5893,13 @@ with gr.Blocks(title="面部修复 - ComfyUI接口") as fr_demo:
 
     fr_save_processed_image_btn.click(
         fn=save_current_fr_processed_image,
-        inputs=fr_image_output,
+        inputs=fr_image_file_output,
         outputs=fr_status_text
     )
     
     fr_save_original_image_btn.click(
         fn=save_current_fr_original_image,
-        inputs=fr_original_image_output,
+        inputs=fr_original_file_output,
         outputs=fr_status_text
     )
 
@@ -4890,6 +5936,33 @@ if __name__ == "__main__":
         else:
             logging.info("运行环境: 开发环境")
         
+        # 在后台重建输出存储的去重索引，并把已有的生成结果补录到生成记录索引
+        def backfill_generation_index():
+            try:
+                count = comfyui_outputs.rebuild_index()
+                if count:
+                    history_log.info("已从输出文件夹重建 %s 个文件的去重索引", count)
+            except Exception as e:
+                history_log.warning("重建输出去重索引失败: %s", e)
+            for directory in ("output", os.path.join(WSL_COMFYUI_PATH, "output")):
+                try:
+                    count = generation_index.backfill(directory)
+                    if count:
+                        history_log.info("已补录 %s 张图像到生成记录: %s", count, directory)
+                except Exception as e:
+                    history_log.warning("补录生成记录失败: %s, %s", directory, e)
+        threading.Thread(target=backfill_generation_index, name="generation-backfill", daemon=True).start()
+        
+        # 监视输出文件夹中新出现的图像
+        output_watcher.start()
+        
+        # 在后台按保留策略清理旧文件
+        retention_manager.start()
+        
+        # 检查ComfyUI服务器连通性，连接失败时仅提示，不阻止界面启动
+        if not comfyui_pool.probe():
+            pool_log.warning("当前无法连接任何ComfyUI服务器 %s，请确认ComfyUI已启动", ", ".join(COMFYUI_SERVERS))
+        
         # 确保必要的目录存在
         os.makedirs("json", exist_ok=True)
         os.makedirs("workflows", exist_ok=True)
@@ -0,0 +1,27 @@
+import os
+
+import app
+
+
+# 清理输出文件夹后，生成记录中对应的输出也要被删除（索引记录的是相对路径时也一样）
+def test_sweep_removes_evicted_outputs_from_index(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    shard = os.path.join("output", "2026", "10", "18")
+    os.makedirs(shard)
+    path = os.path.join(shard, "0123456789abcdef_deadbeef.png")
+    with open(path, "wb") as f:
+        f.write(b"png")
+    os.utime(path, (0, 0))
+
+    index = app.GenerationIndex(str(tmp_path / "generations.db"))
+    index.record("prompt-1", "txt2img", "success", {}, [path])
+
+    manager = app.RetentionManager()
+    manager.add_policy(app.RetentionPolicy("output", max_age_days=1, recursive=True,
+                                           on_evict=index.remove_outputs))
+    manager.sweep()
+
+    assert not os.path.exists(path)
+    assert index.latest_output() is None
+    rows = index._connect().execute("SELECT COUNT(*) FROM outputs").fetchone()[0]
+    assert rows == 0